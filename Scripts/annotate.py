@@ -63,7 +63,7 @@ def previous_release_annotate(fpath: Optional[str], df: pd.DataFrame, columns: D
     if fpath:
         if not os.path.exists("{}.tbi".format(fpath)):
             raise FileNotFoundError("Tabix index for file {} not found. Make sure that the file is properly indexed.".format(fpath))
-        previous_df = load_annotation_df(df,fpath,columns,columns, chrom_prefix="", na_value="")
+        previous_df = load_pysam_df(df,fpath,columns, chrom_prefix="", na_value="")
     else:
         return pd.DataFrame(columns = out_columns)
 
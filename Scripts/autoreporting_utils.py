@@ -2,8 +2,9 @@ import argparse,shlex,subprocess, os
 from subprocess import Popen, PIPE
 import pandas as pd, numpy as np #typing: ignore
 import pysam
-from typing import List, Dict, NamedTuple
+from typing import List, Dict, NamedTuple, Optional
 import gzip
+import threading
 """
 Utility functions that are used in the scripts, put here for keeping the code clearer
 """
@@ -35,7 +36,7 @@ def create_variant_column(df,chrom="#chrom",pos="pos",ref="ref",alt="alt"):
     """
     if df.empty:
         return None
-    return df.apply( lambda x: "chr{}_{}_{}_{}".format(x[chrom],x[pos],x[ref],x[alt]) ,axis=1)
+    return ("chr" + df[chrom].astype(str) + "_" + df[pos].astype(str) + "_" + df[ref].astype(str) + "_" + df[alt].astype(str)).rename(None)
 
 def load_annotation_df(df: pd.DataFrame, fpath: str, columns: Dict[str,str], resource_columns: Dict[str,str], chrom_prefix: str="", na_value: str=".") -> pd.DataFrame:
     """Load annotation data by reading the whole annotation file
@@ -66,59 +67,88 @@ def load_annotation_df(df: pd.DataFrame, fpath: str, columns: Dict[str,str], res
     out[out.columns]=out[out.columns].apply(pd.to_numeric,errors="ignore")
     return out
 
+class TabixPool(object):
+    """Pool of tabix file handles, with one handle per file and thread, so that the same files can be read from several threads.
+    Handles are reopened in forked worker processes. File headers and contig names are read once per file.
+    """
+    def __init__(self):
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__headers = {}
+        self.__contigs = {}
+
+    def handle(self, fpath: str) -> pysam.TabixFile:
+        """Return the tabix handle of this thread for a file, opening it if necessary
+        """
+        if getattr(self.__local, "pid", None) != os.getpid():
+            self.__local.pid = os.getpid()
+            self.__local.handles = {}
+        handles = self.__local.handles
+        if fpath not in handles:
+            handles[fpath] = pysam.TabixFile(fpath)
+        return handles[fpath]
+
+    def header(self, fpath: str) -> List[str]:
+        """Return the column names of a file, i.e. its first line
+        """
+        with self.__lock:
+            if fpath not in self.__headers:
+                with gzip.open(fpath) as f:
+                    header_temp = f.readline().decode()
+                self.__headers[fpath] = header_temp.strip("\n").split("\t")
+            return self.__headers[fpath]
+
+    def contigs(self, fpath: str) -> List[str]:
+        """Return the contigs in the tabix index of a file
+        """
+        with self.__lock:
+            if fpath not in self.__contigs:
+                self.__contigs[fpath] = list(self.handle(fpath).contigs)
+            return self.__contigs[fpath]
+
+    def fetch(self, fpath: str, chrom: str, start: int, end: int) -> List[str]:
+        """Return the lines of a file in a range, using the handle of this thread
+        """
+        return list(self.handle(fpath).fetch(chrom, start, end))
+
+    def close(self):
+        """Close the handles of this thread
+        """
+        for handle in getattr(self.__local, "handles", {}).values():
+            handle.close()
+        self.__local.handles = {}
+
+#process-wide tabix handle pool
+tabix_pool = TabixPool()
+
 def load_pysam_df(df,fpath,columns,chrom_prefix="",na_value=".") -> pd.DataFrame:
     """Load variants using pysam from tabix-indexed file
     Args:
-
+        df (pd.DataFrame): Variants, with the chromosome and position columns in columns
+        fpath (str): tabix-indexed file, with the same chromosome and position column names
+        columns (Dict[str,str]): column names
+        chrom_prefix (str): Prefix of the chromosome names in the file
+        na_value (str): Missing value in the file
     Returns:
         (pd.DataFrame): DataFrame with same columns as the annotation file
     """
-    tb = pysam.TabixFile(fpath)
-    #generate chrom-position df
-    chrompos_df = df[[columns["chrom"], columns["pos"]]].copy()
-    chrompos_df = chrompos_df.rename(columns = {columns["chrom"]:"chrom",columns["pos"]:"pos"}).drop_duplicates(keep="first")
-    tbxlst = []
-    for t in chrompos_df.itertuples():
-        #get rows
-        try:
-            rows = tb.fetch("{}{}".format(chrom_prefix,t.chrom), int(t.pos)-1,int(t.pos))
-        except:
-            rows = []
-        data = [a.strip('\n').split('\t') for a in rows]
-        tbxlst.extend(data)
-
-    #header = tb.header[0].split('\t')
-    with gzip.open(fpath) as f:
-        header_temp = f.readline().decode()
-    header = header_temp.strip("\n").split("\t")
- 
-    out_df = pd.DataFrame(tbxlst, columns = header)
-    out_df=out_df.replace(na_value,np.nan)
-    out_df[out_df.columns]=out_df[out_df.columns].apply(pd.to_numeric,errors="ignore")
-    tb.close()
-    return out_df
+    points = df[[columns["chrom"], columns["pos"]]].rename(columns = {columns["chrom"]:"chrom",columns["pos"]:"pos"})
+    header = tabix_pool.header(fpath)
+    return load_tabix_rows(fpath, points=points, chrom_prefix=chrom_prefix, na_value=na_value,
+        chrom_col=columns["chrom"] if columns["chrom"] in header else None,
+        pos_col=columns["pos"] if columns["pos"] in header else None)
 
 def load_pysam_ranges(df: pd.DataFrame, fpath: str, chrom_prefix: str = "", na_value: str = ".") -> pd.DataFrame:
-    tb = pysam.TabixFile(fpath)
-    tbxlst=[]
-    for _,row in df.iterrows():
-        try:
-            rows = tb.fetch("{}{}".format(chrom_prefix,row["chrom"]),max(int(row["min"])-1,0),int(row["max"]))
-        except Exception as ex:
-            print(f"Exception with loading pysam range {row}]")
-            print(ex)
-            rows = []
-        data = [a.strip('\n').split('\t') for a in rows]
-        tbxlst.extend(data)
-    #header = tb.header[0].split('\t')
-    with gzip.open(fpath) as f:
-        header_temp = f.readline().decode()
-    header = header_temp.strip("\n").split("\t")
-    out_df = pd.DataFrame(tbxlst, columns = header)
-    out_df=out_df.replace(na_value,np.nan)
-    out_df[out_df.columns]=out_df[out_df.columns].apply(pd.to_numeric,errors="ignore")
-    tb.close()
-    return out_df
+    """Load the rows in ranges using pysam from tabix-indexed file
+    Args:
+        df (pd.DataFrame): Ranges, with columns (chrom, min, max)
+        fpath (str): tabix-indexed file, with chromosome and position as the first two columns
+        chrom_prefix (str): Prefix of the chromosome names in the file
+        na_value (str): Missing value in the file
+    Returns:
+        (pd.DataFrame): DataFrame with same columns as the file
+    """
+    return load_tabix_rows(fpath, ranges=df, chrom_prefix=chrom_prefix, na_value=na_value)
 
 class Region(NamedTuple):
     chrom: str
@@ -163,6 +193,207 @@ def prune_regions(regions:List[Region])->List[Region]:
     return out
 
 
+#default gap in bp under which tabix range queries are merged to one range fetch
+TABIX_MAX_GAP = 10000
+#default gap for position lookups, which are sparse, so that only nearby positions share a fetch
+TABIX_POINT_MAX_GAP = 1000
+
+def coalesce_intervals(chroms: np.ndarray, starts: np.ndarray, ends: np.ndarray, max_gap: int) -> List[Region]:
+    """Sort intervals and merge the ones that overlap or are closer than max_gap to each other, so that they can be read with one range query
+    Args:
+        chroms (np.ndarray): chromosome of each interval
+        starts (np.ndarray): interval starts
+        ends (np.ndarray): interval ends, inclusive
+        max_gap (int): Largest gap in bp between merged intervals
+    Returns:
+        (List[Region]): Sorted, non-overlapping intervals covering all intervals
+    """
+    if len(starts) == 0:
+        return []
+    data = pd.DataFrame({
+        "chrom":np.asarray(chroms).astype(str),
+        "start":np.asarray(starts, dtype=np.int64),
+        "end":np.asarray(ends, dtype=np.int64)
+    }).sort_values(["chrom","start"], kind="mergesort")
+    chrom = data["chrom"].values
+    #furthest end of the preceding intervals on the same chromosome
+    reach = data.groupby("chrom", sort=False)["end"].cummax().values
+    new_range = np.r_[True, (chrom[1:] != chrom[:-1]) | (data["start"].values[1:] > reach[:-1] + max_gap)]
+    group = np.cumsum(new_range)
+    merged = data.groupby(group).agg({"chrom":"first","start":"min","end":"max"})
+    return [Region(a, int(b), int(c)) for a, b, c in zip(merged["chrom"], merged["start"], merged["end"])]
+
+def coalesce_positions(chroms: np.ndarray, positions: np.ndarray, max_gap: int) -> List[Region]:
+    """Merge positions to ranges, so that nearby positions can be read with one range query
+    Args:
+        chroms (np.ndarray): chromosome of each position
+        positions (np.ndarray): positions
+        max_gap (int): Largest gap in bp between consecutive positions of a range
+    Returns:
+        (List[Region]): Ranges covering all positions
+    """
+    return coalesce_intervals(chroms, positions, positions, max_gap)
+
+def _position_keys(chrom: pd.Series, pos: pd.Series, chrom_codes: Dict[str,int]) -> np.ndarray:
+    """Combine chromosome and position to one sortable key. Positions on other chromosomes get negative keys.
+    """
+    codes = chrom.astype(str).map(chrom_codes).fillna(-1).values.astype(np.int64)
+    return (codes << 32) + pd.to_numeric(pos, errors="coerce").fillna(-1).values.astype(np.int64)
+
+def _in_intervals(keys: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Return whether each key is inside one of the sorted, non-overlapping intervals [start, end]
+    """
+    idx = np.searchsorted(starts, keys, side="right") - 1
+    inside = idx >= 0
+    inside[inside] = keys[inside] <= ends[idx[inside]]
+    return inside
+
+def in_regions(chrom: pd.Series, pos: pd.Series, regions: List[Region]) -> np.ndarray:
+    """Return whether each position is inside one of the regions. Both ends of the regions are included.
+    Args:
+        chrom (pd.Series): chromosomes
+        pos (pd.Series): positions
+        regions (List[Region]): regions
+    Returns:
+        (np.ndarray): boolean array, True for the positions in the regions
+    """
+    if not regions:
+        return np.zeros(len(pos), dtype=bool)
+    union = pd.DataFrame(coalesce_intervals(np.array([a.chrom for a in regions]), np.array([a.start for a in regions]), np.array([a.end for a in regions]), 0))
+    chrom_codes = {a:i for i,a in enumerate(sorted(union["chrom"].unique()))}
+    return _in_intervals(_position_keys(chrom, pos, chrom_codes), _position_keys(union["chrom"], union["start"], chrom_codes), _position_keys(union["chrom"], union["end"], chrom_codes))
+
+def plan_region_queries(regions: List[Region], max_gap: int, max_span: int) -> List[Region]:
+    """Merge regions that are closer than max_gap to each other to fewer, wider regions, so that they can be fetched with one query each.
+    A merged region spans at most max_span bp, unless one of the regions is wider than that.
+    Args:
+        regions (List[Region]): regions
+        max_gap (int): Largest gap in bp between merged regions
+        max_span (int): Largest span in bp of a merged region
+    Returns:
+        (List[Region]): Sorted regions covering all regions
+    """
+    out = []
+    for region in sorted(regions, key=lambda x: (str(x.chrom), x.start)):
+        if out and out[-1].chrom == region.chrom and region.start <= out[-1].end + max_gap and max(out[-1].end, region.end) - out[-1].start <= max_span:
+            out[-1] = Region(out[-1].chrom, out[-1].start, max(out[-1].end, region.end))
+        else:
+            out.append(region)
+    return out
+
+def load_tabix_rows(fpath: str, points: Optional[pd.DataFrame] = None, ranges: Optional[pd.DataFrame] = None, chrom_prefix: str = "", na_value: str = ".",
+        chrom_col: Optional[str] = None, pos_col: Optional[str] = None, max_gap: Optional[int] = None) -> pd.DataFrame:
+    """Load the rows at positions and in ranges of a tabix-indexed file.
+    The queries are sorted and merged to intervals, each interval is fetched once through the tabix pool, and the rows of the requested positions and ranges are selected in vectorised form.
+    Args:
+        fpath (str): tabix-indexed file
+        points (Optional[pd.DataFrame]): Positions, with columns (chrom, pos)
+        ranges (Optional[pd.DataFrame]): Ranges, with columns (chrom, min, max). Both ends are included.
+        chrom_prefix (str): Prefix of the chromosome names in the file
+        na_value (str): Missing value in the file
+        chrom_col (Optional[str]): Chromosome column of the file. Default is the first column.
+        pos_col (Optional[str]): Position column of the file. Default is the second column.
+        max_gap (Optional[int]): Queries closer than this are fetched as one interval. Default is TABIX_MAX_GAP if there are range queries, and TABIX_POINT_MAX_GAP for position lookups only.
+    Returns:
+        (pd.DataFrame): DataFrame with same columns as the file, sorted by chromosome and position
+    """
+    header = tabix_pool.header(fpath)
+    chrom_col = chrom_col if chrom_col else header[0]
+    pos_col = pos_col if pos_col else header[1]
+    queries = []
+    if points is not None:
+        queries.append(pd.DataFrame({"chrom":points["chrom"].astype(str), "min":points["pos"].astype(np.int64), "max":points["pos"].astype(np.int64), "point":True}))
+    if ranges is not None:
+        queries.append(pd.DataFrame({"chrom":ranges["chrom"].astype(str), "min":ranges["min"].astype(np.int64).clip(lower=1), "max":ranges["max"].astype(np.int64), "point":False}))
+    queries = pd.concat(queries + [pd.DataFrame(columns=["chrom","min","max","point"])], ignore_index=True, sort=False)
+    if max_gap is None:
+        max_gap = TABIX_MAX_GAP if ranges is not None else TABIX_POINT_MAX_GAP
+    queries["chrom"] = chrom_prefix + queries["chrom"]
+    #chromosomes that are not in the file have no rows
+    queries = queries.loc[queries["chrom"].isin(tabix_pool.contigs(fpath)),:]
+    lines = []
+    for interval in coalesce_intervals(queries["chrom"].values, queries["min"].values, queries["max"].values, max_gap):
+        try:
+            lines.extend(tabix_pool.fetch(fpath, interval.chrom, interval.start-1, interval.end))
+        except Exception as ex:
+            print(f"Exception with loading pysam range {interval}")
+            print(ex)
+    if not lines:
+        return pd.DataFrame(columns=header)
+    out_df = pd.Series(lines).str.strip("\n").str.split("\t", expand=True)
+    out_df.columns = header[:out_df.shape[1]]
+    out_df = out_df.reindex(columns=header)
+    #select the rows of the requested positions, and of the requested ranges
+    chrom_codes = {a:i for i,a in enumerate(sorted(queries["chrom"].unique()))}
+    row_keys = _position_keys(out_df[chrom_col], out_df[pos_col], chrom_codes)
+    is_point = queries["point"].astype(bool)
+    keep = np.isin(row_keys, _position_keys(queries.loc[is_point,"chrom"], queries.loc[is_point,"min"], chrom_codes))
+    range_queries = queries.loc[~is_point,:]
+    if not range_queries.empty:
+        union = pd.DataFrame(coalesce_intervals(range_queries["chrom"].values, range_queries["min"].values, range_queries["max"].values, 0))
+        keep |= _in_intervals(row_keys, _position_keys(union["chrom"], union["start"], chrom_codes), _position_keys(union["chrom"], union["end"], chrom_codes))
+    out_df = out_df.loc[keep,:].reset_index(drop=True)
+    out_df=out_df.replace(na_value,np.nan)
+    out_df[out_df.columns]=out_df[out_df.columns].apply(pd.to_numeric,errors="ignore")
+    return out_df
+
+def _run_starts(values: np.ndarray) -> np.ndarray:
+    """Return the indices where runs of equal values start
+    """
+    return np.flatnonzero(np.r_[True, values[1:] != values[:-1]]) if values.size else np.array([],dtype=int)
+
+class PositionIndex(object):
+    """Per-chromosome sorted position index of a dataframe, for answering region queries without scanning the whole dataframe.
+    Data that is already grouped by chromosome and sorted by position within each chromosome, e.g. a GWAS Catalog snapshot, is indexed in place without copying it.
+    A categorical chromosome column, e.g. of a memory-mapped table, is indexed by its codes. Other data is copied and sorted.
+    Args:
+        df (pd.DataFrame): Indexed data
+        chrom_col (str): chromosome column
+        pos_col (str): position column
+    """
+    def __init__(self, df: pd.DataFrame, chrom_col: str, pos_col: str):
+        names = None
+        if df[chrom_col].dtype.name == "category" and not df[chrom_col].isna().any():
+            chroms = df[chrom_col].cat.codes.values
+            names = np.asarray(df[chrom_col].cat.categories.astype(str))
+        else:
+            chroms = df[chrom_col].astype(str).values
+        positions = df[pos_col].values
+        starts = _run_starts(chroms)
+        #sorted if each chromosome is a single run of rows, and the positions decrease only at the start of a run
+        self.sorted = np.unique(chroms[starts]).size == starts.size and np.isin(np.flatnonzero(np.diff(positions) < 0) + 1, starts).all()
+        if self.sorted:
+            self.data = df
+        else:
+            data = df.reset_index(drop=True)
+            data[chrom_col] = data[chrom_col].astype(str)
+            self.data = data.sort_values([chrom_col, pos_col], kind="mergesort")
+            chroms = self.data[chrom_col].values
+            names = None
+            positions = self.data[pos_col].values
+            starts = _run_starts(chroms)
+        self.positions = positions
+        ends = np.r_[starts[1:], chroms.size].astype(int)
+        self.bounds = {(chroms[a] if names is None else names[chroms[a]]):(a,b) for a,b in zip(starts,ends)}
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def query(self, chrom: str, start: int, end: int) -> pd.DataFrame:
+        """Return the rows with start <= position <= end in a chromosome, in the original row order.
+        The rows of data that was indexed in place are a slice of it, without copying.
+        """
+        if str(chrom) not in self.bounds:
+            return self.data.iloc[0:0]
+        lo, hi = self.bounds[str(chrom)]
+        positions = self.positions[lo:hi]
+        a = lo + np.searchsorted(positions, start, side="left")
+        b = lo + np.searchsorted(positions, end, side="right")
+        if self.sorted:
+            return self.data.iloc[a:b]
+        return self.data.iloc[a:b].sort_index()
+
+
 def columns_from_arguments(column_labels):
     """
     Return a dict of columns (used pervasively throughout the script) from the argument column_labels
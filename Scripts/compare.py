@@ -168,13 +168,13 @@ def filter_invalid_alleles(df: pd.DataFrame,columns: Dict[str, str]) -> pd.DataF
     return retval
 
 def compare(df, ld_check, plink_mem, ld_panel_path,
-            prefix, ldstore_threads, ld_threshold,  cache_gwas, columns, 
+            prefix, ldstore_threads, ld_threshold, columns, 
             association_db):
     """
     Compares found significant variants to gwascatalog results and/or supplied summary statistic files
     In: df, ld_check, plink_mem, ld_panel_path,
         prefix, gwascatalog_pval, gwascatalog_pad, gwascatalog_threads,
-        ldstore_threads, ld_threshold, cache_gwas, columns, gwapi, customdataresource
+        ldstore_threads, ld_threshold, columns, gwapi, customdataresource
     Out: A tuple (report_df, ld_df)
         report_df: the dataframe containing all of the variants and their previous associations, as well as annotations
         ld_df (optional): a dataframe containing the LD paired associations of variants
@@ -187,28 +187,22 @@ def compare(df, ld_check, plink_mem, ld_panel_path,
     df_cols=df.columns.to_list()
     if not all(nec_col in df_cols for nec_col in necessary_columns):
         Exception("GWS variant file {} did not contain all of the necessary columns:\n{} ".format(compare_fname,necessary_columns))
-    if os.path.exists("{}gwas_out_mapping.tsv".format(prefix)) and cache_gwas:
-        summary_df = pd.read_csv("{}gwas_out_mapping.tsv".format(prefix),sep="\t")
-    else:
-        range_df = df.loc[:,[columns["chrom"],"pos_rmin","pos_rmax"]].drop_duplicates().copy(deep=True)
-        regions = [
-            Region(a[columns["chrom"]],int(a["pos_rmin"]),int(a["pos_rmax"])) for i,a in range_df.iterrows()
-        ]
-        regions = prune_regions(regions)
-        assoc_records = association_db.associations_for_regions(regions)
-        assoc_df = pd.DataFrame(assoc_records)
-        if not assoc_df.empty:
-            assoc_df=filter_invalid_alleles(assoc_df, {"ref":"ref","alt":"alt"})
-            indel_idx=(assoc_df["ref"]=="-")|(assoc_df["alt"]=="-")
-            indels=solve_indels(assoc_df.loc[indel_idx,:],df,columns)
-            assoc_df=assoc_df.loc[~indel_idx,:]
-            assoc_df=pd.concat([assoc_df,indels],sort=False).reset_index(drop=True)
-            rename_dict={"chrom":columns["chrom"],"pos":columns["pos"],"ref":columns["ref"],"alt":columns["alt"],"pval":columns["pval"]}
-            assoc_df=assoc_df.rename(columns=rename_dict)
-            assoc_df.loc[:,"#variant"]=create_variant_column(assoc_df,chrom=columns["chrom"],pos=columns["pos"],ref=columns["ref"],alt=columns["alt"])
-        summary_df=assoc_df
-        if cache_gwas:
-            summary_df.to_csv("{}gwas_out_mapping.tsv".format(prefix),sep="\t",index=False)
+    range_df = df.loc[:,[columns["chrom"],"pos_rmin","pos_rmax"]].drop_duplicates().copy(deep=True)
+    regions = [
+        Region(a[columns["chrom"]],int(a["pos_rmin"]),int(a["pos_rmax"])) for i,a in range_df.iterrows()
+    ]
+    regions = prune_regions(regions)
+    assoc_df = association_db.associations_for_regions(regions)
+    if not assoc_df.empty:
+        assoc_df=filter_invalid_alleles(assoc_df, {"ref":"ref","alt":"alt"})
+        indel_idx=(assoc_df["ref"]=="-")|(assoc_df["alt"]=="-")
+        indels=solve_indels(assoc_df.loc[indel_idx,:],df,columns)
+        assoc_df=assoc_df.loc[~indel_idx,:]
+        assoc_df=pd.concat([assoc_df,indels],sort=False).reset_index(drop=True)
+        rename_dict={"chrom":columns["chrom"],"pos":columns["pos"],"ref":columns["ref"],"alt":columns["alt"],"pval":columns["pval"]}
+        assoc_df=assoc_df.rename(columns=rename_dict)
+        assoc_df.loc[:,"#variant"]=create_variant_column(assoc_df,chrom=columns["chrom"],pos=columns["pos"],ref=columns["ref"],alt=columns["alt"])
+    summary_df=assoc_df
     if summary_df.empty:
         #just abort, output the top report but no merging summary df cause it doesn't exist
         print("No summary variants, report will be incomplete")
@@ -285,11 +279,16 @@ if __name__ == "__main__":
     parser.add_argument("--gwascatalog-threads",dest="gwascatalog_threads",type=int,default=4,help="Number of concurrent queries to GWAScatalog API. Default 4. Increase if the gwascatalog api takes too long.")
     parser.add_argument("--ldstore-threads",type=int,default=4,help="Number of threads to use with ldstore. Default 4")
     parser.add_argument("--ld-threshold",type=float,default=0.9,help="ld threshold for including ld associations in ld report")
-    parser.add_argument("--cache-gwas",action="store_true",help="save gwascatalog results into gwas_out_mapping.tsv and load them from there if it exists. Use only for testing.")
+    parser.add_argument("--gwascatalog-mirror",dest="gwascatalog_mirror",type=str,default="",help="GWAS Catalog mirror created with gwcatalog.py mirror. With --db gwas, the mirror is used in place of the GWAS Catalog api if it is fresh.")
+    parser.add_argument("--gwascatalog-mirror-max-age",dest="gwascatalog_mirror_max_age",type=float,default=30,help="Largest age of a usable GWAS Catalog mirror in days. 0 for no limit. Default 30")
+    parser.add_argument("--gwascatalog-cache-dir",dest="gwascatalog_cache_dir",type=str,default="",help="Cache GWAS Catalog api results in this directory, and reuse them for the same regions in later runs. Can be shared by several runs.")
+    parser.add_argument("--gwascatalog-cache-ttl",dest="gwascatalog_cache_ttl",type=float,default=30,help="Days after which cached GWAS Catalog results are refreshed. 0 for no limit. Default 30")
+    parser.add_argument("--gwascatalog-cache-max-size",dest="gwascatalog_cache_max_size",type=float,default=0,help="Largest size of the GWAS Catalog cache in MB. The least recently used results are removed first. 0 for no limit. Default 0")
     parser.add_argument("--column-labels",dest="column_labels",metavar=("CHROM","POS","REF","ALT","PVAL"),nargs=5,default=["#chrom","pos","ref","alt","pval","beta","maf","maf_cases","maf_controls"],help="Names for data file columns. Default is '#chrom pos ref alt pval beta maf maf_cases maf_controls'.")
     parser.add_argument("--local-gwascatalog",dest='localdb_path',type=str,help="Path to local GWAS Catalog DB.")
-    parser.add_argument("--db",dest="database_choice",type=str,choices=['local','gwas','summary_stats'],default="gwas",help="Database to use for comparison. use 'local','gwas' or 'summary_stats'.")
-    parser.add_argument("--gwascatalog-allele-file",dest="allele_db_file",help="GWAS Catalog alleles taken from here. Use dbSNP variation VCF file (current gwcat build hg38p13, b153).")
+    parser.add_argument("--db",dest="database_choice",type=str,choices=['local','gwas','summary_stats','sqlite'],default="gwas",help="Database to use for comparison. use 'local','gwas','summary_stats' or 'sqlite'. With 'sqlite', --local-gwascatalog is an SQLite association database created with gwcatalog.py sqlite.")
+    parser.add_argument("--db-timeout",dest="db_timeout",type=float,default=None,help="Time in seconds to wait for each comparison database. The databases are queried concurrently, and the associations of a database that does not answer in time are left out. Default no limit.")
+    parser.add_argument("--gwascatalog-allele-file",dest="allele_db_file",help="GWAS Catalog alleles taken from here. Use dbSNP variation VCF file (current gwcat build hg38p13, b153), or an allele table created from it with gwcatalog.py alleles.")
     args=parser.parse_args()
     columns=columns_from_arguments(args.column_labels)
     if args.prefix!="":
@@ -305,12 +304,18 @@ if __name__ == "__main__":
                                                     args.gwascatalog_pad,
                                                     args.gwascatalog_pval,
                                                     args.gwascatalog_threads,
-                                                    args.allele_db_file)
+                                                    args.allele_db_file,
+                                                    args.gwascatalog_cache_dir,
+                                                    args.gwascatalog_cache_ttl*86400 if args.gwascatalog_cache_ttl else None,
+                                                    args.gwascatalog_cache_max_size*2**20 if args.gwascatalog_cache_max_size else None,
+                                                    args.db_timeout,
+                                                    args.gwascatalog_mirror,
+                                                    args.gwascatalog_mirror_max_age*86400 if args.gwascatalog_mirror_max_age else None)
 
     df=pd.read_csv(args.compare_fname,sep="\t")
     [report_df,ld_out_df] = compare(df, ld_check=args.ld_check,
                                     plink_mem=args.plink_mem, ld_panel_path=args.ld_panel_path, prefix=args.prefix,
-                                    ldstore_threads=args.ldstore_threads, ld_threshold=args.ld_threshold, cache_gwas=args.cache_gwas, columns=columns,
+                                    ldstore_threads=args.ldstore_threads, ld_threshold=args.ld_threshold, columns=columns,
                                     association_db=assoc_db)
     if type(report_df) != type(None):
         report_df.fillna("NA").replace("","NA").to_csv(args.report_out,sep="\t",index=False,float_format="%.3g")
@@ -5,7 +5,36 @@ import gzip
 import pysam
 from typing import List, Dict
 from functools import partial
-from data_access.db import AlleleDB, Location, VariantData, Variant
+import pandas as pd, numpy as np
+from data_access.db import AlleleDB, Location, VariantData, Variant, ALLELE_COLUMNS
+from data_access import columnar_store
+from data_access.gwcatalog_api import read_gwcatalog
+from autoreporting_utils import coalesce_positions, tabix_pool, TABIX_POINT_MAX_GAP
+
+def _vcf_chrom(chrom: pd.Series) -> pd.Series:
+    """Convert chromosome names to the numeric chromosomes of the dbSNP vcf
+    """
+    return chrom.astype(str).str.replace("X","23").str.replace("Y","24").str.replace("MT","25").str.replace("M","25")
+
+def _to_variant_data(data: pd.DataFrame) -> List[VariantData]:
+    """Convert an allele table to a list of VariantData
+    """
+    output = []
+    for r in data.itertuples(index=False):
+        alts = r.alt.split(',')
+        output.append(
+            VariantData(
+                Variant(
+                    r.chrom,
+                    r.pos,
+                    r.ref,
+                    alts[0],
+                ),
+                alts[1:],
+                r.rsid
+            )
+        )
+    return output
 
 #NOTE: Is this used anywhere?
 def _partial_filter(chrom: str, pos: int, cpra: List[str]):
@@ -19,47 +48,146 @@ def remdups(lst):
 class VCFAlleleDB(AlleleDB):
     """Allele db based on vcf file from dbsnp. NOTE: File can be on ftp server, IF the index file exists. 
     E.g. https://ftp.ncbi.nih.gov/snp/organisms/human_9606_b151_GRCh37p13/VCF/00-All.vcf.gz
+    Positions closer than max_gap bp to each other are read with one range query.
+    The vcf is read through the shared tabix handle pool, so the db can be used from several threads.
     """
 
-    def __init__(self, vcf_file):
+    def __init__(self, vcf_file, max_gap: int = TABIX_POINT_MAX_GAP):
         if not os.path.exists(vcf_file):
             raise FileNotFoundError("File {} not found".format(vcf_file))
-        self.handle = None
         try:
-            self.handle = pysam.TabixFile(vcf_file)
+            handle = tabix_pool.handle(vcf_file)
         except:
             print("Error with pysam handle creation:")
             raise
         self.file = vcf_file
-        self.header = self.handle.header[-1].strip('\n').split('\t')
+        self.max_gap = max_gap
+        self.contigs = tabix_pool.contigs(vcf_file)
+        self.header = handle.header[-1].strip('\n').split('\t')
+
+    def get_allele_table(self, positions: pd.DataFrame) -> pd.DataFrame:
+        """Get alleles for chromosomal positions as a table.
+        The positions are sorted and deduplicated, and nearby positions are read with one tabix fetch. Only the first five vcf columns are parsed.
+        Args:
+            positions (pd.DataFrame): Genetic locations, with columns (chrom, pos)
+        Returns:
+            (pd.DataFrame): Variants at those locations, with columns (chrom, pos, ref, alt, rsid), sorted by chromosome and position
+        """
+        #vcf is numeric
+        query = pd.DataFrame({
+            "chrom":_vcf_chrom(positions["chrom"]),
+            "pos":positions["pos"].astype(np.int64)
+        }).drop_duplicates().sort_values(["chrom","pos"])
+        #chromosomes that are not in the vcf have no variants
+        query = query.loc[query["chrom"].isin(self.contigs),:]
+        lines = []
+        for region in coalesce_positions(query["chrom"].values, query["pos"].values, self.max_gap):
+            lines.extend(tabix_pool.fetch(self.file, region.chrom, region.start-1, region.end))
+        if not lines:
+            return pd.DataFrame(columns=ALLELE_COLUMNS).astype({"pos":np.int64, "rsid":np.int64})
+        data = pd.Series(lines).str.split("\t", n=5, expand=True).iloc[:,[0,1,3,4,2]]
+        data.columns = ALLELE_COLUMNS
+        data["pos"] = data["pos"].astype(np.int64)
+        data["rsid"] = pd.to_numeric(data["rsid"].str.replace("rs",""), errors="coerce")
+        data = data.dropna(subset=["rsid"]).astype({"rsid":np.int64})
+        #ranges also return variants between the queried positions, and indels that overlap them
+        data = data.merge(query, how="inner", on=["chrom","pos"])
+        return data.drop_duplicates().sort_values(["chrom","pos"], kind="mergesort").reset_index(drop=True)
+
+    def get_alleles(self, positions: List[Location])-> List[VariantData]:
+        data = self.get_allele_table(pd.DataFrame({
+            "chrom":[a.chromosome for a in positions],
+            "pos":[a.position for a in positions]
+        }))
+        return _to_variant_data(data)
+
+ALLELE_TABLE_CONTENT = "alleles"
+
+def is_allele_table(path: str) -> bool:
+    """Return True if path is an allele table created with create_allele_table
+    """
+    return columnar_store.is_store(path) and columnar_store.read_meta(path).get("content") == ALLELE_TABLE_CONTENT
+
+def create_allele_table(gwcatalog_path: str, vcf_file: str, out_path: str) -> int:
+    """Extract the alleles of GWAS Catalog variants from the dbSNP vcf to a compact allele table.
+    Variants at the positions of GWAS Catalog associations with a GWAS Catalog rsid are included, as only those can be matched to associations.
+    Args:
+        gwcatalog_path (str): GWAS Catalog association file, or a snapshot of it
+        vcf_file (str): Tabixed dbSNP vcf
+        out_path (str): Allele table directory
+    Returns:
+        (int): Number of variants in the table
+    """
+    catalog = read_gwcatalog(gwcatalog_path)
+    rsids = catalog["rsid"].unique()
+    #read one chromosome at a time with short ranges, so that few unneeded vcf lines are held in memory
+    vcf = VCFAlleleDB(vcf_file, max_gap=100)
+    data = [
+        vcf.get_allele_table(chrom_data[["chrom","pos"]])
+        for _, chrom_data in catalog.groupby("chrom")
+    ]
+    data = pd.concat(data + [pd.DataFrame(columns=ALLELE_COLUMNS)], ignore_index=True, sort=False)
+    data = data.loc[data["rsid"].isin(rsids),:].astype({"pos":np.int64, "rsid":np.int64}).reset_index(drop=True)
+    source_hash = columnar_store.read_meta(gwcatalog_path)["source_sha256"] if columnar_store.is_store(gwcatalog_path) else columnar_store.file_sha256(gwcatalog_path)
+    columnar_store.write_table(out_path, data, {
+        "content":ALLELE_TABLE_CONTENT,
+        "vcf":os.path.abspath(vcf_file),
+        "gwcatalog_sha256":source_hash
+    })
+    return data.shape[0]
+
+class TableAlleleDB(AlleleDB):
+    """Allele db based on a compact allele table created with create_allele_table ('gwcatalog.py alleles').
+    The table is memory-mapped, and positions are looked up with a vectorised binary search.
+    """
 
+    def __init__(self, table_path: str):
+        if not is_allele_table(table_path):
+            raise FileNotFoundError("Allele table {} not found".format(table_path))
+        self.file = table_path
+        data, _ = columnar_store.read_table(table_path)
+        self.chrom_codes = {a:i for i,a in enumerate(sorted(data["chrom"].unique()))}
+        keys = self.__keys(data["chrom"], data["pos"])
+        order = np.argsort(keys, kind="mergesort")
+        self.keys = keys[order]
+        #tables are written in order, and are used as they are, so that they stay memory-mapped
+        self.data = data if np.array_equal(order, np.arange(order.size)) else data.iloc[order].reset_index(drop=True)
+
+    def __keys(self, chrom: pd.Series, pos: pd.Series) -> np.ndarray:
+        """Combine chromosome and position to one sortable key, -1 for chromosomes not in the table
+        """
+        codes = chrom.astype(object).map(self.chrom_codes).fillna(-1).values.astype(np.int64)
+        keys = (codes << 32) + pos.values.astype(np.int64)
+        keys[codes < 0] = -1
+        return keys
+
+    def get_allele_table(self, positions: pd.DataFrame) -> pd.DataFrame:
+        """Get alleles for chromosomal positions as a table.
+        Args:
+            positions (pd.DataFrame): Genetic locations, with columns (chrom, pos)
+        Returns:
+            (pd.DataFrame): Variants at those locations, with columns (chrom, pos, ref, alt, rsid), sorted by chromosome and position
+        """
+        query = np.unique(self.__keys(_vcf_chrom(positions["chrom"]), positions["pos"]))
+        query = query[query >= 0]
+        lo = np.searchsorted(self.keys, query, side="left")
+        hi = np.searchsorted(self.keys, query, side="right")
+        counts = hi - lo
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        rows = np.repeat(lo, counts) + offsets
+        out = self.data.iloc[rows].reset_index(drop=True)
+        return out.astype({a:object for a in out.columns if out[a].dtype.name == "category"})
 
     def get_alleles(self, positions: List[Location])-> List[VariantData]:
-        output = []
-        for pos in positions:
-            #vcf is numeric
-            chrom = pos.chromosome.replace("X","23").replace("Y","24").replace("MT","25").replace("M","25")
-            rows = self.handle.fetch(chrom, pos.position-1,pos.position)
-            rows = [a.strip('\n').split('\t') for a in rows]
-            rows = [a for a in rows if int(a[1]) == pos.position]#indels behave weirdly when using tabix
-
-            #get alleles from rows
-            for r in rows:
-                alt = r[4].split(',')[0]
-                other_alts = r[4].split(',')[1:]
-                output.append(
-                    VariantData(
-                        Variant(
-                            r[0],
-                            int(r[1]),
-                            r[3],
-                            alt,
-                        ),
-                        other_alts,
-                        int(r[2].replace('rs',''))
-                    )
-                )
-        return output
-
-    def __del__(self):
-        self.handle.close()
\ No newline at end of file
+        data = self.get_allele_table(pd.DataFrame({
+            "chrom":[a.chromosome for a in positions],
+            "pos":[a.position for a in positions]
+        }))
+        return _to_variant_data(data)
+
+def open_alleledb(path: str) -> AlleleDB:
+    """Open an allele table created with create_allele_table, or a dbSNP vcf
+    """
+    if is_allele_table(path):
+        return TableAlleleDB(path)
+    return VCFAlleleDB(path)
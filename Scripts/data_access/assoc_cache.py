@@ -0,0 +1,236 @@
+"""On-disk cache of association queries.
+Results are keyed by the identity of the backend, i.e. its class, p-value threshold, padding and other parameters, and stored as columnar tables.
+A new set of regions is answered from the cached regions, and only the regions that are not cached are queried from the backend.
+"""
+import os
+import json
+import time
+import uuid
+import shutil
+import fcntl
+import hashlib
+from contextlib import contextmanager
+from typing import List, Dict, Any, Tuple, Optional
+import pandas as pd
+from data_access.db import ExtDB, association_table
+from data_access import columnar_store
+from autoreporting_utils import Region, in_regions
+
+#version of the cached data. Increase when the association table, the table format or the backends change, so that old results are not used.
+CACHE_VERSION = 3
+INDEX_FILE = "index.json"
+LOCK_FILE = "index.lock"
+ENTRY_DIR = "entries"
+
+def cache_key(db: ExtDB) -> str:
+    """Return the cache key of a backend, the sha256 hex digest of its identity and the cache version
+    """
+    identity = {"version":CACHE_VERSION, "db":db.cache_identity()}
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+def subtract_regions(regions: List[Region], covered: List[Region]) -> List[Region]:
+    """Return the parts of regions that are not covered. Both ends of the regions are included.
+    Args:
+        regions (List[Region]): regions
+        covered (List[Region]): covered regions
+    Returns:
+        (List[Region]): Sorted, non-overlapping regions
+    """
+    by_chrom = {}
+    for c in sorted(covered, key=lambda x: x.start):
+        by_chrom.setdefault(str(c.chrom), []).append(c)
+    #union of the regions first, so that overlapping regions are queried once
+    out = []
+    for region in sorted(regions, key=lambda x: (str(x.chrom), x.start)):
+        chrom = str(region.chrom)
+        if out and out[-1].chrom == chrom and region.start <= out[-1].end + 1:
+            out[-1] = Region(chrom, out[-1].start, max(out[-1].end, region.end))
+        else:
+            out.append(Region(chrom, region.start, region.end))
+    missing = []
+    for region in out:
+        start = region.start
+        for c in by_chrom.get(region.chrom, []):
+            if c.end < start:
+                continue
+            if c.start > region.end:
+                break
+            if c.start > start:
+                missing.append(Region(region.chrom, start, c.start - 1))
+            start = max(start, c.end + 1)
+            if start > region.end:
+                break
+        if start <= region.end:
+            missing.append(Region(region.chrom, start, region.end))
+    return missing
+
+def _overlaps(regions: List[Region], others: List[Region]) -> bool:
+    """Return True if any of the regions overlaps any of the other regions
+    """
+    return any(a.chrom == b.chrom and a.start <= b.end and b.start <= a.end for a in regions for b in others)
+
+class CachedDB(ExtDB):
+    """Association database that caches the results of another association database on disk.
+    Each query of the backend is stored as an entry, with the regions it covers. Entries are shared by all processes using the same cache directory,
+    and only used for backends with the same identity, see ExtDB.cache_identity.
+    Entries older than ttl seconds are removed, and least recently used entries are removed when the cache is larger than max_size bytes.
+    The index and the entries are read under a shared lock, and the index is updated under a short exclusive lock, so that processes sharing the cache query it concurrently.
+    Args:
+        db (ExtDB): Backend association database
+        cache_dir (str): Cache directory, created if it does not exist
+        ttl (Optional[float]): Lifetime of an entry in seconds. None for no limit.
+        max_size (Optional[int]): Largest size of the cache in bytes. None for no limit.
+    """
+    def __init__(self, db: ExtDB, cache_dir: str, ttl: Optional[float]=None, max_size: Optional[int]=None):
+        self.db = db
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+        self.key = cache_key(db)
+        self.pad = int(getattr(db, "pad", 0))
+        os.makedirs(os.path.join(cache_dir, ENTRY_DIR), exist_ok=True)
+
+    def cache_identity(self) -> Dict[str,Any]:
+        return self.db.cache_identity()
+
+    @contextmanager
+    def __locked_index(self, exclusive: bool):
+        """Lock the cache index, with a shared lock for reading the index and its entries, or an exclusive lock for updating them
+        """
+        with open(os.path.join(self.cache_dir, LOCK_FILE), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def __read_index(self) -> Dict[str,Any]:
+        path = os.path.join(self.cache_dir, INDEX_FILE)
+        if not os.path.isfile(path):
+            return {}
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except ValueError:
+            print("Association cache index {} is corrupted, the cache is emptied".format(path))
+            return {}
+
+    def __write_index(self, index: Dict[str,Any]):
+        tmp = os.path.join(self.cache_dir, INDEX_FILE + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, os.path.join(self.cache_dir, INDEX_FILE))
+
+    def __remove(self, index: Dict[str,Any], entry_id: str):
+        index.pop(entry_id)
+        shutil.rmtree(os.path.join(self.cache_dir, ENTRY_DIR, entry_id), ignore_errors=True)
+
+    def __expired(self, index: Dict[str,Any], now: float) -> List[str]:
+        """Return the expired entries, and the least recently used entries that do not fit in the cache
+        """
+        expired = []
+        if self.ttl is not None:
+            expired = [a for a, entry in index.items() if now - entry["created"] > self.ttl]
+        if self.max_size is not None:
+            size = sum([entry["size"] for a, entry in index.items() if a not in expired])
+            for entry_id in sorted([a for a in index if a not in expired], key=lambda x: index[x]["last_used"]):
+                if size <= self.max_size:
+                    break
+                size -= index[entry_id]["size"]
+                expired.append(entry_id)
+        return expired
+
+    def __evict(self, index: Dict[str,Any], now: float):
+        """Remove expired entries, and the least recently used entries until the cache is small enough
+        """
+        for entry_id in self.__expired(index, now):
+            self.__remove(index, entry_id)
+
+    def __store(self, regions: List[Region], data: pd.DataFrame) -> Tuple[str, Dict[str,Any]]:
+        """Write query results to a new entry directory, which is added to the index by the caller
+        """
+        entry_id = uuid.uuid4().hex
+        path = os.path.join(self.cache_dir, ENTRY_DIR, entry_id)
+        columnar_store.write_table(path, association_table(data))
+        size = columnar_store.table_size(path)
+        now = time.time()
+        return entry_id, {
+            "key":self.key,
+            "regions":[[a.chrom, int(a.start), int(a.end)] for a in regions],
+            "created":now,
+            "last_used":now,
+            "size":size
+        }
+
+    def associations_for_regions(self, regions: List[Region]) -> pd.DataFrame:
+        """Get associations for a list of Regions, querying the backend only for the regions that are not cached
+        Args:
+            regions(List[Region]): A list of Regions
+        Returns:
+            (pd.DataFrame): Associations for variants in the regions, see db.association_table.
+                Associations from several entries are sorted by chromosome and position, otherwise they are in the order of the backend.
+        """
+        return self.query_regions(regions)[0]
+
+    def query_regions(self, regions: List[Region]) -> Tuple[pd.DataFrame, List[Region]]:
+        """Get associations for a list of Regions, and the regions whose backend query failed, see db.ExtDB.query_regions.
+        The regions whose backend query failed are not cached, so that they are queried again on the next call.
+        """
+        if not regions:
+            return association_table(), []
+        regions = [Region(str(a.chrom), int(a.start), int(a.end)) for a in regions]
+        #entries are read under a shared lock, so that they are not removed while being read, but other processes can read them at the same time
+        sources = []
+        with self.__locked_index(exclusive=False):
+            index = self.__read_index()
+            now = time.time()
+            #entries that are removed on the next update are not used
+            expired = set(self.__expired(index, now))
+            entries = {a:entry for a, entry in index.items() if entry["key"] == self.key and a not in expired}
+            covered = {a:[Region(*r) for r in entry["regions"]] for a, entry in entries.items()}
+            missing = subtract_regions(regions, [r for a in covered.values() for r in a])
+            for entry_id, entry_regions in covered.items():
+                if _overlaps(entry_regions, regions):
+                    data, _ = columnar_store.read_table(os.path.join(self.cache_dir, ENTRY_DIR, entry_id))
+                    sources.append((entry_id, entry_regions, data))
+        new_entry = None
+        failed = []
+        if missing:
+            data, failed = self.db.query_regions(missing)
+            succeeded = [a for a in missing if a not in failed]
+            if succeeded:
+                new_entry = self.__store(succeeded, data)
+            sources.append((new_entry[0] if new_entry is not None else None, missing, data))
+        #the index is updated under a short exclusive lock
+        with self.__locked_index(exclusive=True):
+            index = self.__read_index()
+            now = time.time()
+            for entry_id, _, _ in sources:
+                if entry_id in index:
+                    index[entry_id]["last_used"] = now
+            if new_entry is not None:
+                index[new_entry[0]] = new_entry[1]
+            self.__evict(index, now)
+            self.__write_index(index)
+        return self.__combine(regions, sources), failed
+
+    def __combine(self, regions: List[Region], sources: List[Tuple[str, List[Region], pd.DataFrame]]) -> pd.DataFrame:
+        """Combine the associations of entries to the associations of regions.
+        An entry has all associations in its padded regions, so the rows of an entry in the padded regions of an earlier entry are left out, and other rows are kept as they are.
+        """
+        padded = lambda x: [Region(a.chrom, max(0, a.start - self.pad), a.end + self.pad) for a in x]
+        query_regions = padded(regions)
+        seen = []
+        results = []
+        for _, entry_regions, data in sources:
+            if not data.empty:
+                keep = in_regions(data["chrom"].astype(str), data["pos"], query_regions) & ~in_regions(data["chrom"].astype(str), data["pos"], seen)
+                results.append(association_table(data.loc[keep, :]))
+            seen.extend(padded(entry_regions))
+        results = [a for a in results if not a.empty]
+        if not results:
+            return association_table()
+        if len(results) == 1:
+            return results[0]
+        out = association_table(pd.concat(results, ignore_index=True, sort=False))
+        return out.sort_values(["chrom", "pos"], kind="mergesort").reset_index(drop=True)
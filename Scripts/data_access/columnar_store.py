@@ -0,0 +1,150 @@
+"""Columnar on-disk tables, stored as a directory of numpy arrays that are memory-mapped on load.
+Numeric columns are read as memory-mapped arrays, and other columns as categoricals whose codes are memory-mapped, so that processes reading the same table share its pages.
+The column files are in a data directory named in the metadata. A rewrite writes a new data directory and then switches the metadata to it,
+so the files of a table are never modified while another process has them mapped.
+"""
+import os
+import json
+import uuid
+import shutil
+import hashlib
+from typing import Dict, Any, Tuple, Optional
+import pandas as pd, numpy as np
+
+META_FILE = "meta.json"
+#version of the table format. Increase when the stored columns change, so that old tables are recreated.
+#2: missing values of categorical columns are stored as code -1, and codes have the width pandas uses for the number of categories
+#3: the columns are in a data directory that is replaced, not overwritten, when the table is rewritten
+FORMAT_VERSION = 3
+
+def is_store(path: Any) -> bool:
+    """Return True if path is a columnar table directory
+    """
+    return isinstance(path, str) and os.path.isfile(os.path.join(path, META_FILE))
+
+def is_current(path: Any) -> bool:
+    """Return True if path is a columnar table directory written with the current format version
+    """
+    if not is_store(path):
+        return False
+    with open(os.path.join(path, META_FILE)) as f:
+        return json.load(f).get("format") == FORMAT_VERSION
+
+def _codes_dtype(n_categories: int) -> np.dtype:
+    """Return the dtype pandas uses for the codes of a categorical with n_categories categories, so that the codes are not converted on load
+    """
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_categories < np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+def file_sha256(path: str) -> str:
+    """Return the sha256 hex digest of a file's contents
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _write_meta(path: str, meta: Dict[str, Any]) -> None:
+    """Replace the metadata file of a table atomically
+    """
+    tmp_meta = os.path.join(path, "{}.{}.tmp".format(META_FILE, uuid.uuid4().hex))
+    with open(tmp_meta, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_meta, os.path.join(path, META_FILE))
+
+def write_table(path: str, df: pd.DataFrame, meta: Optional[Dict[str, Any]]=None) -> None:
+    """Write a dataframe as a columnar table directory.
+    Numeric and boolean columns are written as arrays, other columns as categorical codes with their categories in the metadata. Missing values of other columns are written as code -1.
+    The columns are written to a new data directory, and the metadata is switched to it atomically. The data directory of the previous version of the table is then removed,
+    which does not change the pages of processes that have it mapped.
+    Args:
+        path (str): Output directory, created if it does not exist
+        df (pd.DataFrame): Table to write
+        meta (Optional[Dict[str,Any]]): Extra metadata, e.g. the source file hash
+    """
+    os.makedirs(path, exist_ok=True)
+    previous = None
+    if os.path.isfile(os.path.join(path, META_FILE)):
+        with open(os.path.join(path, META_FILE)) as f:
+            previous = json.load(f)
+    data_dir = "data-{}".format(uuid.uuid4().hex)
+    os.makedirs(os.path.join(path, data_dir))
+    columns = []
+    for i, col in enumerate(df.columns):
+        fname = "col{}.npy".format(i)
+        values = df[col]
+        if values.dtype.kind in "biuf":
+            np.save(os.path.join(path, data_dir, fname), values.values)
+            columns.append({"name":col, "file":fname, "kind":"array"})
+        else:
+            codes, categories = pd.factorize(values.astype(str).where(values.notna(), None))
+            np.save(os.path.join(path, data_dir, fname), codes.astype(_codes_dtype(len(categories))))
+            columns.append({"name":col, "file":fname, "kind":"category", "categories":list(categories)})
+    out_meta = dict(meta) if meta else {}
+    out_meta.update({"format":FORMAT_VERSION, "rows":int(df.shape[0]), "columns":columns, "data":data_dir})
+    #write the metadata last, so that an interrupted write is not recognised as a table
+    _write_meta(path, out_meta)
+    if previous is not None:
+        if previous.get("data"):
+            shutil.rmtree(os.path.join(path, previous["data"]), ignore_errors=True)
+        else:
+            #tables of older formats have their columns next to the metadata
+            for col in previous.get("columns", []):
+                if os.path.isfile(os.path.join(path, col["file"])):
+                    os.remove(os.path.join(path, col["file"]))
+
+def read_meta(path: str) -> Dict[str, Any]:
+    """Read the metadata of a columnar table directory
+    """
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    if meta.get("format") != FORMAT_VERSION:
+        raise Exception("Columnar table {} has format {}, expected {}. Recreate it with the current version.".format(path, meta.get("format"), FORMAT_VERSION))
+    return meta
+
+def update_meta(path: str, meta: Dict[str, Any]) -> None:
+    """Update the extra metadata of a columnar table directory, without rewriting the columns
+    """
+    out_meta = read_meta(path)
+    out_meta.update(meta)
+    _write_meta(path, out_meta)
+
+def table_size(path: str) -> int:
+    """Return the size of a columnar table directory in bytes
+    """
+    meta = read_meta(path)
+    data_path = os.path.join(path, meta["data"])
+    return os.path.getsize(os.path.join(path, META_FILE)) + sum([os.path.getsize(os.path.join(data_path, a)) for a in os.listdir(data_path)])
+
+def read_table(path: str) -> Tuple[pd.DataFrame, Dict[str, Any]]:
+    """Read a columnar table directory. The column arrays are memory-mapped copy-on-write, and the dataframe is built without copying them,
+    so that processes reading the same table share its pages. Non-numeric columns are read as categoricals, with missing values as NaN.
+    Selecting rows of the table, e.g. filtering or sorting it, copies the selected rows.
+    Args:
+        path (str): Table directory
+    Returns:
+        (Tuple[pd.DataFrame, Dict[str,Any]]): The table and its metadata
+    """
+    while True:
+        meta = read_meta(path)
+        try:
+            return _read_columns(path, meta), meta
+        except FileNotFoundError:
+            #the table was rewritten after its metadata was read, and the previous data directory was removed
+            if read_meta(path)["data"] == meta["data"]:
+                raise
+
+def _read_columns(path: str, meta: Dict[str, Any]) -> pd.DataFrame:
+    """Memory-map the columns of a table version, see read_table
+    """
+    data = {}
+    for col in meta["columns"]:
+        values = np.load(os.path.join(path, meta["data"], col["file"]), mmap_mode="c")
+        if col["kind"] == "category":
+            #code -1 is a missing value
+            values = pd.Categorical.from_codes(values, categories=col["categories"])
+        data[col["name"]] = values
+    return pd.DataFrame(data, columns=[a["name"] for a in meta["columns"]], index=pd.RangeIndex(meta["rows"]), copy=False)
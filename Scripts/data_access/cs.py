@@ -1,9 +1,17 @@
 import gzip
+import re
 import os.path as path
-from typing import List, Dict
-from collections import defaultdict
-import pandas as pd
+from io import StringIO
+from typing import List, Dict, Tuple, Optional
+from collections.abc import Sequence
+import pandas as pd, numpy as np
 from data_access.db import Variant, CSVariant, CS, CSAccess
+from autoreporting_utils import Region, PositionIndex, coalesce_intervals, tabix_pool, TABIX_MAX_GAP
+
+VARIANT_COLUMNS = ["chrom","pos","ref","alt"]
+LEAD_COLUMNS = ["lead_"+a for a in VARIANT_COLUMNS]
+#regions spanning more bp than this are selected from the whole snp file instead of fetching them from its tabix index, about a tenth of the genome
+TABIX_MAX_SPAN = 300000000
 
 def _v_parser(s:str)->Variant:
     """
@@ -12,6 +20,140 @@ def _v_parser(s:str)->Variant:
     data=s.split(":")
     return Variant(data[0],int(data[1]),data[2],data[3])
 
+def _parse_region(region: str) -> Optional[Region]:
+    """
+    parse a SuSiE region, e.g. chr1:100-200. Returns None if the region can not be parsed.
+    """
+    match = re.match(r"^(?:chr)?([^:]+):(\d+)-(\d+)$", region)
+    if not match:
+        return None
+    return Region(match.group(1), int(match.group(2)), int(match.group(3)))
+
+def _span(regions: List[Region]) -> int:
+    """
+    total length of regions in bp, counting overlapping parts once
+    """
+    union = coalesce_intervals(np.array([_chrom_name(a.chrom) for a in regions]), np.array([a.start for a in regions]), np.array([a.end for a in regions]), 0)
+    return int(sum([a.end - a.start + 1 for a in union]))
+
+def _chrom_name(chrom):
+    """
+    chromosome name without the chr prefix, for a chromosome name or a column of them
+    """
+    if isinstance(chrom, pd.Series):
+        return chrom.astype(str).str.replace(r"^chr", "", regex=True)
+    return re.sub(r"^chr", "", str(chrom))
+
+def _contig(chrom: str, contigs: List[str]) -> Optional[str]:
+    """
+    tabix contig name of a chromosome, with or without the chr prefix. Returns None if the chromosome is not in the contigs.
+    """
+    for name in [_chrom_name(chrom), "chr"+_chrom_name(chrom)]:
+        if name in contigs:
+            return name
+    return None
+
+def _split_variants(v: pd.Series) -> pd.DataFrame:
+    """
+    parse a column of variants in cs summary format to columns chrom, pos, ref, alt
+    """
+    parts = v.str.split(":")
+    data = pd.DataFrame({a:parts.str[i] for (i, a) in enumerate(VARIANT_COLUMNS)}, index=v.index)
+    return data.astype({"pos":np.int64})
+
+class CSView(Sequence):
+    """
+    Lazy list of credible sets on top of columnar credible set data. CS objects are only created when accessed.
+    members:
+        cred: credible sets, one per row, with columns region, cs, bayes, min_r2, size, good_cs, lead_chrom, lead_pos, lead_ref, lead_alt
+        variants: credible set variants, with columns chrom, pos, ref, alt, prob, lead_r2, cs_order, sorted by cs_order. cs_order is the row of the credible set in cred.
+    """
+    def __init__(self, cred: pd.DataFrame, variants: pd.DataFrame):
+        self.cred = cred.reset_index(drop=True)
+        self.variants = variants.reset_index(drop=True)
+        bounds = np.searchsorted(self.variants["cs_order"].values, np.arange(self.cred.shape[0]+1))
+        self._starts = bounds[:-1]
+        self._ends = bounds[1:]
+
+    def __len__(self) -> int:
+        return self.cred.shape[0]
+
+    def _cs(self, i: int) -> CS:
+        c = self.cred.iloc[i]
+        v = self.variants.iloc[self._starts[i]:self._ends[i]]
+        return CS(
+            [CSVariant(Variant(chrom, int(pos), ref, alt), float(prob), float(r2))
+                for (chrom, pos, ref, alt, prob, r2) in zip(v["chrom"], v["pos"], v["ref"], v["alt"], v["prob"], v["lead_r2"])],
+            Variant(c["lead_chrom"], int(c["lead_pos"]), c["lead_ref"], c["lead_alt"]),
+            c["region"],
+            int(c["cs"]),
+            float(c["bayes"]),
+            float(c["min_r2"]),
+            int(c["size"]),
+            bool(c["good_cs"])
+        )
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._cs(a) for a in range(len(self))[i]]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("credible set index out of range")
+        return self._cs(i)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, CSView)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    @staticmethod
+    def variants_in_regions(snp: pd.DataFrame, regions: List[Region]) -> pd.DataFrame:
+        """Return the rows of snp data, with variants in column v, that are in regions
+        """
+        variants = _split_variants(snp["v"])
+        variants["chrom"] = _chrom_name(variants["chrom"])
+        index = PositionIndex(variants, "chrom", "pos")
+        rows = [index.query(_chrom_name(a.chrom), a.start, a.end).index.values for a in regions]
+        return snp.iloc[np.unique(np.concatenate(rows + [np.array([], dtype=np.int64)]))]
+
+    def in_regions(self, regions: List[Region]) -> 'CSView':
+        """Return the credible sets that have at least one variant in regions
+        """
+        variants = self.variants[["chrom","pos","cs_order"]].copy()
+        variants["chrom"] = _chrom_name(variants["chrom"])
+        index = PositionIndex(variants, "chrom", "pos")
+        orders = [index.query(_chrom_name(a.chrom), a.start, a.end)["cs_order"].values for a in regions]
+        keep = np.isin(np.arange(len(self)), np.concatenate(orders + [np.array([], dtype=np.int64)]))
+        new_order = np.cumsum(keep) - 1
+        variants = self.variants.loc[keep[self.variants["cs_order"].values], :].copy()
+        variants["cs_order"] = new_order[variants["cs_order"].values]
+        cred = self.cred.loc[keep, :].copy()
+        cred["cs_order"] = np.arange(cred.shape[0])
+        return CSView(cred, variants)
+
+    def to_df(self, columns: Dict[str,str]) -> pd.DataFrame:
+        """
+        Return the credible set variants as a dataframe, see cs_to_df
+        """
+        cred = self.cred.iloc[self.variants["cs_order"].values].reset_index(drop=True)
+        cs_id = "chr" + cred["lead_chrom"] + "_" + cred["lead_pos"].astype(str) + "_" + cred["lead_ref"] + "_" + cred["lead_alt"] + "_" + cred["cs"].astype(str)
+        return pd.DataFrame({
+            columns["chrom"]:self.variants["chrom"].values,
+            columns["pos"]:self.variants["pos"].values,
+            columns["ref"]:self.variants["ref"].values,
+            columns["alt"]:self.variants["alt"].values,
+            "cs_id":cs_id.values,
+            "cs_region":cred["region"].values,
+            "cs_number":cred["cs"].values,
+            "cs_prob":self.variants["prob"].values,
+            "cs_log10bf":cred["bayes"].values,
+            "cs_min_r2":cred["min_r2"].values,
+            "cs_size":cred["size"].values,
+            "good_cs":cred["good_cs"].values,
+            "r2_to_lead":self.variants["lead_r2"].values
+        }, columns=_cs_df_columns(columns))
+
 class CSFullReader(CSAccess):
     """
     Read credible set data from bgzipped susie outputs
@@ -53,64 +195,98 @@ class CSFullReader(CSAccess):
                 raise Exception(f"Required columns {','.join(missing_cols)} not in credible set cred file: {cred_path}")
         
     
+    def _read_snps(self, lines: Optional[List[str]] = None) -> pd.DataFrame:
+        """Read the credible set variants of the snp file, or of lines of it
+        """
+        source = self.snp_path if lines is None else StringIO("\n".join(lines))
+        snp = pd.read_csv(source, sep="\t", float_precision="round_trip", compression="gzip" if lines is None else None,
+            header=0 if lines is None else None, names=None if lines is None else tabix_pool.header(self.snp_path),
+            usecols=["v","cs_specific_prob","region","cs","lead_r2"],
+            dtype={"v":str,"region":str,"cs":np.int64,"cs_specific_prob":np.float64,"lead_r2":np.float64})
+        #snps that are not part of a credible set have cs -1
+        return snp.loc[snp["cs"] != -1, :].reset_index(drop=True)
+
+    def _read_cred(self) -> pd.DataFrame:
+        """Read the credible sets of the cred file
+        """
+        cred = pd.read_csv(self.cred_path, sep="\t", float_precision="round_trip", compression="gzip",
+            usecols=["cs_log10bf","cs_min_r2","cs","cs_size","region","low_purity"],
+            dtype={"region":str,"cs":np.int64,"cs_size":np.int64,"cs_log10bf":np.float64,"cs_min_r2":np.float64,"low_purity":str})
+        cred = cred.rename(columns={"cs_log10bf":"bayes","cs_min_r2":"min_r2","cs_size":"size"})
+        cred["good_cs"] = cred["low_purity"].str.lower() != "true"
+        return cred
+
+    def _build(self, snp: pd.DataFrame, cred: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Assign credible set variants and lead variants to credible sets, see CSView
+        """
+        #lead variant of each credible set is the first variant with the highest probability
+        lead_idx = snp.groupby(["region","cs"], sort=False)["cs_specific_prob"].idxmax()
+        leads = _split_variants(snp.loc[lead_idx, "v"]).rename(columns=lambda x: "lead_"+x)
+        leads["region"] = snp.loc[lead_idx, "region"].values
+        leads["cs"] = snp.loc[lead_idx, "cs"].values
+        cred = pd.merge(cred, leads, how="left", on=["region","cs"])
+        missing = cred["lead_pos"].isna()
+        if missing.any():
+            reg, n = cred.loc[missing, ["region","cs"]].iloc[0]
+            raise Exception(f"CS with region {reg} and number {n} not found in credible set data!")
+        cred = cred.astype({"lead_pos":np.int64})
+        cred["cs_order"] = np.arange(cred.shape[0])
+        variants = pd.concat([_split_variants(snp["v"]), snp[["region","cs"]]], axis="columns")
+        variants["prob"] = snp["cs_specific_prob"]
+        variants["lead_r2"] = snp["lead_r2"]
+        variants = pd.merge(cred[["region","cs","cs_order"]], variants, how="inner", on=["region","cs"], sort=False)
+        variants = variants.sort_values("cs_order", kind="mergesort")
+        return cred, variants
+
+    def _read(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Read the credible sets and their variants, see CSView
+        """
+        return self._build(self._read_snps(), self._read_cred())
+
+    def _fetch_snps(self, regions: List[Region]) -> pd.DataFrame:
+        """Read the credible set variants in regions from the tabix-indexed snp file
+        """
+        contigs = tabix_pool.contigs(self.snp_path)
+        queries = [(_contig(a.chrom, contigs), a.start, a.end) for a in regions]
+        queries = [a for a in queries if a[0] is not None]
+        lines = []
+        for interval in coalesce_intervals(np.array([a[0] for a in queries]), np.array([a[1] for a in queries]), np.array([a[2] for a in queries]), TABIX_MAX_GAP):
+            lines.extend(tabix_pool.fetch(self.snp_path, interval.chrom, max(0, interval.start-1), interval.end))
+        return self._read_snps(lines)
+
+    def get_cs_in_regions(self, regions: List[Region]) -> List[CS]:
+        """
+        Read the credible sets that have variants in regions from full susie results.
+        If the snp file is tabix-indexed, only the credible sets in the regions are read from it: the variants in the regions give the credible sets, and the SuSiE regions of those credible sets give the rest of their variants.
+        Regions spanning more than TABIX_MAX_SPAN bp in total, e.g. the genome outside of an ignored region, are selected from the whole file, as fetching most of the file line by line is slower than reading it.
+        Returns:
+            (List[CS]): Credible sets in the order of the cred file, as a lazy view of the credible set data
+        """
+        if not path.isfile(self.snp_path + ".tbi") or _span(regions) > TABIX_MAX_SPAN:
+            return CSView(*self._read()).in_regions(regions)
+        snp = CSView.variants_in_regions(self._fetch_snps(regions), regions)
+        keys = snp[["region","cs"]].drop_duplicates()
+        susie_regions = [_parse_region(a) for a in keys["region"].unique()]
+        if None in susie_regions:
+            #SuSiE regions that can not be parsed can not be fetched
+            return CSView(*self._read()).in_regions(regions)
+        snp = pd.merge(self._fetch_snps(susie_regions), keys, how="inner", on=["region","cs"], sort=False)
+        cred = pd.merge(self._read_cred(), keys, how="inner", on=["region","cs"], sort=False)
+        return CSView(*self._build(snp, cred))
+
     def get_cs(self) -> List[CS]:
         """
         Read credible set data from full susie results
+        Returns:
+            (List[CS]): Credible sets in the order of the cred file, as a lazy view of the credible set data
         """
-        #snps, group them using their regions and cs numbers
-        #also find out the lead variant for each of those groups
-        #then, read in the credible sets, and assign those variants and lead vars to those.
-        variants = defaultdict(list)
-        with gzip.open(self.snp_path,"rt") as snp_file:
-            headers = snp_file.readline().strip().split("\t")
-            h_order = {a:i for (i,a) in enumerate(headers)}
-            for dataline in snp_file:
-                data=dataline.split("\t")
-                #if the snp is not part of a credible set, skip it
-                snp_cs = int(data[h_order["cs"]])
-                if snp_cs != -1:
-                    snp = _v_parser(data[h_order["v"]])
-                    snp_prob = float(data[h_order["cs_specific_prob"]])
-                    snp_r2 = float(data[h_order["lead_r2"]])
-                    snp_region = data[h_order["region"]]
-                    variants[(snp_region,snp_cs)].append(CSVariant(
-                        snp,
-                        snp_prob,
-                        snp_r2
-                    ))
-
-        cs = []
-        with gzip.open(self.cred_path,"rt") as cred_file:
-            headers = cred_file.readline().strip().split("\t")
-            h_order = {a:i for (i,a) in enumerate(headers)}
-            for dataline in cred_file:
-                data=dataline.strip().split("\t")
-                reg = data[h_order["region"]]
-                n = int(data[h_order["cs"]])
-                bayes = float(data[h_order["cs_log10bf"]]) 
-                min_r2 = float(data[h_order["cs_min_r2"]])
-                size = int(data[h_order["cs_size"]])
-                low_purity = (data[h_order["low_purity"]].lower() == "true")
-                good_cs = not low_purity
-                try:
-                    cs_vars = variants[(reg,n)]
-                    cs_lead = max(cs_vars, key=lambda x: x.prob)
-                    cs.append(
-                        CS(
-                            cs_vars,
-                            cs_lead.variant,
-                            reg,
-                            n,
-                            bayes,
-                            min_r2,
-                            size, 
-                            good_cs
-                        )
-                    )
-                except:
-                    raise Exception(f"CS with region {reg} and number {n} not found in credible set data!")
-        return cs
+        return CSView(*self._read())
 
+    def get_cs_df(self, columns: Dict[str,str]) -> pd.DataFrame:
+        """
+        Read credible set data from full susie results to a dataframe with one row per credible set variant, see cs_to_df
+        """
+        return self.get_cs().to_df(columns)
 
 
 class CSSummaryReader(CSAccess):
@@ -159,73 +335,69 @@ class CSSummaryReader(CSAccess):
                 missing_cols = [a for a in required_cred_headers if a not in headers]
                 raise Exception(f"Required columns {','.join(missing_cols)} not in credible set cred file: {cred_path}")
 
+    def _read(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Read the credible sets and their variants, see CSView
+        """
+        cred = pd.read_csv(self.cred_path, sep="\t", float_precision="round_trip",
+            usecols=["region","cs","v","cs_specific_prob","cs_log10bf","cs_min_r2","cs_size","good_cs"],
+            dtype={"region":str,"cs":np.int64,"v":str,"cs_specific_prob":np.float64,"cs_log10bf":np.float64,"cs_min_r2":np.float64,"cs_size":np.int64,"good_cs":str})
+        cred = cred.rename(columns={"cs_log10bf":"bayes","cs_min_r2":"min_r2","cs_size":"size"})
+        cred["good_cs"] = cred["good_cs"] != "False"
+        cred = pd.concat([cred, _split_variants(cred["v"]).rename(columns=lambda x: "lead_"+x)], axis="columns")
+        cred["cs_order"] = np.arange(cred.shape[0])
+        snp = pd.read_csv(self.snp_path, sep="\t", float_precision="round_trip",
+            usecols=["region","cs","v","cs_specific_prob"],
+            dtype={"region":str,"cs":np.int64,"v":str,"cs_specific_prob":np.float64})
+        snp = pd.concat([_split_variants(snp["v"]), snp[["v","region","cs","cs_specific_prob"]]], axis="columns")
+        #if a credible set is listed more than once, its variants are placed in the last one
+        assign = cred.drop_duplicates(subset=["region","cs"], keep="last")
+        snp = pd.merge(snp, assign[["region","cs","cs_order"]+LEAD_COLUMNS], how="left", on=["region","cs"], sort=False)
+        missing = snp["cs_order"].isna()
+        if missing.any():
+            snp_v, snp_reg, snp_num = snp.loc[missing, ["v","region","cs"]].iloc[0]
+            raise Exception(f"snp {snp_v} with region {snp_reg} and number {snp_num} could not be placed into a credible set: Credible set was not found!")
+        is_lead = np.all([snp[a].values == snp["lead_"+a].values for a in VARIANT_COLUMNS], axis=0)
+        snp["lead_r2"] = np.where(is_lead, 1.0, np.nan)
+        #if the cs is not good, then it will have no variants. In that case, add the lead variant as the only cs variant
+        bad_leads = cred.loc[~cred["good_cs"], :]
+        bad_leads = pd.DataFrame({
+            **{a:bad_leads["lead_"+a].values for a in VARIANT_COLUMNS},
+            "region":bad_leads["region"].values,
+            "cs":bad_leads["cs"].values,
+            "cs_specific_prob":bad_leads["cs_specific_prob"].values,
+            "lead_r2":1.0,
+            "cs_order":bad_leads["cs_order"].values
+        })
+        variants = pd.concat([bad_leads, snp.drop(columns=["v"]+LEAD_COLUMNS)], ignore_index=True, sort=False)
+        variants = variants.rename(columns={"cs_specific_prob":"prob"}).astype({"cs_order":np.int64})
+        variants = variants.sort_values("cs_order", kind="mergesort")
+        return cred, variants
+
     def get_cs(self) -> List[CS]:
         """
         Read credible set information from cred and snp files
+        Returns:
+            (List[CS]): Credible sets in the order of the cred file, as a lazy view of the credible set data
         """
-        #read credible sets
-        credsets = []
-        with open(self.cred_path,"r") as cred_file:
-            headers = cred_file.readline().strip().split("\t")
-            h_order = {a:i for (i,a) in enumerate(headers)}
-            for dataline in cred_file:
-                data=dataline.strip().split("\t")
-                #if the cs is not good, then it will have no variants. In that case, add the lead variant as the only cs variant
-                if data[h_order["good_cs"]] == "False":
-                    csvars = [
-                        CSVariant(
-                            _v_parser(data[h_order["v"]]),
-                            float(data[h_order["cs_specific_prob"]]),
-                            1.0
-                        )
-                    ]
-                else:
-                    csvars = []
-                if data[h_order["good_cs"]] == "False":
-                    good_cs=False
-                else:
-                    good_cs = True
-                credsets.append(
-                    CS(
-                        csvars,
-                        _v_parser(data[h_order["v"]]),
-                        data[h_order["region"]],
-                        int(data[h_order["cs"]]),
-                        float(data[h_order["cs_log10bf"]]),
-                        float(data[h_order["cs_min_r2"]]),
-                        int(data[h_order["cs_size"]]),
-                        good_cs
-                    )
-                )
-        # create credible set group dictionary
-        cred_set_assign = {(a.region,a.number):i for i,a in enumerate(credsets)} 
-        # read snp data
-        with open(self.snp_path, "r") as snp_file:
-            headers = snp_file.readline().strip().split("\t")
-            h_order = {a:i for (i,a) in enumerate(headers)}
-            for dataline in snp_file:
-                data = dataline.strip().split("\t")
-
-                snp_v = _v_parser(data[h_order["v"]])
-                snp_reg = data[h_order["region"]]
-                snp_num = int(data[h_order["cs"]])
-                snp_prob = float(data[h_order["cs_specific_prob"]])
-                snp_r2 = float("nan")
-                if snp_v == credsets[cred_set_assign[(snp_reg,snp_num)]].lead:
-                    snp_r2 = 1.0
-                snp = CSVariant(snp_v,snp_prob,snp_r2)
-                #assign to correct credible set
-                try:
-                    credsets[cred_set_assign[(snp_reg,snp_num)]].variants.append(snp)
-                except:
-                    raise Exception(f"snp {snp} with region {snp_reg} and number {snp_num} could not be placed into a credible set: Credible set was not found!")
-        return credsets
+        return CSView(*self._read())
 
+    def get_cs_in_regions(self, regions: List[Region]) -> List[CS]:
+        """
+        Read the credible sets that have variants in regions from cred and snp files
+        Returns:
+            (List[CS]): Credible sets in the order of the cred file, as a lazy view of the credible set data
+        """
+        return self.get_cs().in_regions(regions)
 
-def cs_to_df(cs:List[CS],columns: Dict[str,str])->pd.DataFrame():
-    """Kludge to convert from list of CS to a dataframe containing the same information.
-    """
-    output_columns = [
+    def get_cs_df(self, columns: Dict[str,str]) -> pd.DataFrame:
+        """
+        Read credible set information from cred and snp files to a dataframe with one row per credible set variant, see cs_to_df
+        """
+        return self.get_cs().to_df(columns)
+
+
+def _cs_df_columns(columns: Dict[str,str]) -> List[str]:
+    return [
         columns["chrom"],
         columns["pos"],
         columns["ref"],
@@ -240,24 +412,25 @@ def cs_to_df(cs:List[CS],columns: Dict[str,str])->pd.DataFrame():
         "good_cs",
         "r2_to_lead"
     ]
-    out = pd.DataFrame(columns=output_columns)
-    for c in cs:
-        var_data = [ [
-            a.variant.chrom,
-            a.variant.pos,
-            a.variant.ref,
-            a.variant.alt,
-            f"chr{c.lead.chrom}_{c.lead.pos}_{c.lead.ref}_{c.lead.alt}_{c.number}",
-            c.region,
-            c.number,
-            a.prob,
-            c.bayes,
-            c.min_r2,
-            c.size,
-            c.good_cs,
-            a.lead_r2
-        ] for a in c.variants]
-        data = pd.DataFrame(var_data,columns=output_columns)
-        out = pd.concat([out,data],join="inner",ignore_index=True)
-    return out
 
+def cs_to_df(cs:List[CS],columns: Dict[str,str])->pd.DataFrame():
+    """Convert from list of CS to a dataframe containing the same information, one row per credible set variant.
+    """
+    if isinstance(cs, CSView):
+        return cs.to_df(columns)
+    var_data = [ [
+        a.variant.chrom,
+        a.variant.pos,
+        a.variant.ref,
+        a.variant.alt,
+        f"chr{c.lead.chrom}_{c.lead.pos}_{c.lead.ref}_{c.lead.alt}_{c.number}",
+        c.region,
+        c.number,
+        a.prob,
+        c.bayes,
+        c.min_r2,
+        c.size,
+        c.good_cs,
+        a.lead_r2
+    ] for c in cs for a in c.variants]
+    return pd.DataFrame(var_data,columns=_cs_df_columns(columns))
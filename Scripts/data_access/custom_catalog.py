@@ -1,48 +1,51 @@
 import abc
 from typing import List, Text, Dict,Any
 import pandas as pd, numpy as np
-from data_access.db import ExtDB
-from autoreporting_utils import Region
+from data_access.db import ExtDB, association_table
+from autoreporting_utils import Region, PositionIndex
+
+def load_custom_catalog(fname: str) -> pd.DataFrame:
+    """Read a custom association file with at least the columns (chrom, pos, ref, alt, pval, beta, trait), and set the column types.
+    Associations without a position, alleles or a p-value are dropped. As the custom data resource only has a trait defined, the trait is also used as the trait name.
+    Args:
+        fname (str): Custom association file
+    Returns:
+        (pd.DataFrame): Associations, with study_doi renamed to study_link
+    """
+    data = pd.read_csv(fname,sep="\t",na_values="NA")
+    #fix the following column types: pval, beta as float, pos as int, chrom as str
+    data["pval"] = pd.to_numeric(data["pval"],errors="coerce")
+    data["beta"] = pd.to_numeric(data["beta"],errors="coerce")
+    data["pos"] = pd.to_numeric(data["pos"],errors="coerce") 
+    data = data.astype({"chrom":"str"})
+    data=data.dropna(axis="index",subset=["chrom","pos","ref","alt","pval"]).copy()
+    data["trait_name"] = data["trait"]
+    return data.rename(columns={"study_doi":"study_link"})
 
 class CustomCatalog(ExtDB):
     def __init__(self, fname: str, pval_threshold: float, padding: int):
         self.fname = fname
         self.pval_threshold = float(pval_threshold)
         self.pad = int(padding)
-        self.data = pd.read_csv(fname,sep="\t",na_values="NA")
-        #load data into dataframe
-        #fix the following column types: pval, beta as float, pos as int, chrom as str
-        self.data["pval"] = pd.to_numeric(self.data["pval"],errors="coerce")
-        self.data["beta"] = pd.to_numeric(self.data["beta"],errors="coerce")
-        self.data["pos"] = pd.to_numeric(self.data["pos"],errors="coerce") 
-        self.data = self.data.astype({"chrom":"str"})
-        self.data=self.data.dropna(axis="index",subset=["chrom","pos","ref","alt","pval"])
+        self.data = load_custom_catalog(fname)
+        #filter by pval once, and index the associations by position
+        self.data=self.data.loc[self.data["pval"]<=self.pval_threshold,:]
+        self.index = PositionIndex(self.data,"chrom","pos")
 
-    def __get_associations(self,chromosome: str,start: int,end: int)-> List[Dict[str,Any]]:
+    def __get_associations(self,chromosome: str,start: int,end: int)-> pd.DataFrame:
         start=max(0,int(start)-self.pad)
         end=int(end)+self.pad
-        #filter by chromosome, pos, pval
-        tmpdata=self.data.loc[self.data["chrom"] == chromosome,:]
-        tmpdata=tmpdata.loc[(tmpdata["pos"]>= start) &(tmpdata["pos"]<= end),: ]
-        tmpdata=tmpdata.loc[tmpdata["pval"]<=self.pval_threshold,:]
-        tmpdata["trait_name"] = tmpdata["trait"].apply(lambda x: self.__get_trait(x))
-        rename_d = {"study_doi":"study_link"}
-        return tmpdata.rename(columns=rename_d).to_dict("records")
-        #return results
+        return self.index.query(chromosome,start,end)
 
-    def __get_trait(self, trait_code: str) -> str:
-        """Return trait name
-        Return trait code as name as the custom data resource only has a trait defined, no trait code
-        """
-        return trait_code
-    
-    def associations_for_regions(self, regions: List[Region]) -> List[Dict[str, Any]]:
+    def associations_for_regions(self, regions: List[Region]) -> pd.DataFrame:
         """Return associations for a list of regions of type {"chrom": str, "min": int, "max": int }
         Args:
             regions (List[Dict[str, Any]]): The list of regions for which associations are queried
+        Returns:
+            (pd.DataFrame): Associations for variants in the regions, see db.association_table
         """
-        out= []
-        for region in regions:
-            assocs=self.__get_associations(region.chrom,region.start,region.end)
-            out.extend(assocs)
-        return out
\ No newline at end of file
+        out = [self.__get_associations(region.chrom,region.start,region.end) for region in regions]
+        out = [a for a in out if not a.empty]
+        if not out:
+            return association_table()
+        return association_table(pd.concat(out,ignore_index=True,sort=False))
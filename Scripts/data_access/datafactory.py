@@ -3,42 +3,121 @@
 #create Factory that contains all databases, so they can be queried without caring about their implementations
 
 #How about just an object that has e.g. a dict for those
-from typing import List, Dict, Any
-from data_access.db import ExtDB
-from data_access import custom_catalog, gwcatalog_api, alleledb
+import time
+import threading
+from typing import List, Dict, Any, Optional
+from data_access.db import ExtDB, association_table
+import pandas as pd
+from data_access import custom_catalog, gwcatalog_api, alleledb, sqlite_catalog, assoc_cache
 from autoreporting_utils import *
 
-#TODO: change into ExtDB because it kinda already is
+class _Query(object):
+    """Association query of one database, running in a daemon thread, so that a query that is not waited for does not keep the process alive.
+    Args:
+        name (str): Name of the query thread
+        db (ExtDB): Database
+        regions (List[Region]): Queried regions
+    """
+    def __init__(self, name: str, db: ExtDB, regions: List[Region]):
+        self.start = time.monotonic()
+        self.out = None
+        self.error = None
+        self.latency = None
+        self.thread = threading.Thread(target=self.__run, args=(db, regions), name=name, daemon=True)
+        self.thread.start()
+
+    def __run(self, db: ExtDB, regions: List[Region]):
+        try:
+            self.out = db.associations_for_regions(regions)
+        except Exception as e:
+            self.error = e
+        self.latency = time.monotonic() - self.start
+
+    def wait(self, timeout: Optional[float]) -> bool:
+        """Wait until the query is done, but at most until timeout seconds from the start of the query
+        Returns:
+            (bool): True if the query is done
+        """
+        self.thread.join(max(0, self.start + timeout - time.monotonic()) if timeout is not None else None)
+        return not self.thread.is_alive()
+
+    def result(self) -> pd.DataFrame:
+        """Return the associations of a finished query, or raise the exception of the query
+        """
+        if self.error is not None:
+            raise self.error
+        return self.out
+
 class CompoundDB(ExtDB):
-    def __init__(self, conf: List[ExtDB]):
+    """Association database combining several databases.
+    The databases are queried concurrently, each in its own thread, and their results are concatenated in the order of the databases.
+    The query time of each database is printed and stored in latencies.
+    Args:
+        conf (List[ExtDB]): Databases
+        timeout (Optional[float]): Time in seconds to wait for each database, from the start of its query. The results of a database that does not finish in time are left out,
+            and its query is abandoned in a daemon thread. None for no limit.
+    """
+    def __init__(self, conf: List[ExtDB], timeout: Optional[float]=None):
         self.db=[]
         for db in conf:
             self.db.append(db)
-        self.__get_trait=None
-        self.__get_associations=None
+        self.timeout = timeout
+        self.latencies = {}
 
-    def associations_for_regions(self, regions: List[Dict[str, Any]] ) -> List[Dict[str, Any]]:
-        #for every database, query the regions and append the results
+    def associations_for_regions(self, regions: List[Region] ) -> pd.DataFrame:
+        if not self.db:
+            return association_table()
+        names = ["{}:{}".format(i, type(db).__name__) for i, db in enumerate(self.db)]
+        queries = [_Query("CompoundDB-{}".format(name), db, regions) for name, db in zip(names, self.db)]
         results = []
-        for db in self.db:
-            results.extend( db.associations_for_regions( regions ) )
-        return results
+        for name, query in zip(names, queries):
+            if not query.wait(self.timeout):
+                print("Association database {} did not answer in {} s, its associations are left out".format(name, self.timeout))
+                self.latencies[name] = None
+                continue
+            out = query.result()
+            print("Association database {}: {} associations in {:.2f} s".format(name, out.shape[0], query.latency))
+            self.latencies[name] = query.latency
+            results.append(out)
+        results = [a for a in results if not a.empty]
+        if not results:
+            return association_table()
+        return association_table(pd.concat(results,ignore_index=True,sort=False))
+
+    def cache_identity(self) -> Dict[str,Any]:
+        return {"backend":"CompoundDB", "databases":[db.cache_identity() for db in self.db]}
 
-def db_factory(use_gwascatalog, custom_dataresource, database_choice, localdb_path, gwas_width, gwas_pval ,gwas_threads, allele_filepath) -> ExtDB:
+def db_factory(use_gwascatalog, custom_dataresource, database_choice, localdb_path, gwas_width, gwas_pval ,gwas_threads, allele_filepath, cache_dir="", cache_ttl=None, cache_max_size=None, timeout=None, mirror_path="", mirror_max_age=None) -> ExtDB:
+    """Create the association database for comparison.
+    If cache_dir is given, the results of the online GWAS Catalog api are cached there, see assoc_cache.CachedDB. cache_ttl is in seconds and cache_max_size in bytes.
+    The databases are queried concurrently, and each is waited for at most timeout seconds, see CompoundDB.
+    With the online GWAS Catalog api, a mirror created with 'gwcatalog.py mirror' is used in its place if the mirror is at most mirror_max_age seconds old.
+    """
     gwapi=None
     customresource=None
     if use_gwascatalog:
         #alleledb
-        allele_database = alleledb.VCFAlleleDB(allele_filepath)
+        allele_database = alleledb.open_alleledb(allele_filepath)
         if database_choice=="local":
             gwapi=gwcatalog_api.LocalDB(localdb_path,gwas_pval,gwas_width,allele_database)
+        elif database_choice=="sqlite":
+            gwapi=sqlite_catalog.SQLiteDB(localdb_path,gwas_pval,gwas_width,allele_database)
         elif database_choice=="summary_stats":
             raise Exception("gwcatalog choice summary_stats DEPRECATED")
             gwapi=gwcatalog_api.SummaryApi(gwas_pval, gwas_width,gwas_threads)
         else:
-            gwapi=gwcatalog_api.GwasApi(gwas_pval, gwas_width,gwas_threads,allele_database)
+            age = gwcatalog_api.mirror_age(mirror_path) if mirror_path else None
+            if age is not None and (mirror_max_age is None or age <= mirror_max_age):
+                print("Using GWAS Catalog mirror {}, exported {:.1f} days ago".format(mirror_path, age/86400))
+                gwapi=gwcatalog_api.LocalDB(mirror_path,gwas_pval,gwas_width,allele_database)
+            else:
+                if mirror_path:
+                    print("GWAS Catalog mirror {} is missing or too old, using the GWAS Catalog api".format(mirror_path))
+                gwapi=gwcatalog_api.GwasApi(gwas_pval, gwas_width,gwas_threads,allele_database)
+                if cache_dir:
+                    gwapi=assoc_cache.CachedDB(gwapi,cache_dir,cache_ttl,cache_max_size)
     if custom_dataresource != "":
         customresource = custom_catalog.CustomCatalog(custom_dataresource,gwas_pval,gwas_width)
     dataresources = [a for a in [gwapi, customresource] if a != None]
-    datadb = CompoundDB(dataresources)
+    datadb = CompoundDB(dataresources, timeout)
     return datadb
\ No newline at end of file
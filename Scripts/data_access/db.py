@@ -2,22 +2,67 @@
 
 ## File that contains abstract classes for different DAOs
 import abc
-from typing import List, Text, Dict,Any, Optional, NamedTuple
+from typing import List, Text, Dict,Any, Optional, NamedTuple, Tuple
 from io import StringIO
 import pandas as pd #type: ignore
+import numpy as np #type: ignore
 from autoreporting_utils import Region
 
+#columns of the association tables returned by ExtDB implementations
+ASSOCIATION_COLUMNS = ["chrom","pos","ref","alt","rsid","pval","pval_mlog","beta","se","trait","trait_name","study","study_link"]
+
+def association_table(data: Optional[pd.DataFrame]=None) -> pd.DataFrame:
+    """Return associations with the ExtDB column schema, i.e. the columns ASSOCIATION_COLUMNS in that order.
+    Columns missing from the data are filled with NaN, and other columns are dropped. Categorical columns, e.g. from a columnar snapshot, are converted to object columns.
+    Args:
+        data (Optional[pd.DataFrame]): Associations, or None for an empty table
+    Returns:
+        (pd.DataFrame): Association table with columns (chrom, pos, ref, alt, rsid, pval, pval_mlog, beta, se, trait, trait_name, study, study_link)
+    """
+    if data is None or data.empty:
+        return pd.DataFrame(columns=ASSOCIATION_COLUMNS)
+    out = data.reindex(columns=ASSOCIATION_COLUMNS).reset_index(drop=True)
+    out["chrom"] = out["chrom"].astype(str)
+    out["pos"] = out["pos"].astype(np.int64)
+    for col in out.columns:
+        if out[col].dtype.name == "category":
+            out[col] = out[col].astype(object)
+    for col in ("pval","pval_mlog","beta","se"):
+        out[col] = pd.to_numeric(out[col],errors="coerce")
+    return out
+
 class ExtDB(object):
     """Abstract base class for association searches
     """
 
     @abc.abstractmethod
-    def associations_for_regions(self, regions: List[Region]) -> List[Dict[str, Any]]:
+    def associations_for_regions(self, regions: List[Region]) -> pd.DataFrame:
         """Return associations for a list of regions
         Args:
             regions (List[Region]): The list of regions for which associations are queried
+        Returns:
+            (pd.DataFrame): Associations with the columns in ASSOCIATION_COLUMNS, see association_table
         """
 
+    def query_regions(self, regions: List[Region]) -> Tuple[pd.DataFrame, List[Region]]:
+        """Return associations for a list of regions, and the regions whose associations could not be queried.
+        Implementations that leave out the results of failed queries, e.g. after network errors, should override this, so that callers like assoc_cache.CachedDB can tell failed queries from empty results.
+        By default, no query fails.
+        Args:
+            regions (List[Region]): The list of regions for which associations are queried
+        Returns:
+            (Tuple[pd.DataFrame, List[Region]]): Associations, see associations_for_regions, and the regions of regions whose associations are missing from them
+        """
+        return self.associations_for_regions(regions), []
+
+    def cache_identity(self) -> Dict[str,Any]:
+        """Return the parameters that determine the associations returned for a region. Cached results are keyed by them, see assoc_cache.CachedDB.
+        Implementations whose results depend on other parameters, e.g. a server url, should extend this.
+        Returns:
+            (Dict[str,Any]): JSON-serialisable parameters
+        """
+        return {"backend":type(self).__name__, "pval_threshold":getattr(self,"pval_threshold",None), "padding":getattr(self,"pad",None)}
+
 class Variant(NamedTuple):
     """Variant class
         chrom: str
@@ -57,6 +102,56 @@ class LDData(NamedTuple):
             "r2":self.r2
         }
 
+LD_COLUMNS = ["chrom1","pos1","ref1","alt1","chrom2","pos2","ref2","alt2","r2"]
+
+class LDTable(object):
+    """Columnar LD result, with one row per variant pair.
+    The data is in a DataFrame with the columns chrom1,pos1,ref1,alt1,chrom2,pos2,ref2,alt2,r2.
+    Positions are integers, r2 is float and chromosomes and alleles are categoricals.
+    """
+    def __init__(self, df: pd.DataFrame):
+        df = df[LD_COLUMNS].reset_index(drop=True)
+        self.df = df.astype({
+            "chrom1":"category","ref1":"category","alt1":"category",
+            "chrom2":"category","ref2":"category","alt2":"category",
+            "pos1":np.int64,"pos2":np.int64,"r2":np.float64
+        })
+
+    @classmethod
+    def from_ld_data(cls, ld_data: List[LDData]) -> "LDTable":
+        """Create LDTable from a list of LDData
+        """
+        return cls(pd.DataFrame([a.to_flat() for a in ld_data], columns=LD_COLUMNS))
+
+    @classmethod
+    def self_ld(cls, variant: Variant) -> "LDTable":
+        """LDTable containing only the variant in perfect LD with itself
+        """
+        return cls.from_ld_data([LDData(variant, variant, 1.0)])
+
+    def to_ld_data(self) -> List[LDData]:
+        """Convert to a list of LDData
+        """
+        return [
+            LDData(Variant(str(t[0]), int(t[1]), str(t[2]), str(t[3])), Variant(str(t[4]), int(t[5]), str(t[6]), str(t[7])), float(t[8]))
+            for t in self.df.itertuples(index=False, name=None)
+        ]
+
+    def variant_ids(self, n: int) -> pd.Series:
+        """Variant ids in chr{chrom}_{pos}_{ref}_{alt} format for either the first (n=1) or second (n=2) variant of the pairs
+        """
+        if n not in (1, 2):
+            raise ValueError("LDTable has variants 1 and 2, got {}".format(n))
+        return ("chr" + self.df["chrom{}".format(n)].astype(str) + "_" + self.df["pos{}".format(n)].astype(str) +
+            "_" + self.df["ref{}".format(n)].astype(str) + "_" + self.df["alt{}".format(n)].astype(str)).rename(None)
+
+    def __len__(self) -> int:
+        return self.df.shape[0]
+
+    @property
+    def empty(self) -> bool:
+        return self.df.empty
+
 class LDAccess(object):
     """
     Abstract object for getting LD
@@ -74,6 +169,48 @@ class LDAccess(object):
         """
         return
 
+    def get_ranges(self, variants: List[Variant], bp_range: int, ld_threshold: Optional[float]=None) -> List[List[LDData]]:
+        """Return LD for several variant ranges
+        Implementations that can compute several ranges concurrently should override this. By default, the ranges are computed one by one.
+        Args:
+            variants (List[Variant]): Variants for which to get the LD neighbourhoods
+            bp_range (int): LD calculation range.
+            ld_threshold (Optional[float]): Optional LD R^2 threshold.
+        Returns:
+            (List[List[LDData]]): LD data for each of the variants, in the same order as variants
+        """
+        return [self.get_range(v, bp_range, ld_threshold) for v in variants]
+
+    def get_range_table(self, variant: Variant, bp_range: int, ld_threshold: Optional[float]=None) -> LDTable:
+        """Return LD for single variant range as an LDTable
+        Implementations that produce columnar data should override this. By default, the result of get_range is converted.
+        Args:
+            variant (Variant): Variant for which to get the LD neighbourhood
+            bp_range (int): LD calculation range.
+            ld_threshold (Optional[float]): Optional LD R^2 threshold.
+        Returns:
+            (LDTable): LD data for the variant
+        """
+        return LDTable.from_ld_data(self.get_range(variant, bp_range, ld_threshold))
+
+    def get_range_tables(self, variants: List[Variant], bp_range: int, ld_threshold: Optional[float]=None) -> List[LDTable]:
+        """Return LD for several variant ranges as LDTables
+        By default, the result of get_ranges is converted.
+        Returns:
+            (List[LDTable]): LD data for each of the variants, in the same order as variants
+        """
+        return [LDTable.from_ld_data(a) for a in self.get_ranges(variants, bp_range, ld_threshold)]
+
+    def partition(self, n: int) -> "LDAccess":
+        """Return an LD backend for one of n worker processes that use LD concurrently
+        Implementations with limited resources, e.g. memory, should override this to give each worker its share. By default, the backend itself is returned.
+        The returned backend is pickled to the worker processes.
+        """
+        return self
+
+    #number of upcoming lead variants whose LD the grouping can fetch concurrently. Implementations that support concurrent calls of get_range_table should set this.
+    prefetch_depth = 0
+
 class Location(NamedTuple):
     """Chromosomal position
     """
@@ -100,6 +237,9 @@ class VariantData(NamedTuple):
     def biallelic(self) -> bool:
         return len(self.other_alts) == 0
 
+#columns of the allele tables returned by AlleleDB.get_allele_table
+ALLELE_COLUMNS = ["chrom","pos","ref","alt","rsid"]
+
 class AlleleDB(object):
     """
     Abstract object for getting alleles for c:p
@@ -114,6 +254,20 @@ class AlleleDB(object):
         """
         return
 
+    def get_allele_table(self, positions: pd.DataFrame) -> pd.DataFrame:
+        """Get alleles for chromosomal positions as a table. By default, this is an adapter over get_alleles.
+        Args:
+            positions (pd.DataFrame): Genetic locations, with columns (chrom, pos)
+        Returns:
+            (pd.DataFrame): Variants at those locations, with columns (chrom, pos, ref, alt, rsid). Alternate alleles of multiallelic variants are comma-separated.
+        """
+        locations = [Location(a, int(b)) for (a, b) in zip(positions["chrom"], positions["pos"])]
+        data = [
+            (a.variant.chrom, a.variant.pos, a.variant.ref, ",".join([a.variant.alt]+a.other_alts), a.rsid)
+            for a in self.get_alleles(locations)
+        ]
+        return pd.DataFrame(data, columns=ALLELE_COLUMNS).astype({"pos":np.int64, "rsid":np.int64})
+
 class CSVariant(NamedTuple):
     variant:Variant
     prob: float
@@ -139,4 +293,24 @@ class CSAccess(object):
         Returns:
             (List[CS]): List of credible sets. Each credible set contains variants.
         """
+        return
+
+    @abc.abstractmethod
+    def get_cs_in_regions(self, regions: List[Region])->List[CS]:
+        """Returns the credible sets that have at least one variant in regions
+        Args:
+            regions (List[Region]): Regions
+        Returns:
+            (List[CS]): List of credible sets. Each credible set contains all of its variants, also those outside the regions.
+        """
+        return
+
+    @abc.abstractmethod
+    def get_cs_df(self, columns: Dict[str,str])->pd.DataFrame:
+        """Returns all credible set variants from a datasource as a dataframe
+        Args:
+            columns (Dict[str,str]): Column names for chrom, pos, ref and alt
+        Returns:
+            (pd.DataFrame): One row per credible set variant, with columns chrom, pos, ref, alt, cs_id, cs_region, cs_number, cs_prob, cs_log10bf, cs_min_r2, cs_size, good_cs, r2_to_lead
+        """
         return
\ No newline at end of file
@@ -1,50 +1,42 @@
 import json, requests
 import time
 import abc
+import asyncio
 import os
-from typing import List, Text, Dict, Any, Optional, NamedTuple
+import shutil
+import zipfile
+from typing import List, Text, Dict, Any, Optional, NamedTuple, Tuple
 from io import StringIO
+from email.utils import parsedate_to_datetime
 from itertools import groupby
 import pandas as pd, numpy as np
-from data_access.db import ExtDB, AlleleDB, Location, VariantData, Variant, Rsid, RsidVar
-from autoreporting_utils import Region
-from multiprocessing.dummy import Pool as ThreadPool
+from data_access.db import ExtDB, AlleleDB, Location, VariantData, Variant, Rsid, RsidVar, association_table
+from data_access import columnar_store
+from data_access import http_client
+from data_access.http_client import RequestError, ResourceNotFound, ResponseFailure
+from autoreporting_utils import Region, PositionIndex, in_regions, plan_region_queries
 
-class RequestError(Exception):
-    """
-    Unrecoverable error baseclass for try_request errors
-    """
-    pass
-
-class ResourceNotFound(RequestError):
-    """
-    Value does not exist in database or it was not found for some other reason
-    """
-    def __init__(self,parameters=None):
-        super(RequestError,self).__init__()
-        self.parameters=parameters
-    pass
-
-class ResponseFailure(RequestError):
-    """
-    The request aborted due to some error
-    """
-    def __init__(self,parameters=None):
-        super(RequestError,self).__init__()
-        self.parameters=parameters
+#version of the snapshot contents. Increase when the prepared associations change, so that old snapshots are recreated.
+#2: the associations are sorted by chromosome and position
+SNAPSHOT_VERSION = 2
 
 class SummaryApi(ExtDB):
     """ 
     Gwas Catalog summary statistic API
+    Args:
+        pval_threshold (float): p-value threshold for associations
+        padding (int): Padding added to both sides of queried regions, in bp
+        threads (int): Maximum number of regions queried at the same time
+        client (Optional[http_client.HttpClient]): HTTP client. Default is the shared client of the process.
     """
-    def __init__(self, pval_threshold, padding, threads):
-        self.__get_trait=get_trait_name
+    def __init__(self, pval_threshold, padding, threads, client=None):
         self.pval_threshold = float(pval_threshold)
         self.pad = int(padding)
         self.threads = threads
         self.result_size=100
+        self.client = client
 
-    def __get_associations(self,chromosome,start,end):
+    async def __get_associations(self,client,chromosome,start,end):
         pval=self.pval_threshold
         start=max(0,int(start)-self.pad)
         end=int(end)+self.pad
@@ -56,7 +48,7 @@ class SummaryApi(ExtDB):
         payload={"p_upper":pval,"p_lower":p_lower,
             "reveal":"all","bp_lower":start,"bp_upper":end,"start":0,"size":size}
         try:
-            r=try_request("GET",url,params=payload)
+            r=await client.arequest("GET",url,params=payload)
         except ResourceNotFound:
             print("No variants found in {}:{}-{}".format(chromosome,start,end))
             return []
@@ -68,47 +60,42 @@ class SummaryApi(ExtDB):
         if "_links" not in dump.keys():
             return []
         dumplst.append(dump["_embedded"]["associations"])
-        i=1
         while "next" in dump["_links"].keys():
+            payload["start"]+=size
             try:
-                r=try_request("GET",url,params=payload)
+                r=await client.arequest("GET",url,params=payload)
             except ResourceNotFound:
                 print("No variants found in {}:{}-{}".format(chromosome,start,end))
                 return []
             except ResponseFailure:
                 print("Request failure for {}:{}-{}".format(chromosome,start,end))
                 return []
-            if type(r) == type(None):
-                break
             dump=r.json()
             dumplst.append(dump["_embedded"]["associations"])
             if "_links" not in dump.keys():
                 break
-            i+=1
         retval_=parse_output(dumplst)
         retval=[]
         for record in retval_:
             if record["hm_code"] not in [9, 14, 15, 16, 17, 18]:
                 retval.append({"chrom":record["chromosome"],"pos":record["base_pair_location"],"ref":record["hm_effect_allele"],
                 "alt":record["hm_other_allele"],"pval":record["p_value"],"trait":record["trait"][0]})
+        traits = list(set([record["trait"] for record in retval]))
+        trait_names = dict(zip(traits, await asyncio.gather(*[aget_trait_name(a, client) for a in traits])))
         for record in retval:
-            record["trait_name"] = self.__get_trait(record["trait"])
+            record["trait_name"] = trait_names[record["trait"]]
         return retval
 
-    def associations_for_regions(self, regions: List[Region]) -> List[Dict[str, Any]]:
+    def associations_for_regions(self, regions: List[Region]) -> pd.DataFrame:
         """Return associations for a list of Regions
         Args:
             regions (List[Region]): The list of regions for which associations are queried
         """
-        data_lst=[]
-        for region in regions:
-            data_lst.append([region.chrom,region.start,region.end])
-        results = None
-        with ThreadPool(self.threads) as pool:
-            results=pool.starmap(self.__get_associations,data_lst)
+        client = self.client if self.client is not None else http_client.get_client()
+        results = client.gather([self.__get_associations(client,region.chrom,region.start,region.end) for region in regions], limit=self.threads)
         results=[r for r in results if r != None]
         results=[i for sublist in results for i in sublist]
-        return results
+        return association_table(pd.DataFrame(results))
 
 
 def _gwcat_set_column_types(data: pd.DataFrame) -> pd.DataFrame:
@@ -128,65 +115,169 @@ def _gwcat_set_column_types(data: pd.DataFrame) -> pd.DataFrame:
     retcols=["chrom","pos","rsid","pval","pval_mlog","trait","trait_name","study","study_link"]
     return data.loc[:,retcols]
 
+def load_gwcatalog(db_path: str) -> pd.DataFrame:
+    """Read GWAS Catalog associations with mapped ontologies, and prepare them for LocalDB:
+    drop associations without a single valid position, split multiple efo codes to separate rows and set the column types.
+    Args:
+        db_path (str): Path to the GWAS Catalog association file
+    Returns:
+        (pd.DataFrame): Associations with columns (chrom, pos, rsid, pval, pval_mlog, trait, trait_name, study, study_link), sorted by chromosome and position
+    """
+    try:
+        df=pd.read_csv(db_path,sep="\t",low_memory=False)
+    except FileNotFoundError as err:
+        raise FileNotFoundError("argument {} to flag '--local-gwascatalog' not found: Does the file exist?".format(db_path))
+    df=df.astype(str)
+    df=df.loc[ ~ df["CHR_POS"].str.contains(";") ,:]
+    df=df.loc[ ~ df["CHR_POS"].str.contains("x") ,:]
+    df["CHR_POS"]=pd.to_numeric(df["CHR_POS"],errors="coerce")
+    df["SNP_ID_CURRENT"]=pd.to_numeric(df["SNP_ID_CURRENT"],errors="coerce")
+    df["P-VALUE"]=pd.to_numeric(df["P-VALUE"],errors="coerce")
+    df["PVALUE_MLOG"]=pd.to_numeric(df["PVALUE_MLOG"],errors="coerce")
+    df=df.dropna(axis="index",subset=["CHR_POS","CHR_ID","P-VALUE","PVALUE_MLOG","SNP_ID_CURRENT"])
+    df=df.astype({"CHR_POS":int,"P-VALUE":float,"SNP_ID_CURRENT": int})
+    #split multiple efo codes to separate rows
+    cols=["SNP_ID_CURRENT","CHR_ID","CHR_POS","P-VALUE","PVALUE_MLOG","MAPPED_TRAIT","MAPPED_TRAIT_URI","LINK","STUDY"]
+    df = split_traits(df.loc[:,cols])
+    df.loc[:,"trait"]=parse_efo_codes(df.loc[:,"MAPPED_TRAIT_URI"])
+    df = _gwcat_set_column_types(df)
+    #sorted, so that PositionIndex indexes the associations, and memory-mapped snapshots of them, in place
+    return df.sort_values(["chrom","pos"], kind="mergesort").reset_index(drop=True)
+
+def create_snapshot(db_path: str, out_path: str, meta: Optional[Dict[str,Any]]=None) -> bool:
+    """Write the prepared GWAS Catalog associations as a memory-mappable columnar snapshot, which LocalDB can load in place of the association file.
+    The snapshot records the sha256 of the association file, and it is only rewritten if the file has changed or the snapshot has an old format or version.
+    Args:
+        db_path (str): Path to the GWAS Catalog association file
+        out_path (str): Snapshot directory
+        meta (Optional[Dict[str,Any]]): Extra metadata. It is updated also when the snapshot is up to date.
+    Returns:
+        (bool): True if the snapshot was written, False if it was up to date
+    """
+    source_hash = columnar_store.file_sha256(db_path)
+    if columnar_store.is_current(out_path):
+        current = columnar_store.read_meta(out_path)
+        if current.get("source_sha256") == source_hash and current.get("snapshot_version") == SNAPSHOT_VERSION:
+            if meta:
+                columnar_store.update_meta(out_path, meta)
+            return False
+    df = load_gwcatalog(db_path)
+    out_meta = dict(meta) if meta else {}
+    out_meta.update({"source":os.path.abspath(db_path), "source_sha256":source_hash, "snapshot_version":SNAPSHOT_VERSION})
+    columnar_store.write_table(out_path, df, out_meta)
+    return True
+
+def download_export(url: str, out_path: str, client: Optional[http_client.HttpClient]=None) -> Optional[float]:
+    """Download the GWAS Catalog association export with mapped ontologies to a file. A zipped export is unpacked.
+    Args:
+        url (str): Export url
+        out_path (str): Output file
+        client (Optional[http_client.HttpClient]): HTTP client. Default is the shared client of the process.
+    Returns:
+        (Optional[float]): The time of the export from the Last-Modified header of the response, as a unix timestamp, or None if the header is missing or invalid
+    """
+    client = client if client is not None else http_client.get_client()
+    download_path = out_path + ".download"
+    headers = client.download(url, download_path)
+    if zipfile.is_zipfile(download_path):
+        with zipfile.ZipFile(download_path) as archive:
+            members = [a for a in archive.namelist() if not a.endswith("/")]
+            if len(members) != 1:
+                raise Exception("GWAS Catalog export {} should contain one file, found {}".format(url, members))
+            with archive.open(members[0]) as src, open(download_path + ".tsv", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        os.remove(download_path)
+        download_path = download_path + ".tsv"
+    os.replace(download_path, out_path)
+    try:
+        return parsedate_to_datetime(headers["Last-Modified"]).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def create_mirror(source: str, out_path: str, export_path: str, client: Optional[http_client.HttpClient]=None, export_time: Optional[float]=None) -> bool:
+    """Create a local mirror of GWAS Catalog, i.e. a snapshot of the full association export, which LocalDB can load.
+    The snapshot records the time of the export. db_factory uses the mirror in place of the GWAS Catalog api while it is fresh, see mirror_age.
+    The time of a downloaded export is export_time if given, otherwise the Last-Modified time of the download, or the time of the download if the server does not send it.
+    The time of an export file must be given with export_time, as the modification time of a file does not tell when it was exported.
+    Args:
+        source (str): Export url, or a previously downloaded export file
+        out_path (str): Mirror snapshot directory
+        export_path (str): File the export is downloaded to, if source is an url
+        client (Optional[http_client.HttpClient]): HTTP client. Default is the shared client of the process.
+        export_time (Optional[float]): Time of the export as a unix timestamp. Required if source is a file.
+    Returns:
+        (bool): True if the snapshot was written, False if it was up to date with the export
+    """
+    if source.startswith(("http://", "https://")):
+        download_time = time.time()
+        modified = download_export(source, export_path, client)
+        if export_time is None:
+            export_time = modified if modified is not None else download_time
+    else:
+        if not os.path.isfile(source):
+            raise FileNotFoundError("GWAS Catalog export {} not found: Does the file exist?".format(source))
+        if export_time is None:
+            raise ValueError("The export time of GWAS Catalog export file {} is required to create a mirror from it".format(source))
+        export_path = source
+    return create_snapshot(export_path, out_path, {"export_url":source, "export_time":export_time})
+
+def mirror_age(path: str) -> Optional[float]:
+    """Return the age of a GWAS Catalog mirror created with create_mirror in seconds, or None if path is not a mirror or has an old format
+    """
+    if not columnar_store.is_current(path):
+        return None
+    meta = columnar_store.read_meta(path)
+    if "export_time" not in meta:
+        return None
+    return time.time() - meta["export_time"]
+
+def read_gwcatalog(db_path: str) -> pd.DataFrame:
+    """Read prepared GWAS Catalog associations from a snapshot created with create_snapshot, or from the association file with load_gwcatalog
+    """
+    if columnar_store.is_store(db_path):
+        df, _ = columnar_store.read_table(db_path)
+        return df
+    return load_gwcatalog(db_path)
+
 class LocalDB(ExtDB):
+    """GWAS Catalog associations from a local association file, or from a snapshot of it created with 'gwcatalog.py snapshot'
+    """
 
     def __init__(self, db_path: str, pval_threshold: float, padding: int, alleledb: AlleleDB):
         self.pad = int(padding)
         self.pval_threshold = float(pval_threshold)
-        try:
-            self.df=pd.read_csv(db_path,sep="\t",low_memory=False)
-        except FileNotFoundError as err:
-            raise FileNotFoundError("argument {} to flag '--local-gwascatalog' not found: Does the file exist?".format(db_path))
         self.alleledb = alleledb
-        self.df=self.df.astype(str)
-        self.df=self.df.loc[ ~ self.df["CHR_POS"].str.contains(";") ,:]
-        self.df=self.df.loc[ ~ self.df["CHR_POS"].str.contains("x") ,:]
-        self.df["CHR_POS"]=pd.to_numeric(self.df["CHR_POS"],errors="coerce")
-        self.df["SNP_ID_CURRENT"]=pd.to_numeric(self.df["SNP_ID_CURRENT"],errors="coerce")
-        self.df["P-VALUE"]=pd.to_numeric(self.df["P-VALUE"],errors="coerce")
-        self.df["PVALUE_MLOG"]=pd.to_numeric(self.df["PVALUE_MLOG"],errors="coerce")
-        self.df=self.df.dropna(axis="index",subset=["CHR_POS","CHR_ID","P-VALUE","PVALUE_MLOG","SNP_ID_CURRENT"])
-        self.df=self.df.astype({"CHR_POS":int,"P-VALUE":float,"SNP_ID_CURRENT": int})
-        self.df=self.df.loc[self.df["P-VALUE"]<=self.pval_threshold ,:] #filter the df now by pval
+        #the associations are filtered by pval per query, so that a memory-mapped snapshot is not copied
+        self.df = read_gwcatalog(db_path)
+        self.index = PositionIndex(self.df,"chrom","pos")
     
-    def __get_associations(self, chromosome: str, start: int, end: int)-> List[Dict[str,Any]]:
+    def __get_associations(self, chromosome: str, start: int, end: int)-> Optional[pd.DataFrame]:
         start=max(0,int(start)-self.pad)
         end=int(end)+self.pad
-        #filter based on chromosome, start, end, pval
-        df=self.df.loc[self.df["CHR_ID"]==str(chromosome),:].copy()
-        df=df.loc[ (df["CHR_POS"] >=start)& (df["CHR_POS"] <=end ) ,:]
-        if df.empty:
-            return []
-        cols=["SNP_ID_CURRENT","CHR_ID","CHR_POS","P-VALUE","PVALUE_MLOG","MAPPED_TRAIT","MAPPED_TRAIT_URI","LINK","STUDY"]
-        tmpdf=df.loc[:,cols].copy()
-        #deal with multiple efo codes in retval trait uri column
-        retval = split_traits(tmpdf)
+        retval = self.index.query(chromosome, start, end)
+        retval = retval.loc[retval["pval"]<=self.pval_threshold,:]
         if retval.empty:
-            return []
-        retval=retval.reset_index()
-        retval.loc[:,"trait"]=retval.loc[:,"MAPPED_TRAIT_URI"].apply(lambda x: parse_efo(x))
-        retval=_gwcat_set_column_types(retval)
-        return retval.to_dict("records")
+            return None
+        return retval
 
-    def associations_for_regions(self, regions: List[Region]) -> List[Dict[str, Any]]:
+    def associations_for_regions(self, regions: List[Region]) -> pd.DataFrame:
         """Get associations for a list of Regions
         Args:
             regions(List[Region]): A list of Regions
         Returns:
-        List[Dict[str, Any]]: A List of associations for variants in the regions
+            (pd.DataFrame): Associations for variants in the regions, see db.association_table
         """
         out= []
         for region in regions:
             try:
-                out.extend(self.__get_associations(region.chrom,region.start,region.end))
+                out.append(self.__get_associations(region.chrom,region.start,region.end))
             except:
                 pass
-        #TODO: get rid of this ugly format switching
-        result_df = pd.DataFrame(out)
-        if result_df.empty:
-            return []
-        df_out = add_alleles(result_df,self.alleledb)
-        return df_out.to_dict("records")
+        out = [a for a in out if a is not None]
+        if not out:
+            return association_table()
+        result_df = pd.concat(out,ignore_index=True,sort=False)
+        return association_table(add_alleles(result_df,self.alleledb))
 
 def add_alleles(gwasdata: pd.DataFrame, alleledb : AlleleDB):
     """Add allele data for variants
@@ -196,27 +287,12 @@ def add_alleles(gwasdata: pd.DataFrame, alleledb : AlleleDB):
     Returns:
         (pd.DataFrame): Dataframe with added columns (ref, alt)
     """
-    #get the Locations
-    data = gwasdata[["chrom","pos"]].drop_duplicates()
-    locs = []
-    for t in data[["chrom","pos"]].itertuples():
-        locs.append(Location(t.chrom,int(t.pos)))
-    #get allele lst
-    variantlst = alleledb.get_alleles(locs)
-    variantlst = [a for a in variantlst if a.biallelic()]
-    gwas_rsid_list = [Rsid(Location(a.chrom,a.pos),a.rsid) for a in gwasdata.itertuples()]
-    variants_with_alleles = _resolve_alleles(gwas_rsid_list,variantlst)
-    flat_vars = [
-        (
-            a.variant.chrom,
-            a.variant.pos,
-            a.variant.ref,
-            a.variant.alt,
-            a.rsid
-        )
-        for a in variants_with_alleles
-    ]
-    variant_df = pd.DataFrame(flat_vars,columns=["chrom","pos","ref","alt","rsid"])
+    locations = gwasdata[["chrom","pos"]].drop_duplicates()
+    variant_df = alleledb.get_allele_table(locations)
+    #only biallelic variants
+    variant_df = variant_df.loc[~variant_df["alt"].str.contains(","),:]
+    variant_df = variant_df.drop_duplicates(subset=["chrom","pos","rsid","ref","alt"])
+    variant_df = variant_df.astype({"chrom":str,"pos":int,"rsid":int})
     out = gwasdata.merge(variant_df,how="inner",on=["chrom","pos","rsid"]).drop_duplicates(keep="first")
     return out
 
@@ -250,63 +326,112 @@ def _resolve_alleles(rsids: List[Rsid], variantdata: List[VariantData])->List[Rs
         for a in merged_data.itertuples()
     ]
 
+#GWAS Catalog web site, the base url of the download api
+GWASCATALOG_URL = "https://www.ebi.ac.uk/gwas"
+#full association export with mapped ontologies, used for mirrors
+GWASCATALOG_EXPORT_URL = "{}/api/search/downloads/alternative".format(GWASCATALOG_URL)
+#padded regions closer than this are fetched with one download query
+GWASAPI_MAX_GAP = 250000
+#largest span of one download query
+GWASAPI_MAX_SPAN = 2000000
+
 class GwasApi(ExtDB):
     """ 
     Gwas Catalog + ensembl api, returning values identical to the gwas catalog website.
+    Nearby padded regions are merged to fewer, wider download queries, and the results are filtered back to the padded regions.
+    Args:
+        pval_threshold (float): p-value threshold for associations
+        padding (int): Padding added to both sides of queried regions, in bp
+        threads (int): Maximum number of regions queried at the same time
+        alleledb (AlleleDB): Allele database for resolving the alleles of associations
+        client (Optional[http_client.HttpClient]): HTTP client. Default is the shared client of the process.
+        base_url (str): Base url of the GWAS Catalog download api
+        max_gap (int): Padded regions closer than this, in bp, are fetched with one query
+        max_span (int): Largest span of one query, in bp
     """
 
-    def __init__(self, pval_threshold, padding, threads, alleledb):
+    def __init__(self, pval_threshold, padding, threads, alleledb, client=None, base_url=GWASCATALOG_URL, max_gap=GWASAPI_MAX_GAP, max_span=GWASAPI_MAX_SPAN):
         self.pval_threshold = float(pval_threshold)
         self.pad = int(padding)
         self.threads = threads
         self.alleledb=alleledb
+        self.client = client
+        self.base_url = base_url.rstrip("/")
+        self.max_gap = int(max_gap)
+        self.max_span = int(max_span)
 
-    def __get_associations(self,chromosome,start,end):
+    async def __get_associations(self,client,chromosome,start,end):
         pval=self.pval_threshold
-        start=max(0,int(start)-self.pad)
-        end=int(end)+self.pad
-        url="https://www.ebi.ac.uk/gwas/api/search/downloads?q=chromosomeName: {} AND chromosomePosition:[ {} TO {}"\
-            "]&pvalfilter=&orfilter=&betafilter=&datefilter=&genomicfilter=&genotypingfilter[]=&traitfilter[]=&dateaddedfilter=&facet=association&efo=true".format(
-            chromosome,start,end)
-        #gwcat_response=requests.get(url)
+        url="{}/api/search/downloads".format(self.base_url)
+        params={
+            "q":"chromosomeName: {} AND chromosomePosition:[ {} TO {}]".format(chromosome,start,end),
+            "pvalfilter":"","orfilter":"","betafilter":"","datefilter":"","genomicfilter":"","genotypingfilter[]":"","traitfilter[]":"","dateaddedfilter":"",
+            "facet":"association","efo":"true"
+        }
         try:
-            gwcat_response=try_request("GET",url=url)
+            gwcat_response=await client.arequest("GET",url,params=params)
         except ResourceNotFound:
-            return []
+            return None
         except ResponseFailure as e:
-            print(e,e.parameters)
-            return []
+            print("GWAS Catalog query of {}:{}-{} failed:".format(chromosome,start,end),e.parameters)
+            raise
         s_io=StringIO(gwcat_response.text)
         df=pd.read_csv(s_io,sep="\t")
         if df.empty:
-            return []
+            return None
         cols=["SNP_ID_CURRENT","CHR_ID","CHR_POS","P-VALUE","PVALUE_MLOG","MAPPED_TRAIT","MAPPED_TRAIT_URI","LINK","STUDY"]
         tmpdf=df.loc[:,cols].copy()
         #deal with multiple efo codes in retval trait uri column
         retval = split_traits(tmpdf)
         if retval.empty:
-            return []
+            return None
         retval=retval.reset_index()
-        retval.loc[:,"trait"]=retval.loc[:,"MAPPED_TRAIT_URI"].apply(lambda x: parse_efo(x))
+        retval.loc[:,"trait"]=parse_efo_codes(retval.loc[:,"MAPPED_TRAIT_URI"])
         retval=_gwcat_set_column_types(retval)
         retval = retval[retval["pval"]<=pval]
-        return retval.to_dict("records")
+        return retval
 
-    def associations_for_regions(self, regions: List[Region]) -> List[Dict[str, Any]]:
-        data_lst=[]
-        for region in regions:
-            data_lst.append([region.chrom,region.start,region.end])
-        results = None
-        with ThreadPool(self.threads) as pool:
-            results=pool.starmap(self.__get_associations,data_lst)
-        results=[r for r in results if r != None]
-        results=[i for sublist in results for i in sublist]
-        #TODO: get rid of this ugly format switching
-        result_df = pd.DataFrame(results)
+    def associations_for_regions(self, regions: List[Region]) -> pd.DataFrame:
+        """Get associations for a list of Regions. The associations of queries that failed are left out, see query_regions.
+        Args:
+            regions(List[Region]): A list of Regions
+        Returns:
+            (pd.DataFrame): Associations for variants in the regions, see db.association_table
+        """
+        return self.query_regions(regions)[0]
+
+    def query_regions(self, regions: List[Region]) -> Tuple[pd.DataFrame, List[Region]]:
+        """Get associations for a list of Regions, and the regions whose query failed after the retries of the HTTP client
+        Args:
+            regions(List[Region]): A list of Regions
+        Returns:
+            (Tuple[pd.DataFrame, List[Region]]): Associations for variants in the regions that were queried successfully, see db.association_table, and the regions whose query failed
+        """
+        padded = [Region(str(a.chrom), max(0,int(a.start)-self.pad), int(a.end)+self.pad) for a in regions]
+        queries = plan_region_queries(padded, self.max_gap, self.max_span)
+        client = self.client if self.client is not None else http_client.get_client()
+        results = client.gather([self.__get_associations(client,query.chrom,query.start,query.end) for query in queries], limit=self.threads, return_exceptions=True)
+        for r in results:
+            if isinstance(r, Exception) and not isinstance(r, ResponseFailure):
+                raise r
+        #a region is never split between queries, so its associations are complete if a successful query contains its padded region
+        done = [q for q, r in zip(queries, results) if not isinstance(r, ResponseFailure)]
+        failed = [a for a, p in zip(regions, padded) if not any([q.chrom == p.chrom and q.start <= p.start and p.end <= q.end for q in done])]
+        results=[r for r in results if isinstance(r, pd.DataFrame) and not r.empty]
+        if not results:
+            return association_table(), failed
+        result_df = pd.concat(results,ignore_index=True,sort=False)
+        #the queries cover the gaps between the regions, and overlapping regions can be in several queries
+        result_df = result_df.loc[in_regions(result_df["chrom"], result_df["pos"], padded), :].drop_duplicates().reset_index(drop=True)
         if result_df.empty:
-            return []
-        df_out = add_alleles(result_df,self.alleledb)
-        return df_out.to_dict("records")
+            return association_table(), failed
+        return association_table(add_alleles(result_df,self.alleledb)), failed
+
+    def cache_identity(self) -> Dict[str,Any]:
+        identity = super().cache_identity()
+        identity["base_url"] = self.base_url
+        identity["alleledb"] = os.path.abspath(self.alleledb.file) if hasattr(self.alleledb,"file") else type(self.alleledb).__name__
+        return identity
 
 def parse_output(dumplst):
     rows=[]
@@ -315,33 +440,47 @@ def parse_output(dumplst):
             rows.append(d[k])
     return rows
 
+TRAIT_URL="https://www.ebi.ac.uk/gwas/rest/api/efoTraits/"
+
 def get_trait_name(trait):
-    base_url="https://www.ebi.ac.uk/gwas/rest/api/efoTraits/"
     try:
-        r=try_request("GET",url="{}{}".format(base_url,trait) )
+        r=http_client.get_client().request("GET",url="{}{}".format(TRAIT_URL,trait))
     except ResourceNotFound:
         print("Trait {} not found in GWASCatalog".format(trait))
         return "NA"
     except ResponseFailure:
         print("Request for trait {} failed".format(trait))
         return "NA"
-    except:#unhandled exceptions
-        raise
     else:
         return r.json()["trait"]
 
-def try_request(method,url,headers="",data="", params={},retry_count=5):
+async def aget_trait_name(trait, client):
+    """Coroutine version of get_trait_name, using client
     """
-    Make a GET/POST request and handle possible errors
-    In: method, url, headers,data,parameters, number fo times to retry the request
+    try:
+        r=await client.arequest("GET",url="{}{}".format(TRAIT_URL,trait))
+    except ResourceNotFound:
+        print("Trait {} not found in GWASCatalog".format(trait))
+        return "NA"
+    except ResponseFailure:
+        print("Request for trait {} failed".format(trait))
+        return "NA"
+    else:
+        return r.json()["trait"]
+
+def try_request(method,url,headers="",data="", params={},retry_count=5,session=None):
+    """
+    Make a GET/POST request and handle possible errors. The online backends use http_client.HttpClient instead.
+    In: method, url, headers,data,parameters, number fo times to retry the request, optional requests.Session to reuse connections
     Out: Request or None
     """
+    request = session.request if session is not None else requests.request
     try:
-        r=requests.request(method=method, url=url, headers=headers,params=params,data=data)
+        r=request(method=method, url=url, headers=headers,params=params,data=data)
         tries=2
         while r.status_code not in (200,400,404):
             time.sleep(0.5)
-            r=requests.request(method=method, url=url, headers=headers,params=params,data=data)
+            r=request(method=method, url=url, headers=headers,params=params,data=data)
             if tries >= retry_count:
                 print("{} Request {} with parameters {}; headers {}; data {}; returned code {} with attempt {}".format(method,
                     url,
@@ -369,29 +508,61 @@ def parse_efo(code):
         return code.split("/").pop()
 
 
+def parse_efo_codes(codes: pd.Series) -> pd.Series:
+    """Vectorised parse_efo: the last part of each trait uri, and 'NAN' for invalid uris.
+    Catalogs repeat a small set of uris, so each distinct uri is parsed once.
+    Args:
+        codes (pd.Series): trait uris
+    Returns:
+        (pd.Series): EFO codes, with the same index
+    """
+    index, uniques = pd.factorize(codes)
+    uniques = pd.Series(uniques, dtype=object)
+    parsed = uniques.str.rsplit("/", n=1).str[-1] if not uniques.empty else uniques
+    invalid = parsed.isna()
+    if invalid.any() or (index < 0).any():
+        print("Invalid EFO codes:{}".format(list(uniques[invalid]) + ([np.nan] if (index < 0).any() else [])))
+    #code -1, i.e. a missing uri, takes the last element
+    parsed = np.append(parsed.where(~invalid, "NAN").values, "NAN").astype(object)
+    return pd.Series(parsed[index], index=codes.index)
+
+def _split_column(values: pd.Series) -> pd.DataFrame:
+    """Split comma-separated values to (row, piece, value) rows, where row is the index of the value and piece the position of the part.
+    Each distinct value is split once.
+    """
+    codes, uniques = pd.factorize(values)
+    #missing values, code -1, are kept as the last unique value
+    codes = np.where(codes < 0, len(uniques), codes)
+    parts = pd.Series(np.append(np.asarray(uniques, dtype=object), np.nan), dtype=object).str.split(",").explode()
+    pieces = pd.DataFrame({
+        "code":parts.index,
+        "piece":parts.groupby(level=0).cumcount().values,
+        "value":parts.str.strip().values
+    })
+    rows = pd.DataFrame({"row":values.index, "code":codes})
+    return rows.merge(pieces, on="code", how="inner").sort_values(["row","piece"], kind="mergesort").drop(columns="code")
+
 def split_traits(df,traitname="MAPPED_TRAIT",traituriname="MAPPED_TRAIT_URI"):
     """
     Split gwascatalog trait column to single traits. 
     Does this by duplicating rows with multiple traits to multiple rows, each containing only one trait.
+    The traits and trait uris are paired in order, and extra traits or uris without a pair are dropped.
     In: Dataframe containing information and the trait columns, 'MAPPED_TRAIT' and 'MAPPED_TRAIT_URI'
     Out: Same dataframe with the information and columns 'MAPPED_TRAIT' and 'MAPPED_TRAIT_URI'
     """
-    retval=[]
     if (traitname not in df.columns) or (traituriname not in df.columns) :
         return None
-    for row in df.itertuples(index=False):
-        if type(getattr(row,traituriname)) == type("string"):
-            if "," in getattr(row,traituriname):
-                efos=getattr(row,traituriname).split(",")
-                traits=getattr(row,traitname).split(",")
-                efos=[e.strip() for e in efos]
-                traits=[t.strip() for t in traits]
-                for idx, (efo,trait) in enumerate(zip(efos,traits)):
-                    new_row=row._replace(**{traitname:trait, traituriname:efo})
-                    retval.append(new_row)
-            else:
-                retval.append(row)
-        else:
-            retval.append(row)
-    retval=pd.DataFrame.from_records(retval,columns=df.columns)
+    df = df.reset_index(drop=True)
+    if df[traituriname].dtype != object:
+        return df
+    multi = df[traituriname].str.contains(",",regex=False).fillna(False).astype(bool)
+    if not multi.any():
+        return df
+    #inner join on the position pairs the traits and uris, like zip
+    pairs = _split_column(df.loc[multi,traituriname]).merge(_split_column(df.loc[multi,traitname]),on=["row","piece"],how="inner",suffixes=("_uri","_trait"))
+    split = df.loc[pairs["row"],:].reset_index(drop=True)
+    split[traitname] = pairs["value_trait"].values
+    split[traituriname] = pairs["value_uri"].values
+    split.index = pairs["row"].values
+    retval = pd.concat([df.loc[~multi,:],split]).sort_index(kind="mergesort").reset_index(drop=True)
     return retval
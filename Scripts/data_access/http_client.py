@@ -0,0 +1,202 @@
+"""HTTP client shared by the online backends.
+Requests are scheduled on an asyncio event loop running in a background thread, and sent through one pooled requests.Session, so that connections are kept alive between requests.
+"""
+import asyncio
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Awaitable, Mapping
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+
+class RequestError(Exception):
+    """
+    Unrecoverable error baseclass for request errors
+    """
+    pass
+
+class ResourceNotFound(RequestError):
+    """
+    Value does not exist in database or it was not found for some other reason
+    """
+    def __init__(self,parameters=None):
+        super(RequestError,self).__init__()
+        self.parameters=parameters
+    pass
+
+class ResponseFailure(RequestError):
+    """
+    The request aborted due to some error
+    """
+    def __init__(self,parameters=None):
+        super(RequestError,self).__init__()
+        self.parameters=parameters
+
+#status codes of responses that are retried
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+class HttpClient(object):
+    """Asyncio HTTP client with connection pooling, bounded per-host concurrency and retries.
+    Responses with status 429 or 5xx, and connection errors, are retried with exponential backoff and jitter.
+    The coroutine API (arequest) is used from coroutines running on the client's loop, the synchronous facade (request, run, gather) from other threads.
+    Args:
+        max_per_host (int): Maximum number of concurrent requests to one host
+        retry_count (int): Maximum number of attempts for one request
+        backoff (float): Base delay of the exponential backoff, in seconds
+        max_backoff (float): Maximum delay between attempts, in seconds
+        timeout (float): Timeout of one attempt, in seconds
+    """
+    def __init__(self, max_per_host: int=8, retry_count: int=5, backoff: float=0.5, max_backoff: float=30.0, timeout: float=120.0):
+        self.max_per_host = max(1, int(max_per_host))
+        self.retry_count = max(1, int(retry_count))
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=self.max_per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        #blocking session calls run in the executor, one thread per concurrent request
+        self.executor = ThreadPoolExecutor(max_workers=4*self.max_per_host)
+        self.__semaphores = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def __semaphore(self, url: str) -> asyncio.Semaphore:
+        #only called from the loop thread
+        host = urlparse(url).netloc
+        if host not in self.__semaphores:
+            self.__semaphores[host] = asyncio.Semaphore(self.max_per_host)
+        return self.__semaphores[host]
+
+    def __delay(self, attempt: int, response: Optional[requests.Response]) -> float:
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    async def arequest(self, method: str, url: str, params: Optional[Dict[str,Any]]=None, headers: Optional[Dict[str,str]]=None, data: Any=None) -> requests.Response:
+        """Make a request, retrying on 429, 5xx and connection errors
+        Args:
+            method (str): HTTP method
+            url (str): url
+            params (Optional[Dict[str,Any]]): query parameters
+            headers (Optional[Dict[str,str]]): headers
+            data (Any): request body
+        Returns:
+            (requests.Response): Response with status 200
+        Raises:
+            ResourceNotFound: The response status was 400 or 404
+            ResponseFailure: The request failed, or was still failing after the last attempt
+        """
+        def send():
+            return self.session.request(method=method, url=url, params=params, headers=headers, data=data, timeout=self.timeout)
+        for attempt in range(self.retry_count):
+            last = attempt == self.retry_count - 1
+            r = None
+            async with self.__semaphore(url):
+                try:
+                    #the coroutines run on the client loop. asyncio.get_running_loop is not available in python 3.6.
+                    r = await self.loop.run_in_executor(self.executor, send)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    if last:
+                        print("Request caused an exception:{}".format(e))
+                        raise ResponseFailure(parameters=e)
+                except Exception as e:
+                    print("Request caused an exception:{}".format(e))
+                    raise ResponseFailure(parameters=e)
+            if r is not None:
+                if r.status_code == 200:
+                    return r
+                if r.status_code in (400, 404):
+                    raise ResourceNotFound(parameters={"url":r.url,"params":params,"headers":headers,"data":data,"status_code":r.status_code})
+                if r.status_code not in RETRY_STATUS or last:
+                    print("{} Request {} with parameters {}; headers {}; data {}; returned code {} with attempt {}".format(method,
+                        url, params, headers, data, r.status_code, attempt+1))
+                    raise ResponseFailure(parameters={"url":r.url,"params":params,"headers":headers,"data":data,"status_code":r.status_code})
+            await asyncio.sleep(self.__delay(attempt, r))
+
+    def run(self, coroutine: Awaitable) -> Any:
+        """Run a coroutine on the client loop and wait for its result
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def request(self, method: str, url: str, params: Optional[Dict[str,Any]]=None, headers: Optional[Dict[str,str]]=None, data: Any=None) -> requests.Response:
+        """Synchronous version of arequest
+        """
+        return self.run(self.arequest(method, url, params=params, headers=headers, data=data))
+
+    def gather(self, coroutines: List[Awaitable], limit: Optional[int]=None, return_exceptions: bool=False) -> List[Any]:
+        """Run coroutines concurrently on the client loop, and wait for their results
+        Args:
+            coroutines (List[Awaitable]): coroutines to run
+            limit (Optional[int]): Maximum number of coroutines running at the same time
+            return_exceptions (bool): Return the exceptions of failed coroutines in place of their results, instead of raising the first one
+        Returns:
+            (List[Any]): Results of the coroutines, in the same order
+        """
+        async def run_all():
+            semaphore = asyncio.Semaphore(limit) if limit else None
+            async def run_one(coroutine):
+                if semaphore is None:
+                    return await coroutine
+                async with semaphore:
+                    return await coroutine
+            return await asyncio.gather(*[run_one(a) for a in coroutines], return_exceptions=return_exceptions)
+        return self.run(run_all())
+
+    def download(self, url: str, out_path: str, params: Optional[Dict[str,Any]]=None) -> Mapping[str,str]:
+        """Download a response body to a file, streaming it in blocks. The file is replaced only when the download is complete.
+        Args:
+            url (str): url
+            out_path (str): Output file
+            params (Optional[Dict[str,Any]]): query parameters
+        Returns:
+            (Mapping[str,str]): The response headers, with case-insensitive names
+        Raises:
+            ResourceNotFound: The response status was 400 or 404
+            ResponseFailure: The request failed, or the response status was not 200
+        """
+        tmp_path = out_path + ".part"
+        try:
+            with self.session.get(url, params=params, stream=True, timeout=self.timeout) as r:
+                if r.status_code in (400, 404):
+                    raise ResourceNotFound(parameters={"url":r.url,"params":params,"status_code":r.status_code})
+                if r.status_code != 200:
+                    print("Download {} with parameters {} returned code {}".format(url, params, r.status_code))
+                    raise ResponseFailure(parameters={"url":r.url,"params":params,"status_code":r.status_code})
+                with open(tmp_path, "wb") as f:
+                    for block in r.iter_content(1 << 20):
+                        f.write(block)
+                headers = r.headers
+        except (requests.ConnectionError, requests.Timeout) as e:
+            print("Download caused an exception:{}".format(e))
+            raise ResponseFailure(parameters=e)
+        os.replace(tmp_path, out_path)
+        return headers
+
+    def close(self):
+        """Stop the client loop and close the connections
+        """
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+def get_client() -> HttpClient:
+    """Return the HTTP client of this process, creating it if necessary. Forked worker processes create their own client.
+    """
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = HttpClient()
+            _client_pid = os.getpid()
+        return _client
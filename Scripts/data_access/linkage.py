@@ -1,71 +1,274 @@
 import abc
-import argparse,shlex,subprocess, glob, time
+import argparse,shlex,subprocess, glob, time, os, tempfile, threading, copy
 from subprocess import Popen, PIPE
 from typing import List, Text, Dict,Any, Optional
+from multiprocessing.dummy import Pool as ThreadPool
+from collections import OrderedDict
 import pandas as pd, numpy as np
-from data_access.gwcatalog_api import try_request, ResourceNotFound, ResponseFailure
-from data_access.db import LDAccess, LDData, Variant
+from data_access import http_client
+from data_access.http_client import ResourceNotFound, ResponseFailure
+from data_access.db import LDAccess, LDData, LDTable, LD_COLUMNS, Variant
 from autoreporting_utils import create_variant_column
 
 
 class OnlineLD(LDAccess):
-    def __init__(self,url):
+    """LD from the FinnGen LD API.
+    Responses are cached per (variant, window, threshold). The backend is thread-safe, so that LD for upcoming leads can be fetched concurrently.
+    Args:
+        url (str): LD API url
+        prefetch_depth (int): Number of upcoming leads whose LD the grouping fetches in the background
+        cache_size (int): Maximum number of cached responses
+        client (Optional[http_client.HttpClient]): HTTP client. Default is the shared client of the process.
+    """
+    def __init__(self,url,prefetch_depth=0,cache_size=1024,client=None):
         self.url=url
+        self.prefetch_depth=prefetch_depth
+        self.cache_size=cache_size
+        self.client=client
+        self.__cache=OrderedDict()
+        self.__lock=threading.Lock()
+
+    def __getstate__(self):
+        #clients and locks are not passed to worker processes, they use the shared client of the process
+        state = self.__dict__.copy()
+        del state["_OnlineLD__lock"]
+        state["client"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock=threading.Lock()
+
+    @staticmethod
+    def __window(bp_range: int) -> int:
+        window = 2* bp_range 
+        return max(min(window, 5000000), 100000)#range in api.finngen.fi is [100 000, 5 000 000]
+
+    def __key(self, variant: Variant, bp_range: int, ld_threshold: Optional[float]):
+        return (variant, self.__window(bp_range), ld_threshold if ld_threshold else None)
 
     def get_range(self, variant: Variant, bp_range: int, ld_threshold: Optional[float]=None) -> List[LDData]:
         """Get LD data for a range around one variant
         """
-        window = 2* bp_range 
-        window = max(min(window, 5000000), 100000)#range in api.finngen.fi is [100 000, 5 000 000]
-        variant="{}:{}:{}:{}".format(variant.chrom, variant.pos, variant.ref, variant.alt)
-        params={"variant":variant,"panel":"sisu3","variant":variant,"window":window}
+        return self.get_range_table(variant, bp_range, ld_threshold).to_ld_data()
+
+    def get_range_table(self, variant: Variant, bp_range: int, ld_threshold: Optional[float]=None) -> LDTable:
+        """Get LD data for a range around one variant as an LDTable
+        """
+        key = self.__key(variant, bp_range, ld_threshold)
+        with self.__lock:
+            if key in self.__cache:
+                self.__cache.move_to_end(key)
+                return self.__cache[key]
+        ld_data = self.__fetch(*key)
+        with self.__lock:
+            self.__cache[key] = ld_data
+            if len(self.__cache) > self.cache_size:
+                self.__cache.popitem(last=False)
+        return ld_data
+
+    def __fetch(self, variant: Variant, window: int, ld_threshold: Optional[float]) -> LDTable:
+        """Request and parse the LD data of one window
+        """
+        variant_id="{}:{}:{}:{}".format(variant.chrom, variant.pos, variant.ref, variant.alt)
+        params={"variant":variant_id,"panel":"sisu3","window":window}
         if ld_threshold:
             params["r2_thresh"]=ld_threshold
         try:
-            data=try_request("GET",url=self.url,params=params)
+            client = self.client if self.client is not None else http_client.get_client()
+            data=client.request("GET",self.url,params=params)
         except ResourceNotFound as e:
             print("LD data not found (status code {}) with url {} and params {}.".format(e.parameters["status_code"],self.url,params) )
-            return [LDData(
-                variant,
-                variant,
-                1.0
-            )]
+            return LDTable.self_ld(variant)
         except ResponseFailure as e:
             print("Error with request.")
             print(e)
             raise e
         #parse data
-        ld_data=data.json()["ld"]
-        ld_out=[]
-        for d in ld_data:
-            c1 = d["variation1"].split(":")[0]
-            p1 = int(d["variation1"].split(":")[1])
-            ref1 = d["variation1"].split(":")[2]
-            alt1 = d["variation1"].split(":")[3]
+        ld_df=pd.DataFrame(data.json()["ld"],columns=["variation1","variation2","r2"])
+        if ld_df.empty:
+            return LDTable(pd.DataFrame(columns=LD_COLUMNS))
+        ld_columns = {}
+        for n in (1,2):
+            parts = ld_df["variation{}".format(n)].str.split(":",expand=True)
+            ld_columns["chrom{}".format(n)] = parts[0]
+            ld_columns["pos{}".format(n)] = parts[1].astype(np.int64)
+            ld_columns["ref{}".format(n)] = parts[2]
+            ld_columns["alt{}".format(n)] = parts[3]
+        ld_columns["r2"] = ld_df["r2"].astype(float)
+        return LDTable(pd.DataFrame(ld_columns))
+
+def _flip_snp_id(snp: str) -> str:
+    """Swap the alleles of a chr{chrom}_{pos}_{ref}_{alt} variant id. Other ids are returned as is.
+    """
+    data = snp.split("_")
+    if len(data) != 4:
+        return snp
+    return "_".join([data[0],data[1],data[3],data[2]])
+
+class PanelIndex(object):
+    """Hashed index of the variant ids of a plink panel, loaded once from the panel's .bim file.
+    Variants are looked up both as is and with flipped alleles, so that a variant that is in the panel
+    as chr1_123_C_A is found when asked for chr1_123_A_C.
+    """
+    def __init__(self, bim_path: str):
+        ids = pd.read_csv(bim_path, delim_whitespace=True, header=None, usecols=[1], dtype=str)[1]
+        self.hashes = np.sort(pd.util.hash_array(ids.values.astype(object)))
 
-            c2 = d["variation2"].split(":")[0]
-            p2 = int(d["variation2"].split(":")[1])
-            ref2 = d["variation2"].split(":")[2]
-            alt2 = d["variation2"].split(":")[3]
+    def __len__(self):
+        return self.hashes.shape[0]
 
-            r2 = float(d["r2"])
+    def __contains__(self, snp: str) -> bool:
+        h = pd.util.hash_array(np.array([snp],dtype=object))[0]
+        idx = np.searchsorted(self.hashes, h)
+        return bool(idx < self.hashes.shape[0] and self.hashes[idx] == h)
 
-            ld_out.append(
-                LDData(
-                    Variant(c1, p1, ref1, alt1),
-                    Variant(c2, p2, ref2, alt2),
-                    r2)
-                )
-        return ld_out
+    def __contains_ids(self, ids: pd.Series) -> np.ndarray:
+        if self.hashes.shape[0] == 0:
+            return np.zeros(ids.shape[0], dtype=bool)
+        h = pd.util.hash_array(ids.values.astype(object))
+        idx = np.minimum(np.searchsorted(self.hashes, h), self.hashes.shape[0]-1)
+        return self.hashes[idx] == h
 
+    def lookup_ids(self, ids: pd.Series) -> pd.Series:
+        """Return the ids of the variants in the panel, NA for the variants that are not in the panel
+        """
+        ids = ids.astype(str)
+        flipped = ids.map(_flip_snp_id)
+        return ids.where(self.__contains_ids(ids), flipped.where(self.__contains_ids(flipped)))
 
+    def lookup(self, snp: str) -> Optional[str]:
+        """Return the id of the variant in the panel, or None if the variant is not in the panel
+        """
+        if snp in self:
+            return snp
+        flipped = _flip_snp_id(snp)
+        return flipped if flipped in self else None
 
 class PlinkLD(LDAccess):
-    def __init__(self,path,memory):
+    def __init__(self,path,memory,threads=1):
         self.path=path
         self.memory=memory
+        self.threads=max(int(threads),1)
+        #number of LD calculations that were skipped because the lead variant was not in the panel
+        self.panel_misses = 0
+        self.__lock = threading.Lock()
+        bim_path = "{}.bim".format(path)
+        if os.path.exists(bim_path):
+            self.panel_index = PanelIndex(bim_path)
+        else:
+            print("LD panel variant file {} not found, variants are not checked against the panel before running plink.".format(bim_path))
+            self.panel_index = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_PlinkLD__lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    def partition(self, n: int) -> "PlinkLD":
+        """Return a PlinkLD with 1/n of the plink memory and threads, for one of n worker processes
+        """
+        n = max(int(n),1)
+        part = copy.copy(self)
+        part.memory = max(int(self.memory/n),1)
+        part.threads = max(int(self.threads/n),1)
+        part.panel_misses = 0
+        return part
 
     def get_range(self, variant: Variant, bp_range: int, ld_threshold:Optional[float]=None)->List[LDData]:
+        return self.get_range_table(variant, bp_range, ld_threshold).to_ld_data()
+
+    def get_ranges(self, variants: List[Variant], bp_range: int, ld_threshold: Optional[float]=None) -> List[List[LDData]]:
+        return [a.to_ld_data() for a in self.get_range_tables(variants, bp_range, ld_threshold)]
+
+    def clump(self, assoc: pd.DataFrame, p1: float, p2: float, r2: float, kb: int, allow_overlap: bool=False) -> pd.DataFrame:
+        """Clump variants genome-wide with a single plink --clump run, and get the r2 of the clumped variants to their index variants with a single --r2 run.
+        Args:
+            assoc (pd.DataFrame): Variants with columns 'SNP' (variant id, chr{chrom}_{pos}_{ref}_{alt}) and 'P'
+            p1 (float): Significance threshold for index variants (--clump-p1)
+            p2 (float): Significance threshold for clumped variants (--clump-p2)
+            r2 (float): LD threshold for clumping (--clump-r2)
+            kb (int): Clumping window in kb (--clump-kb)
+            allow_overlap (bool): Whether variants can be clumped with several index variants (--clump-allow-overlap)
+        Returns:
+            (pd.DataFrame): Clumped variants with columns 'lead', 'variant' and 'r2', using the ids of assoc. Every index variant is in its own clump with r2 1.0.
+        """
+        out_columns = ["lead","variant","r2"]
+        assoc = assoc.drop_duplicates(subset=["SNP"]).copy()
+        assoc["ID"] = assoc["SNP"].astype(str).str.replace(r"^chr23_", "chrX_", regex=True)
+        if self.panel_index is not None:
+            assoc["ID"] = self.panel_index.lookup_ids(assoc["ID"])
+            with self.__lock:
+                self.panel_misses += int(assoc["ID"].isna().sum())
+            assoc = assoc.dropna(subset=["ID"])
+        if assoc.empty:
+            return pd.DataFrame(columns=out_columns)
+        to_id = dict(zip(assoc["ID"], assoc["SNP"]))
+        with tempfile.TemporaryDirectory(prefix="plink_clump_") as tmp_dir:
+            assoc_fname = os.path.join(tmp_dir, "assoc.tsv")
+            assoc[["ID","P"]].rename(columns={"ID":"SNP"}).to_csv(assoc_fname, sep="\t", index=False)
+            clump_name = os.path.join(tmp_dir, "clump")
+            plink_cmd = f"plink --allow-extra-chr --bfile {self.path} --clump {assoc_fname} --clump-p1 {p1} --clump-p2 {p2} --clump-r2 {r2} --clump-kb {kb} --out {clump_name} --memory {self.memory}"
+            if allow_overlap:
+                plink_cmd += " --clump-allow-overlap"
+            self.__run_plink(plink_cmd)
+            #plink does not write the clump file if none of the variants are significant
+            if not os.path.exists(f"{clump_name}.clumped"):
+                return pd.DataFrame(columns=out_columns)
+            clumped = pd.read_csv(f"{clump_name}.clumped", delim_whitespace=True, usecols=["SNP","SP2"], dtype=str)
+            lead_fname = os.path.join(tmp_dir, "leads.txt")
+            clumped[["SNP"]].to_csv(lead_fname, header=False, index=False)
+            r2_name = os.path.join(tmp_dir, "r2")
+            plink_cmd = f"plink --allow-extra-chr --bfile {self.path} --r2 gz --ld-snp-list {lead_fname} --ld-window-r2 {r2} --ld-window-kb {kb} --ld-window 100000 --out {r2_name} --memory {self.memory}"
+            self.__run_plink(plink_cmd)
+            ld_df = pd.read_csv(f"{r2_name}.ld.gz", delim_whitespace=True, compression="gzip", usecols=["SNP_A","SNP_B","R2"], dtype={"SNP_A":str,"SNP_B":str})
+        #SP2 is a comma-separated list of 'variant(allele)' entries, or NONE
+        members = clumped.assign(variant=clumped["SP2"].str.split(",")).explode("variant")
+        members["variant"] = members["variant"].str.strip().str.replace(r"\(\d+\)$", "", regex=True)
+        members = members.loc[(members["variant"] != "NONE") & members["variant"].notna(), ["SNP","variant"]]
+        clumps = pd.concat([pd.DataFrame({"SNP":clumped["SNP"],"variant":clumped["SNP"]}), members], ignore_index=True)
+        clumps = clumps.merge(ld_df.rename(columns={"SNP_A":"SNP","SNP_B":"variant","R2":"r2"}).drop_duplicates(subset=["SNP","variant"]), on=["SNP","variant"], how="left")
+        clumps.loc[clumps["SNP"] == clumps["variant"],"r2"] = 1.0
+        clumps["lead"] = clumps["SNP"].map(to_id)
+        clumps["variant"] = clumps["variant"].map(to_id)
+        return clumps.dropna(subset=["lead","variant"])[out_columns].reset_index(drop=True)
+
+    def __run_plink(self, plink_cmd: str):
+        pr = subprocess.run(shlex.split(plink_cmd),stdout=PIPE,stderr=subprocess.STDOUT,encoding='ASCII')
+        if pr.returncode != 0:
+            print("PLINK FAILURE. Error code {}".format(pr.returncode))
+            print(*pr.stdout.splitlines(), sep="\n")
+            raise Exception("plink command failed: {}".format(plink_cmd))
+
+    @property
+    def prefetch_depth(self) -> int:
+        #the grouping can run a plink process for the upcoming leads on each of the other threads
+        return self.threads - 1
+
+    def get_range_table(self, variant: Variant, bp_range: int, ld_threshold:Optional[float]=None)->LDTable:
+        """Get LD for one variant. As up to self.threads of these can be run at the same time, each gets 1/threads of the plink memory.
+        """
+        return self.__get_range(variant, bp_range, ld_threshold, max(int(self.memory/self.threads),1))
+
+    def get_range_tables(self, variants: List[Variant], bp_range: int, ld_threshold: Optional[float]=None) -> List[LDTable]:
+        """Get LD for several variants using concurrent plink processes.
+        At most self.threads plink runs are active at the same time, and the plink memory is divided evenly between them.
+        Returns:
+            (List[LDTable]): LD data for each variant, in the same order as the input variants
+        """
+        if not variants:
+            return []
+        threads = min(self.threads, len(variants))
+        memory = max(int(self.memory/threads),1)
+        with ThreadPool(threads) as pool:
+            results = pool.starmap(self.__get_range, [(v, bp_range, ld_threshold, memory) for v in variants])
+        return results
+
+    def __get_range(self, variant: Variant, bp_range: int, ld_threshold: Optional[float], memory: int) -> LDTable:
         if not ld_threshold:
             ld_threshold = 0.0
         chromosome = variant.chrom
@@ -76,30 +279,39 @@ class PlinkLD(LDAccess):
             variant.alt
         )
         kb_range = int(bp_range/1000)
-        plink_name = f"plink_{snp}_ld"
-        plink_cmd = f"plink --allow-extra-chr --bfile {self.path} --chr {chromosome} --r2 gz --ld-snp {snp} --ld-window-r2 {ld_threshold} --ld-window-kb {kb_range} --ld-window 100000 --out {plink_name} --memory {self.memory}"
-        pr = subprocess.Popen(shlex.split(plink_cmd),stdout=PIPE,stderr=subprocess.STDOUT,encoding='ASCII')
-        pr.wait()
-        plink_log = pr.stdout.readlines()
-        if pr.returncode != 0:
-            if any([ True for a in plink_log if "Error: No valid variants specified by --ld-snp/--ld-snps/--ld-snp-list." in a]):
-                print("PLINK FAILURE. Variants not found in LD panel for chromosome {}".format(chromosome))
-            print("PLINK FAILURE. Error code {}".format(pr.returncode)  )
-            print(*plink_log, sep="\n")
-            return [LDData(variant,variant,1.0)]
-        else:
+        panel_snp = snp
+        if self.panel_index is not None:
+            panel_snp = self.panel_index.lookup(snp)
+            if panel_snp is None:
+                #the skipped runs are reported once, from panel_misses
+                with self.__lock:
+                    self.panel_misses += 1
+                return LDTable.self_ld(variant)
+        #every run gets its own directory, so that concurrent runs for the same or different variants do not clobber each other's files
+        with tempfile.TemporaryDirectory(prefix="plink_ld_") as tmp_dir:
+            plink_name = os.path.join(tmp_dir, f"plink_{snp}_ld")
+            plink_cmd = f"plink --allow-extra-chr --bfile {self.path} --chr {chromosome} --r2 gz --ld-snp {panel_snp} --ld-window-r2 {ld_threshold} --ld-window-kb {kb_range} --ld-window 100000 --out {plink_name} --memory {memory}"
+            pr = subprocess.run(shlex.split(plink_cmd),stdout=PIPE,stderr=subprocess.STDOUT,encoding='ASCII')
+            plink_log = pr.stdout.splitlines()
+            if pr.returncode != 0:
+                if any([ True for a in plink_log if "Error: No valid variants specified by --ld-snp/--ld-snps/--ld-snp-list." in a]):
+                    print("PLINK FAILURE. Variants not found in LD panel for chromosome {}".format(chromosome))
+                print("PLINK FAILURE. Error code {}".format(pr.returncode)  )
+                print(*plink_log, sep="\n")
+                return LDTable.self_ld(variant)
             #columns are: CHR_A, BP_A, SNP_A, CHR_B. BP_B, SNP_B, R2
             ld_df=pd.read_csv("{}.ld.gz".format(plink_name),delim_whitespace=True,compression="gzip")
-        #clean up the files
-        cleanup_cmd= "rm {}".format(plink_name)
-        plink_files = glob.glob( "{}.*".format(plink_name) )
-        subprocess.call(shlex.split(cleanup_cmd)+plink_files, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        ld_data = [
-            LDData(
-                Variant(str(v["CHR_A"]).replace("X","23"), int(v["BP_A"]), v["SNP_A"].split("_")[2], v["SNP_A"].split("_")[3]),
-                Variant(str(v["CHR_B"]).replace("X","23"), int(v["BP_B"]), v["SNP_B"].split("_")[2], v["SNP_B"].split("_")[3]),
-                float(v["R2"])
-            )
-            for v in ld_df.to_dict('records')
-        ]
-        return ld_data
+        if ld_df.empty:
+            return LDTable(pd.DataFrame(columns=LD_COLUMNS))
+        ld_columns = {}
+        for n, side in ((1,"A"),(2,"B")):
+            snp_ids = ld_df["SNP_{}".format(side)].astype(str)
+            alleles = snp_ids.str.split("_",expand=True)
+            #if the variant is in the panel with flipped alleles, report it with the alleles it was asked with
+            is_lead = snp_ids == panel_snp
+            ld_columns["chrom{}".format(n)] = ld_df["CHR_{}".format(side)].astype(str).str.replace("X","23").where(~is_lead,variant.chrom)
+            ld_columns["pos{}".format(n)] = ld_df["BP_{}".format(side)].where(~is_lead,variant.pos)
+            ld_columns["ref{}".format(n)] = alleles[2].where(~is_lead,variant.ref)
+            ld_columns["alt{}".format(n)] = alleles[3].where(~is_lead,variant.alt)
+        ld_columns["r2"] = ld_df["R2"]
+        return LDTable(pd.DataFrame(ld_columns))
@@ -0,0 +1,126 @@
+"""Association database in a local SQLite file, indexed by chromosome and position
+"""
+import os
+import sqlite3
+from typing import List, Optional
+import pandas as pd, numpy as np
+from data_access.db import ExtDB, AlleleDB, ASSOCIATION_COLUMNS, association_table
+from data_access import columnar_store
+from data_access.gwcatalog_api import load_gwcatalog, add_alleles
+from data_access.custom_catalog import load_custom_catalog
+from autoreporting_utils import Region
+
+_COLUMN_TYPES = {
+    "chrom":"TEXT NOT NULL",
+    "pos":"INTEGER NOT NULL",
+    "ref":"TEXT",
+    "alt":"TEXT",
+    "rsid":"INTEGER",
+    "pval":"REAL NOT NULL",
+    "pval_mlog":"REAL",
+    "beta":"REAL",
+    "se":"REAL",
+    "trait":"TEXT",
+    "trait_name":"TEXT",
+    "study":"TEXT",
+    "study_link":"TEXT"
+}
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS associations ({})".format(", ".join(["{} {}".format(a, _COLUMN_TYPES[a]) for a in ASSOCIATION_COLUMNS])),
+    "CREATE INDEX IF NOT EXISTS associations_region ON associations (chrom, pos)",
+    "CREATE TABLE IF NOT EXISTS sources (path TEXT, format TEXT, source_sha256 TEXT, rows INTEGER)"
+]
+
+def import_associations(db_path: str, source: str, source_format: str) -> int:
+    """Import associations to an SQLite association database, creating the database if it does not exist.
+    Args:
+        db_path (str): SQLite database path
+        source (str): Association file
+        source_format (str): 'gwcatalog' for GWAS Catalog associations with mapped ontologies, or 'custom' for a custom data resource file
+    Returns:
+        (int): Number of imported associations
+    """
+    if source_format == "gwcatalog":
+        data = load_gwcatalog(source)
+    elif source_format == "custom":
+        data = load_custom_catalog(source)
+    else:
+        raise ValueError("Unknown association file format {}, use 'gwcatalog' or 'custom'".format(source_format))
+    data = association_table(data)
+    #NaN to NULL
+    data = data.astype(object).where(data.notna(), None)
+    conn = sqlite3.connect(db_path)
+    try:
+        with conn:
+            for statement in _SCHEMA:
+                conn.execute(statement)
+            conn.executemany(
+                "INSERT INTO associations ({}) VALUES ({})".format(", ".join(ASSOCIATION_COLUMNS), ", ".join(["?"]*len(ASSOCIATION_COLUMNS))),
+                data.itertuples(index=False, name=None)
+            )
+            conn.execute("INSERT INTO sources VALUES (?, ?, ?, ?)",
+                (os.path.abspath(source), source_format, columnar_store.file_sha256(source), data.shape[0]))
+        conn.execute("ANALYZE")
+    finally:
+        conn.close()
+    return data.shape[0]
+
+class SQLiteDB(ExtDB):
+    """Associations from an SQLite association database created with 'gwcatalog.py sqlite'.
+    The p-value threshold and the region padding are applied in the database query, using the (chrom, pos) index, so that only matching associations are read.
+    Alleles of associations without them, i.e. GWAS Catalog associations, are resolved with the allele database.
+    Args:
+        db_path (str): SQLite database path
+        pval_threshold (float): p-value threshold for associations
+        padding (int): Padding added to both sides of queried regions, in bp
+        alleledb (Optional[AlleleDB]): Allele database. If None, associations without alleles are dropped.
+    """
+    def __init__(self, db_path: str, pval_threshold: float, padding: int, alleledb: Optional[AlleleDB]):
+        if not os.path.isfile(db_path):
+            raise FileNotFoundError("SQLite association database {} not found: Does the file exist?".format(db_path))
+        self.db_path = db_path
+        self.pval_threshold = float(pval_threshold)
+        self.pad = int(padding)
+        self.alleledb = alleledb
+        self.conn = sqlite3.connect("file:{}?mode=ro".format(db_path), uri=True, check_same_thread=False)
+        self.query = "SELECT {} FROM associations WHERE chrom = ? AND pos BETWEEN ? AND ? AND pval <= ? ORDER BY rowid".format(", ".join(ASSOCIATION_COLUMNS))
+
+    def __getstate__(self):
+        #connections are not passed to other processes
+        state = self.__dict__.copy()
+        del state["conn"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.conn = sqlite3.connect("file:{}?mode=ro".format(self.db_path), uri=True, check_same_thread=False)
+
+    def __get_associations(self, chromosome: str, start: int, end: int) -> List[tuple]:
+        start=max(0,int(start)-self.pad)
+        end=int(end)+self.pad
+        return self.conn.execute(self.query, (str(chromosome), start, end, self.pval_threshold)).fetchall()
+
+    def associations_for_regions(self, regions: List[Region]) -> pd.DataFrame:
+        """Get associations for a list of Regions
+        Args:
+            regions(List[Region]): A list of Regions
+        Returns:
+            (pd.DataFrame): Associations for variants in the regions, see db.association_table
+        """
+        rows = []
+        for region in regions:
+            rows.extend(self.__get_associations(region.chrom, region.start, region.end))
+        data = pd.DataFrame(rows, columns=ASSOCIATION_COLUMNS)
+        if data.empty:
+            return association_table()
+        has_alleles = data["ref"].notna() & data["alt"].notna()
+        out = [data.loc[has_alleles, :]]
+        no_alleles = data.loc[~has_alleles, :].drop(columns=["ref", "alt"])
+        if (not no_alleles.empty) and (self.alleledb is not None):
+            no_alleles = no_alleles.astype({"rsid":np.int64})
+            out.append(add_alleles(no_alleles, self.alleledb))
+        out = [a for a in out if not a.empty]
+        if not out:
+            return association_table()
+        return association_table(pd.concat(out, ignore_index=True, sort=False))
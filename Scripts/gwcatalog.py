@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Prepare local GWAS Catalog resources once, so that they can be shared by many autoreporting runs.
+"""
+import argparse
+from datetime import datetime, timezone
+from data_access import gwcatalog_api, sqlite_catalog, alleledb
+
+def snapshot(args):
+    """Create a columnar snapshot of a GWAS Catalog association file
+    """
+    if gwcatalog_api.create_snapshot(args.gwascatalog, args.out):
+        print("Snapshot of {} written to {}".format(args.gwascatalog, args.out))
+    else:
+        print("Snapshot {} is up to date with {}".format(args.out, args.gwascatalog))
+
+def sqlite(args):
+    """Import association files to an SQLite association database
+    """
+    if not args.gwascatalog and not args.custom_dataresource:
+        raise ValueError("Give at least one of --gwascatalog or --custom-dataresource to import")
+    sources = ([(args.gwascatalog, "gwcatalog")] if args.gwascatalog else []) + [(a, "custom") for a in args.custom_dataresource]
+    for source, source_format in sources:
+        rows = sqlite_catalog.import_associations(args.out, source, source_format)
+        print("Imported {} associations from {} to {}".format(rows, source, args.out))
+
+def mirror(args):
+    """Create or refresh a local GWAS Catalog mirror from the association export
+    """
+    export = args.export if args.export else args.out.rstrip("/") + ".tsv"
+    if gwcatalog_api.create_mirror(args.source, args.out, export, export_time=args.export_time):
+        print("Mirror of {} written to {}".format(args.source, args.out))
+    else:
+        print("Mirror {} is up to date with {}".format(args.out, args.source))
+
+def export_time(value: str) -> float:
+    """Parse an export date YYYY-MM-DD, in UTC, to a unix timestamp
+    """
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError("export time {} is not a date YYYY-MM-DD".format(value))
+
+def alleles(args):
+    """Extract the alleles of GWAS Catalog variants to a compact allele table
+    """
+    rows = alleledb.create_allele_table(args.gwascatalog, args.vcf, args.out)
+    print("Wrote alleles for {} variants to {}".format(rows, args.out))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prepare local GWAS Catalog resources")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    snapshot_parser = subparsers.add_parser("snapshot", help="Write a memory-mapped snapshot of a GWAS Catalog association file. Use the snapshot directory with --local-gwascatalog.")
+    snapshot_parser.add_argument("gwascatalog", type=str, help="GWAS Catalog associations with mapped ontologies")
+    snapshot_parser.add_argument("out", type=str, help="Snapshot output directory")
+    snapshot_parser.set_defaults(func=snapshot)
+    sqlite_parser = subparsers.add_parser("sqlite", help="Import association files to an SQLite association database. Use the database with --db sqlite --local-gwascatalog DATABASE.")
+    sqlite_parser.add_argument("out", type=str, help="SQLite database path. If the database exists, the associations are added to it.")
+    sqlite_parser.add_argument("--gwascatalog", type=str, default="", help="GWAS Catalog associations with mapped ontologies")
+    sqlite_parser.add_argument("--custom-dataresource", dest="custom_dataresource", type=str, nargs="*", default=[], help="Custom data resource files")
+    sqlite_parser.set_defaults(func=sqlite)
+    mirror_parser = subparsers.add_parser("mirror", help="Download the GWAS Catalog association export, and write a snapshot of it. Use the mirror with --db gwas --gwascatalog-mirror MIRROR.")
+    mirror_parser.add_argument("out", type=str, help="Mirror output directory")
+    mirror_parser.add_argument("--source", type=str, default=gwcatalog_api.GWASCATALOG_EXPORT_URL, help="Export url, or a previously downloaded export file for creating the mirror offline. Default {}".format(gwcatalog_api.GWASCATALOG_EXPORT_URL))
+    mirror_parser.add_argument("--export", type=str, default="", help="File the export is downloaded to. Default is the output directory name with a .tsv suffix.")
+    mirror_parser.add_argument("--export-time", dest="export_time", type=export_time, default=None, help="Date of the export, YYYY-MM-DD in UTC, which the mirror age is counted from. Required if --source is a file. For a download, the default is the Last-Modified date of the download, or the time of the download if the server does not send it.")
+    mirror_parser.set_defaults(func=mirror)
+    alleles_parser = subparsers.add_parser("alleles", help="Extract the alleles of GWAS Catalog variants from the dbSNP vcf to a compact allele table. Use the table with --gwascatalog-allele-file.")
+    alleles_parser.add_argument("gwascatalog", type=str, help="GWAS Catalog associations with mapped ontologies, or a snapshot of them")
+    alleles_parser.add_argument("vcf", type=str, help="Tabixed dbSNP vcf, with numeric chromosomes")
+    alleles_parser.add_argument("out", type=str, help="Allele table output directory")
+    alleles_parser.set_defaults(func=alleles)
+    args = parser.parse_args()
+    args.func(args)
@@ -5,10 +5,13 @@ from subprocess import Popen, PIPE
 import sys,os,io
 import pandas as pd, numpy as np
 import scipy.stats as stats
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple, Any
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+import heapq
 from autoreporting_utils import *
 from data_access.linkage import PlinkLD, OnlineLD, Variant, LDData
-from data_access.db import LDAccess
+from data_access.db import LDAccess, LDTable
 from data_access.db import CSAccess, CS, CSVariant
 from data_access.cs import cs_to_df
 from data_access.csfactory import csfactory
@@ -19,6 +22,27 @@ def parse_region(region):
     end=region.split(":")[1].split("-")[1]
     return {"chrom":str(chrom),"start":int(start),"end":int(end)}
 
+#chromosome names in the input data. Chromosome X can be named 23 or X.
+CHROMOSOMES = [str(a) for a in range(1,24)] + ["X"]
+#largest position that can be queried from a tabix index
+MAX_POSITION = 2**29-1
+
+def region_complement(region: Dict[str,Any]) -> List[Region]:
+    """Return the regions covering the genome outside of a region
+    Args:
+        region (Dict[str,Any]): Region from parse_region
+    Returns:
+        (List[Region]): Regions outside of the region. A region in chromosome 23 or X is excluded from both.
+    """
+    excluded = ["23","X"] if region["chrom"] in ["23","X"] else [region["chrom"]]
+    out = [Region(a, 1, MAX_POSITION) for a in CHROMOSOMES if a not in excluded]
+    for chrom in excluded:
+        if region["start"] > 1:
+            out.append(Region(chrom, 1, region["start"]-1))
+        if region["end"] < MAX_POSITION:
+            out.append(Region(chrom, region["end"]+1, MAX_POSITION))
+    return out
+
 def simple_grouping(df_p1,df_p2,r,overlap,columns):
     """
     Simple grouping function
@@ -51,6 +75,216 @@ def simple_grouping(df_p1,df_p2,r,overlap,columns):
 
 
 
+class GreedyClumper(object):
+    """Greedy clumping state shared by ld_grouping and credible_grouping.
+    Candidate leads are kept in a p-value min-heap, with ties broken by row order. Variants are identified by integer codes,
+    and retired variants are left in the heap and skipped when popped (lazy deletion). Rows that are claimed by a group
+    are tracked in a boolean array over the row positions of the pool. Groups are stored as arrays of row positions,
+    and the output dataframe is built once in build.
+    Args:
+        pool (pd.DataFrame): All rows that can be grouped, with the '#variant' column.
+        lead_positions (np.ndarray): Row positions in pool of the lead candidates
+        pval_col (str): p-value column name
+    """
+    def __init__(self, pool: pd.DataFrame, lead_positions: np.ndarray, pval_col: str):
+        self.pool = pool.reset_index(drop=True)
+        #sorted factorization, so that the order of codes is the order of the variant ids
+        codes, self.uniques = pd.factorize(self.pool["#variant"], sort=True)
+        self.codes = codes
+        self.rows_by_code = np.argsort(codes, kind="mergesort")
+        self.code_starts = np.searchsorted(codes[self.rows_by_code], np.arange(len(self.uniques)+1))
+        self.claimed = np.zeros(self.pool.shape[0], dtype=bool)
+        self.retired = np.zeros(len(self.uniques), dtype=bool)
+        pvals = self.pool[pval_col].values.astype(float)
+        self.heap = [(pvals[i], int(i)) for i in lead_positions if not np.isnan(pvals[i])]
+        heapq.heapify(self.heap)
+        self.groups = []
+
+    def pop_lead(self) -> Optional[int]:
+        """Return the row position of the next lead, i.e. the remaining lead candidate with the smallest p-value, or None if there are none left.
+        """
+        while self.heap:
+            _, pos = heapq.heappop(self.heap)
+            if not self.retired[self.codes[pos]]:
+                return pos
+        return None
+
+    def peek(self, k: int) -> List[int]:
+        """Return the row positions of the next k leads without removing them.
+        """
+        taken = []
+        while self.heap and len(taken) < k:
+            item = heapq.heappop(self.heap)
+            if not self.retired[self.codes[item[1]]]:
+                taken.append(item)
+        for item in taken:
+            heapq.heappush(self.heap, item)
+        return [a[1] for a in taken]
+
+    def codes_of(self, ids: pd.Series) -> np.ndarray:
+        """Variant codes of variant ids. Ids that are not in the pool get code -1.
+        """
+        return self.uniques.get_indexer(ids)
+
+    def rows_of(self, codes: np.ndarray) -> np.ndarray:
+        """Row positions of all rows with any of the codes, in row order
+        """
+        codes = np.unique(codes[codes >= 0])
+        if codes.shape[0] == 0:
+            return np.zeros(0, dtype=np.int64)
+        starts = self.code_starts[codes]
+        lengths = self.code_starts[codes+1] - starts
+        idx = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return np.sort(self.rows_by_code[idx])
+
+    def retire(self, codes: np.ndarray):
+        """Remove the variants from lead candidates
+        """
+        self.retired[codes[codes >= 0]] = True
+
+    def claim(self, positions: np.ndarray):
+        """Mark rows as grouped, so that later groups can not include them
+        """
+        self.claimed[positions] = True
+
+    def add_group(self, lead_pos: int, positions: np.ndarray, r2: np.ndarray, wipe: Optional[np.ndarray]=None):
+        """Store a group
+        Args:
+            lead_pos (int): row position of the group lead
+            positions (np.ndarray): row positions of the group rows, in output order
+            r2 (np.ndarray): r2 to lead for each of the group rows
+            wipe (Optional[np.ndarray]): boolean array, true for the rows whose credible set columns are removed
+        """
+        if wipe is None:
+            wipe = np.zeros(positions.shape[0], dtype=bool)
+        self.groups.append((lead_pos, positions, r2, wipe))
+
+    def build(self, template: pd.DataFrame, pos_col: str, wipe_columns: List[str]=[]) -> pd.DataFrame:
+        """Build the grouped dataframe
+        Args:
+            template (pd.DataFrame): empty dataframe with the output columns
+            pos_col (str): position column name, used for pos_rmin and pos_rmax
+            wipe_columns (List[str]): columns that are set to NA for wiped rows
+        Returns:
+            (pd.DataFrame): the group rows with columns r2_to_lead, locus_id, pos_rmin and pos_rmax set
+        """
+        groups = [g for g in self.groups if g[1].shape[0] > 0]
+        if not groups:
+            return template
+        sizes = np.array([g[1].shape[0] for g in groups])
+        positions = np.concatenate([g[1] for g in groups])
+        out = self.pool.iloc[positions].reset_index(drop=True)
+        out["r2_to_lead"] = np.concatenate([g[2] for g in groups]).astype(float)
+        wipe = np.concatenate([g[3] for g in groups])
+        if wipe.any():
+            for col in wipe_columns:
+                out.loc[wipe,col] = np.nan
+        out["locus_id"] = np.repeat(self.pool["#variant"].values[[g[0] for g in groups]], sizes)
+        group_starts = np.concatenate([[0],np.cumsum(sizes)[:-1]])
+        pos_values = out[pos_col].values
+        out["pos_rmin"] = np.repeat(np.minimum.reduceat(pos_values, group_starts), sizes)
+        out["pos_rmax"] = np.repeat(np.maximum.reduceat(pos_values, group_starts), sizes)
+        return pd.concat([template,out],ignore_index=True,axis=0,join="inner")
+
+class LDPrefetcher(object):
+    """Fetch LD for the upcoming leads of a greedy grouping on a background thread pool, while the current group is formed.
+    Prefetched LD is keyed by the lead row, and it is discarded if the lead is claimed by a group before it is used.
+    As the LD backend is deterministic, the grouping results do not depend on what was prefetched.
+    Args:
+        ld_api (LDAccess): ld api object. Its get_range_table must be thread-safe if depth > 0.
+        locus_range (int): Range around the locus on which LD is calculated, in bp
+        depth (int): Number of upcoming leads to prefetch. With 0, LD is fetched only when needed.
+    """
+    def __init__(self, ld_api: LDAccess, locus_range: int, depth: int):
+        self.ld_api = ld_api
+        self.locus_range = locus_range
+        self.depth = max(int(depth),0)
+        self.executor = ThreadPoolExecutor(max_workers=self.depth) if self.depth > 0 else None
+        self.pending = {}
+        #all submitted prefetches, including discarded ones that were already running
+        self.futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        """Cancel the prefetches that have not started, and wait for the at most depth running ones, so that no prefetch outlives the grouping
+        """
+        self.pending = {}
+        for future in self.futures:
+            future.cancel()
+        self.futures = []
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def prefetch(self, leads: List[Tuple[int, Variant, float]]):
+        """Start fetching LD for leads that are not already being fetched
+        Args:
+            leads (List[Tuple[int, Variant, float]]): lead row position, lead variant and LD threshold for each lead
+        """
+        if self.executor is None:
+            return
+        self.futures = [a for a in self.futures if not a.done()]
+        for (pos, variant, ld_threshold) in leads:
+            if pos not in self.pending:
+                future = self.executor.submit(self.ld_api.get_range_table, variant, self.locus_range, ld_threshold)
+                self.pending[pos] = ((variant, ld_threshold), future)
+                self.futures.append(future)
+
+    def discard(self, positions: List[int]):
+        """Discard prefetched LD of leads that will not be used
+        """
+        for pos in positions:
+            item = self.pending.pop(pos, None)
+            if item is not None:
+                item[1].cancel()
+
+    def get(self, pos: int, variant: Variant, ld_threshold: float) -> LDTable:
+        """Return LD for a lead, from the prefetched results if available
+        """
+        item = self.pending.pop(pos, None)
+        if item is not None and item[0] == (variant, ld_threshold) and not item[1].cancelled():
+            return item[1].result()
+        return self.ld_api.get_range_table(variant, self.locus_range, ld_threshold)
+
+def prefetch_leads(prefetcher: LDPrefetcher, clumper: GreedyClumper, dynamic_r2: bool, ld_threshold: float, columns: Dict[str, str]) -> None:
+    """Discard the prefetched LD of retired leads, and prefetch LD for the next most significant leads
+    Args:
+        prefetcher (LDPrefetcher): LD prefetcher
+        clumper (GreedyClumper): Clumping state, from which the current lead has been popped
+        dynamic_r2 (bool): Whether to adjust LD threshold by lead variant pval or not.
+        ld_threshold (float): LD threshold, see ld_grouping
+        columns (Dict[str,str]): column dictionary
+    """
+    if prefetcher.depth <= 0:
+        return
+    prefetcher.discard([pos for pos in prefetcher.pending if clumper.retired[clumper.codes[pos]]])
+    upcoming = []
+    for pos in clumper.peek(prefetcher.depth):
+        variant, group_ld_threshold = lead_ld_query(clumper.pool.iloc[pos], dynamic_r2, ld_threshold, columns)
+        upcoming.append((pos, variant, group_ld_threshold))
+    prefetcher.prefetch(upcoming)
+
+def lead_ld_query(lead_var_row: pd.Series, dynamic_r2: bool, ld_threshold: float, columns: Dict[str, str]) -> Tuple[Variant, float]:
+    """Return the variant and LD threshold with which the LD of a lead is queried
+    """
+    group_ld_threshold = ld_threshold
+    if dynamic_r2:
+        lead_pval = lead_var_row[columns["pval"]]
+        group_ld_threshold = min(ld_threshold/stats.chi2.isf(lead_pval,df=1),1.0)
+    return (Variant(lead_var_row[columns["chrom"]], lead_var_row[columns["pos"]], lead_var_row[columns["ref"]], lead_var_row[columns["alt"]]), group_ld_threshold)
+
+def lead_ld_partners(ld_data: LDTable, lead_var_id: str, clumper: GreedyClumper) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the variant codes and r2 values of the LD partners of a lead, one per variant
+    """
+    is_lead = (ld_data.variant_ids(1) == lead_var_id).values
+    codes = clumper.codes_of(ld_data.variant_ids(2)[is_lead])
+    r2 = ld_data.df["r2"].values[is_lead]
+    _, first = np.unique(codes, return_index=True)
+    first = np.sort(first)
+    codes, r2 = codes[first], r2[first]
+    return (codes[codes >= 0], r2[codes >= 0])
+
 def ld_grouping(
     df_p1: pd.DataFrame,
     df_p2: pd.DataFrame,
@@ -74,54 +308,120 @@ def ld_grouping(
     Returns:
         (pd.DataFrame): Grouped variants in a pandas dataframe
     """
-    leads = df_p1.copy()
-    all_variants = df_p2.copy()
+    leads = df_p1
+    all_variants = df_p2
     #if r2 to lead data was gotten from cs, it's dropped as obsolete.
     if "r2_to_lead" in all_variants.columns:
         leads = leads.drop(columns=["r2_to_lead"])
         all_variants = all_variants.drop(columns=["r2_to_lead"])
     out_df = pd.DataFrame(columns=list(all_variants.columns)+["r2_to_lead"])
-    iteration=0
-    while not leads.empty:
-        #get min pval variant
-        lead_var_row = leads.loc[leads[columns["pval"]].idxmin(),: ]
-        lead_var_id = lead_var_row["#variant"]
-        #get ld threshold
-        group_ld_threshold = ld_threshold
-        if dynamic_r2:
-            lead_pval = lead_var_row[columns["pval"]]
-            group_ld_threshold = min(ld_threshold/stats.chi2.isf(lead_pval,df=1),1.0)
-        #get LD neighbourhood
-        ld_data = ld_api.get_range(Variant(lead_var_row[columns["chrom"]], lead_var_row[columns["pos"]], lead_var_row[columns["ref"]], lead_var_row[columns["alt"]]), locus_range, group_ld_threshold)
-        flat_ld = [a.to_flat() for a in ld_data]
-        ld_df = pd.DataFrame(flat_ld, columns=['chrom1','pos1','ref1','alt1','chrom2','pos2','ref2','alt2','r2'])
-        ld_df = ld_df.rename(columns={"r2":"r2_to_lead"})
-        if not ld_df.empty:
-            ld_df['variant1']=create_variant_column(ld_df,'chrom1','pos1','ref1','alt1')
-            ld_df['#variant']=create_variant_column(ld_df,'chrom2','pos2','ref2','alt2')
-            ld_df = ld_df.drop(columns=["chrom1","pos1","chrom2","pos2","ref1","ref2","alt1","alt2"])
-            ld_df = ld_df[ld_df["variant1"]==lead_var_id]
-            merged_df = pd.merge(all_variants, ld_df[["#variant","r2_to_lead"]], how="inner",on="#variant")
-            group_vars = merged_df.loc[:,out_df.columns]
-            grouplead = all_variants[all_variants["#variant"]==lead_var_id].copy()
-            grouplead["r2_to_lead"]=1.0
-            group = pd.concat([group_vars,grouplead],ignore_index=True,axis=0,join='inner').drop_duplicates(subset=["#variant"])
-        else:
-            group = leads.loc[leads["#variant"]==lead_var_id,:]
-            group["r2_to_lead"]=1.0
-    
-        group["locus_id"]=lead_var_id
-        group["pos_rmin"]=group[columns["pos"]].min()
-        group["pos_rmax"]=group[columns["pos"]].max()
-        out_df = pd.concat([out_df,group],ignore_index=True,axis=0,join="inner")
-
-        #remove all group variants from leads
-        leads = leads[~leads["#variant"].isin(group["#variant"].unique())]
-        #if overlap false, we remove grouped variants from all variants
-        if not overlap:
-            all_variants = all_variants[~all_variants["#variant"].isin(group["#variant"].unique())]
-        iteration+=1
-    return out_df
+    #the pool contains the possible group members first, then the lead candidates
+    n_all = all_variants.shape[0]
+    pool = pd.concat([all_variants,leads],ignore_index=True,axis=0,sort=False)
+    clumper = GreedyClumper(pool, np.arange(n_all,pool.shape[0]), columns["pval"])
+    is_lead_row = np.arange(pool.shape[0]) >= n_all
+    with LDPrefetcher(ld_api, locus_range, ld_api.prefetch_depth) as prefetcher:
+        while True:
+            lead_pos = clumper.pop_lead()
+            if lead_pos is None:
+                break
+            lead_var_row = clumper.pool.iloc[lead_pos]
+            lead_var_id = lead_var_row["#variant"]
+            lead_code = clumper.codes[lead_pos]
+            lead_variant, group_ld_threshold = lead_ld_query(lead_var_row, dynamic_r2, ld_threshold, columns)
+            prefetch_leads(prefetcher, clumper, dynamic_r2, ld_threshold, columns)
+            #get LD neighbourhood
+            ld_data = prefetcher.get(lead_pos, lead_variant, group_ld_threshold)
+            if not ld_data.empty:
+                partner_codes, partner_r2 = lead_ld_partners(ld_data, lead_var_id, clumper)
+                #the first remaining row of each LD partner and of the lead, in row order
+                rows = clumper.rows_of(np.append(partner_codes,lead_code))
+                rows = rows[(~is_lead_row[rows]) & (~clumper.claimed[rows])]
+                _, first = np.unique(clumper.codes[rows], return_index=True)
+                rows = np.sort(rows[first])
+                r2_by_code = pd.Series(partner_r2, index=partner_codes)
+                in_ld = np.isin(clumper.codes[rows], partner_codes)
+                #the lead is included even if it is not in the LD data, as the last row of the group
+                group_rows = np.concatenate([rows[in_ld], rows[~in_ld]])
+                group_r2 = np.concatenate([r2_by_code.loc[clumper.codes[rows[in_ld]]].values, np.ones((~in_ld).sum())])
+            else:
+                group_rows = clumper.rows_of(np.array([lead_code]))
+                group_rows = group_rows[is_lead_row[group_rows]]
+                group_r2 = np.ones(group_rows.shape[0])
+            clumper.add_group(lead_pos, group_rows, group_r2)
+            #remove all group variants from leads
+            group_codes = np.unique(clumper.codes[group_rows])
+            clumper.retire(group_codes)
+            #if overlap false, we remove grouped variants from all variants
+            if not overlap:
+                clumper.claim(clumper.rows_of(group_codes))
+    return clumper.build(out_df, columns["pos"])
+
+
+def plink_clump_grouping(
+    df_p1: pd.DataFrame,
+    df_p2: pd.DataFrame,
+    sig_tresh_1: float,
+    sig_tresh_2: float,
+    locus_range: int,
+    ld_threshold: float,
+    overlap: bool,
+    ld_api: LDAccess,
+    columns: Dict[str,str]) -> pd.DataFrame:
+    """Group variants using plink --clump
+    The clumping is done by plink in one genome-wide pass, and the clumps are converted to groups like in ld_grouping.
+    Lead variants that are not in any clump, e.g. because they are not in the LD panel, form groups of their own.
+    Args:
+        df_p1 (pd.DataFrame): Dataframe with variants that have pval>sig_threshold. These variants can be lead variants.
+        df_p2 (pd.DataFrame): Dataframe with variants that have pval>sig_threshold_2. These variants can be LD partners.
+        sig_tresh_1 (float): Significance threshold for lead variants
+        sig_tresh_2 (float): Significance threshold for LD partners
+        locus_range (int): Clumping range, in bp
+        ld_threshold (float): LD r2 threshold for including a variant in the group
+        overlap (bool): Whether groups can overlap or not.
+        ld_api (LDAccess): ld api object, must be PlinkLD
+        columns (Dict[str,str]): column dictionary
+    Returns:
+        (pd.DataFrame): Grouped variants in a pandas dataframe
+    """
+    if not isinstance(ld_api, PlinkLD):
+        raise ValueError("Grouping method plink_clump requires the plink LD api.")
+    leads = df_p1
+    all_variants = df_p2
+    if "r2_to_lead" in all_variants.columns:
+        leads = leads.drop(columns=["r2_to_lead"])
+        all_variants = all_variants.drop(columns=["r2_to_lead"])
+    out_df = pd.DataFrame(columns=list(all_variants.columns)+["r2_to_lead"])
+    n_all = all_variants.shape[0]
+    pool = pd.concat([all_variants,leads],ignore_index=True,axis=0,sort=False)
+    clumper = GreedyClumper(pool, np.zeros(0,dtype=np.int64), columns["pval"])
+    is_lead_row = np.arange(pool.shape[0]) >= n_all
+    assoc = pd.DataFrame({"SNP":pool["#variant"],"P":pool[columns["pval"]]})
+    clumps = ld_api.clump(assoc, sig_tresh_1, sig_tresh_2, ld_threshold, int(locus_range/1000), overlap)
+    clumps["lead_code"] = clumper.codes_of(clumps["lead"])
+    clumps["code"] = clumper.codes_of(clumps["variant"])
+    #form the groups from the most significant lead down, ties in plink output order
+    lead_pval = clumps["lead"].map(assoc.groupby("SNP")["P"].min())
+    clumps = clumps.iloc[np.argsort(lead_pval.values, kind="mergesort")]
+    for lead_code, clump in clumps.groupby("lead_code", sort=False):
+        lead_rows = clumper.rows_of(np.array([lead_code]))
+        lead_rows = lead_rows[is_lead_row[lead_rows]]
+        if lead_rows.shape[0] == 0:
+            continue
+        #first row of each clumped variant
+        rows = clumper.rows_of(clump["code"].values)
+        rows = rows[~is_lead_row[rows]]
+        _, first = np.unique(clumper.codes[rows], return_index=True)
+        rows = np.sort(rows[first])
+        r2_by_code = clump.drop_duplicates(subset=["code"]).set_index("code")["r2"]
+        clumper.add_group(lead_rows[0], rows, r2_by_code.loc[clumper.codes[rows]].values)
+        clumper.retire(clumper.codes[rows])
+    #leads that were not clumped
+    for lead_pos in np.flatnonzero(is_lead_row):
+        if not clumper.retired[clumper.codes[lead_pos]]:
+            clumper.add_group(lead_pos, np.array([lead_pos]), np.ones(1))
+            clumper.retire(clumper.codes[[lead_pos]])
+    return clumper.build(out_df, columns["pos"])
 
 
 def credible_grouping(data: pd.DataFrame, dynamic_r2: bool, ld_threshold: float, locus_range: int, overlap: bool, ld_api: LDAccess, columns: Dict[str, str]) -> pd.DataFrame:
@@ -138,77 +438,130 @@ def credible_grouping(data: pd.DataFrame, dynamic_r2: bool, ld_threshold: float,
     Returns:
         (pd.DataFrame): Grouped variants in a pandas dataframe
     """
-    df = data.copy()
     lead_vars = []
-    for name, group in df.groupby(["cs_id"]):
+    for name, group in data.groupby(["cs_id"]):
         loc_id = "_".join(name.split("_")[:-1])#remove cs_number from cs_id
         group_lead =  group.loc[group["#variant"]==loc_id,"#variant"].iat[0]
         lead_vars.append(group_lead)
     if len(lead_vars) == 0:
-        return pd.DataFrame(columns=df.columns)
-    leads = df.loc[df["#variant"].isin(lead_vars)].copy()
+        return pd.DataFrame(columns=data.columns)
     out_df = pd.DataFrame(columns=list(data.columns))
+    lead_positions = np.flatnonzero(data["#variant"].isin(lead_vars).values)
+    clumper = GreedyClumper(data, lead_positions, columns["pval"])
+    cs_codes, _ = pd.factorize(clumper.pool["cs_id"])
+    cs_order = np.argsort(cs_codes, kind="mergesort")
+    cs_starts = np.searchsorted(cs_codes[cs_order], np.arange(cs_codes.max()+2))
+    #r2 from the credible set data. If it is not available, it is filled from the LD data
+    cs_r2 = clumper.pool["r2_to_lead"].values.astype(float)
+    wipe_credset_data = ["cs_prob",
+        "cs_min_r2",
+        "cs_log10bf",
+        "good_cs",
+        "cs_region",
+        "cs_size",
+        "cs_id"]
 
-    while not leads.empty:
-        lead_var_row = leads.loc[leads[columns["pval"]].idxmin(),: ]
-        lead_variant = lead_var_row["#variant"] #choose the lead variant with smallest p-value
-        cs_id = lead_var_row["cs_id"]
-        #get ld threshold
-        group_ld_threshold = ld_threshold
-        if dynamic_r2:
-            lead_pval = lead_var_row[columns["pval"]]
-            group_ld_threshold = min(ld_threshold/stats.chi2.isf(lead_pval,df=1),1.0)
-        #get LD data to cs lead
-        ld_data = ld_api.get_range(Variant(lead_var_row[columns["chrom"]], lead_var_row[columns["pos"]], lead_var_row[columns["ref"]], lead_var_row[columns["alt"]]), locus_range, group_ld_threshold)
-        flat_ld = [a.to_flat() for a in ld_data]
-        ld_df = pd.DataFrame(flat_ld, columns=['chrom1','pos1','ref1','alt1','chrom2','pos2','ref2','alt2','r2'])
-        ld_df = ld_df.rename(columns={"r2":"r2_to_lead"})
-        if not ld_df.empty:
-            ld_df['variant1']=create_variant_column(ld_df,'chrom1','pos1','ref1','alt1')
-            ld_df['#variant']=create_variant_column(ld_df,'chrom2','pos2','ref2','alt2')
-            ld_df = ld_df.drop(columns=["chrom1","pos1","chrom2","pos2","ref1","ref2","alt1","alt2"])
-            ld_df = ld_df[ld_df["variant1"]==lead_variant]
-            #merged_df = pd.merge(df, ld_df[["#variant","r2_to_lead"]], how="inner",on="#variant")
-        else:
-            #empty df, 
-            ld_df = pd.DataFrame(columns=["#variant","variant1","r2_to_lead"])
-        #separate credible set. It is deliberately taken from the not mutated 'data'-dataframe, so that even if those variants were grouped somewhere before, they are still included.
-        cs = data.loc[data["cs_id"]==cs_id,:].copy()
-        #fill r2 from the ld data if it's not all in the cs data
-        cs_group = cs.merge(ld_df,on="#variant",how="left",suffixes = ("","_right"))#contains all variants of this CS, even though LD might be smaller than ld threshold
-        cs_group["r2_to_lead"]=cs_group["r2_to_lead"].fillna(cs_group["r2_to_lead_right"])
-        cs_group = cs_group.drop(columns=["r2_to_lead_right"])
-
-        #get LD partners
-        ld_partners = df.merge(ld_df[["#variant","r2_to_lead"]], on="#variant",how="inner",suffixes = ("_old",""))
-        ld_partners = ld_partners.loc[ld_partners["cs_id"]!= cs_id,:]
-        #fill with right
-        ld_partners = ld_partners.drop(columns=["r2_to_lead_old"])
-        #filter out the variants in the current credible set
-        #remove credset data from LD partner variants
-        wipe_credset_data = ["cs_prob",
-            "cs_min_r2",
-            "cs_log10bf",
-            "good_cs",
-            "cs_region",
-            "cs_size",
-            "cs_id"]
-        for col in wipe_credset_data:
-            ld_partners[col] = np.nan
-        group=pd.concat([cs_group,ld_partners],ignore_index=True,sort=False).sort_values(by=["cs_id","#variant","r2_to_lead"]).drop_duplicates(subset=["#variant"],keep="first")
-        group["locus_id"]=lead_variant
-        group["pos_rmin"]=group[columns["pos"]].min()
-        group["pos_rmax"]=group[columns["pos"]].max()
-        out_df=pd.concat([out_df,group],ignore_index=True,axis=0,join='inner')
-        
-        #convergence: remove lead_variant, remove group from df if overlap is not true
-        leads=leads[~ (leads["#variant"] == lead_variant) ]
-        if not overlap:
-            df=df[~df["#variant"].isin(ld_partners["#variant"])]
-            df=df[~(df["cs_id"]==cs_id)]
-        
-    return out_df
+    with LDPrefetcher(ld_api, locus_range, ld_api.prefetch_depth) as prefetcher:
+        while True:
+            lead_pos = clumper.pop_lead()
+            if lead_pos is None:
+                break
+            lead_var_row = clumper.pool.iloc[lead_pos]
+            lead_variant = lead_var_row["#variant"] #choose the lead variant with smallest p-value
+            cs_code = cs_codes[lead_pos]
+            lead_query, group_ld_threshold = lead_ld_query(lead_var_row, dynamic_r2, ld_threshold, columns)
+            prefetch_leads(prefetcher, clumper, dynamic_r2, ld_threshold, columns)
+            #get LD data to cs lead
+            ld_data = prefetcher.get(lead_pos, lead_query, group_ld_threshold)
+            partner_codes, partner_r2 = lead_ld_partners(ld_data, lead_variant, clumper)
+            r2_by_code = pd.Series(partner_r2, index=partner_codes)
+            #separate credible set. It is deliberately taken from all of the data, so that even if those variants were grouped somewhere before, they are still included.
+            if cs_code >= 0:
+                group_cs_rows = cs_order[cs_starts[cs_code]:cs_starts[cs_code+1]]
+            else:
+                group_cs_rows = np.zeros(0, dtype=np.int64)
+            group_cs_r2 = cs_r2[group_cs_rows]
+            fill = np.isnan(group_cs_r2) & np.isin(clumper.codes[group_cs_rows], partner_codes)
+            group_cs_r2[fill] = r2_by_code.loc[clumper.codes[group_cs_rows][fill]].values
+            #get LD partners: remaining variants that are not in this credible set
+            partner_rows = clumper.rows_of(partner_codes)
+            partner_rows = partner_rows[~clumper.claimed[partner_rows]]
+            if cs_code >= 0:
+                partner_rows = partner_rows[cs_codes[partner_rows] != cs_code]
+            partner_row_codes = clumper.codes[partner_rows]
+            #each variant is included once, credible set rows first. Both parts are ordered by variant id.
+            group_order = np.lexsort((np.where(np.isnan(group_cs_r2),np.inf,group_cs_r2), clumper.codes[group_cs_rows]))
+            group_cs_rows, group_cs_r2 = group_cs_rows[group_order], group_cs_r2[group_order]
+            _, first = np.unique(partner_row_codes, return_index=True)
+            unique_partners = partner_rows[first]
+            unique_partners = unique_partners[~np.isin(clumper.codes[unique_partners], clumper.codes[group_cs_rows])]
+            group_rows = np.concatenate([group_cs_rows, unique_partners])
+            group_r2 = np.concatenate([group_cs_r2, r2_by_code.loc[clumper.codes[unique_partners]].values])
+            wipe = np.concatenate([np.zeros(group_cs_rows.shape[0],dtype=bool), np.ones(unique_partners.shape[0],dtype=bool)])
+            clumper.add_group(lead_pos, group_rows, group_r2, wipe)
+
+            #convergence: remove lead_variant, remove group from df if overlap is not true
+            clumper.retire(np.array([clumper.codes[lead_pos]]))
+            if not overlap:
+                clumper.claim(clumper.rows_of(partner_row_codes))
+                clumper.claim(group_cs_rows)
+    return clumper.build(out_df, columns["pos"], wipe_credset_data)
+
+
+#grouping function and its other arguments in a worker process of group_by_chromosome, set once per worker by _init_group_worker
+_group_worker = {}
 
+def _init_group_worker(group_fn, kwargs: Dict[str, Any]) -> None:
+    """Set the grouping function and its other arguments of a worker process, so that the tasks only carry the dataframes of a chromosome
+    """
+    _group_worker["fn"] = group_fn
+    _group_worker["kwargs"] = kwargs
+
+def _group_shard(frames: Dict[str, pd.DataFrame]) -> Tuple[pd.DataFrame, int]:
+    """Group one chromosome in a worker process. Returns the groups and the number of LD panel misses of the worker's LD backend during the grouping.
+    """
+    kwargs = _group_worker["kwargs"]
+    misses = getattr(kwargs.get("ld_api"), "panel_misses", 0)
+    out = _group_worker["fn"](**frames, **kwargs)
+    return (out, getattr(kwargs.get("ld_api"), "panel_misses", 0) - misses)
+
+def group_by_chromosome(group_fn, frames: Dict[str, pd.DataFrame], kwargs: Dict[str, Any], workers: int, columns: Dict[str, str]) -> pd.DataFrame:
+    """Run a grouping function separately for each chromosome on a pool of worker processes
+    Groups never cross chromosomes, so the results are the same as grouping all of the chromosomes at once. 
+    Args:
+        group_fn: grouping function, e.g. ld_grouping
+        frames (Dict[str, pd.DataFrame]): The dataframe arguments of the grouping function, which are split by chromosome. The chromosomes are taken from the first one.
+        kwargs (Dict[str, Any]): Other arguments of the grouping function, passed once to each worker. If there is an ld_api, every worker gets its own partition of it.
+        workers (int): Number of worker processes
+        columns (Dict[str,str]): column dictionary
+    Returns:
+        (pd.DataFrame): The groups of all chromosomes, in chromosome order
+    """
+    first = next(iter(frames.values()))
+    chroms = sorted(first[columns["chrom"]].astype(str).unique(), key=lambda c: (len(c), c))
+    workers = max(min(workers, len(chroms)), 1)
+    shard_kwargs = dict(kwargs)
+    ld_api = kwargs.get("ld_api")
+    if ld_api is not None:
+        shard_kwargs["ld_api"] = ld_api.partition(workers)
+    tasks = [
+        {name: df.loc[df[columns["chrom"]].astype(str) == chrom,:] for name, df in frames.items()}
+        for chrom in chroms
+    ]
+    with Pool(workers, initializer=_init_group_worker, initargs=(group_fn, shard_kwargs)) as pool:
+        results = pool.map(_group_shard, tasks)
+    if ld_api is not None and hasattr(ld_api, "panel_misses"):
+        ld_api.panel_misses += sum([a[1] for a in results])
+    if not results:
+        return group_fn(**frames, **kwargs)
+    return pd.concat([a[0] for a in results], ignore_index=True, axis=0, sort=False)
+
+def run_grouping(group_fn, frames: Dict[str, pd.DataFrame], kwargs: Dict[str, Any], workers: int, columns: Dict[str, str]) -> pd.DataFrame:
+    """Run a grouping function, per chromosome in worker processes if workers > 1
+    """
+    if workers > 1:
+        return group_by_chromosome(group_fn, frames, kwargs, workers, columns)
+    return group_fn(**frames, **kwargs)
 
 def extract_cols(df: pd.DataFrame, cols: List[str])-> pd.DataFrame:
     """Extract columns from a dataframe
@@ -296,7 +649,8 @@ def fetch_gws(gws_fpath: str,
                 ld_api: LDAccess, 
                 extra_cols: List[str],
                 pheno_name: str,
-                pheno_data_file :str):
+                pheno_data_file :str,
+                fetch_workers: int=1):
     """Filter and group variants.
     Args:
         gws_fpath (str): summary statistic filename
@@ -315,17 +669,23 @@ def fetch_gws(gws_fpath: str,
         extra_cols (List[str]): Extra columns to include in results
         pheno_name (str): Phenotype name
         pheno_data_file (str): Phenotype info file
+        fetch_workers (int): Number of worker processes for grouping. If more than 1, the chromosomes are grouped in parallel.
     Returns:
         (pd.DataFrame): Filtered and grouped variants
     """
     locus_width_bp = locus_width*1000
     if ignore_region:
         ignore_region_=parse_region(ignore_region)
+        #the data is filtered after chromosome X is renamed to 23
+        if ignore_region_["chrom"] == "X":
+            ignore_region_["chrom"] = "23"
     if group and grouping_method == "cred":
         if not cred_set_data:
             raise Exception("--credible-set-file not specified")
-        cs_data = cred_set_data.get_cs()
-        cs_df = cs_to_df(cs_data,columns)
+        if ignore_region:
+            cs_df = cs_to_df(cred_set_data.get_cs_in_regions(region_complement(ignore_region_)),columns)
+        else:
+            cs_df = cred_set_data.get_cs_df(columns)
         #cs df X->23
         cs_df = df_replace_value(cs_df,columns["chrom"],"X","23")
         cs_df = df_replace_value(cs_df,"cs_id",r'^chrX(.*)',r'chr23\1',regex=True)
@@ -383,14 +743,17 @@ def fetch_gws(gws_fpath: str,
         not_grouped_data.loc[:,"pos_rmax"]=not_grouped_data.loc[:,columns["pos"]]
         not_grouped_data.loc[:,"pos_rmin"]=not_grouped_data.loc[:,columns["pos"]]
         #group, sort data
-        grouped_data = credible_grouping(
-            data=not_grouped_data,
-            dynamic_r2=dynamic_r2,
-            ld_threshold=ld_r2,
-            locus_range=locus_width_bp,
-            overlap=overlap,
-            ld_api=ld_api,
-            columns=columns)
+        grouped_data = run_grouping(
+            credible_grouping,
+            {"data":not_grouped_data},
+            {"dynamic_r2":dynamic_r2,
+            "ld_threshold":ld_r2,
+            "locus_range":locus_width_bp,
+            "overlap":overlap,
+            "ld_api":ld_api,
+            "columns":columns},
+            fetch_workers,
+            columns)
         retval = grouped_data.sort_values(["locus_id","#variant"])
         
     else:
@@ -416,8 +779,10 @@ def fetch_gws(gws_fpath: str,
         #data input: get credible set variants
         join_cols=[columns["chrom"], columns["pos"], columns["ref"], columns["alt"]]
         if cred_set_data:
-            cs_data = cred_set_data.get_cs()
-            cs_df = cs_to_df(cs_data,columns)
+            if ignore_region:
+                cs_df = cs_to_df(cred_set_data.get_cs_in_regions(region_complement(ignore_region_)),columns)
+            else:
+                cs_df = cred_set_data.get_cs_df(columns)
         else:
             cs_df=pd.DataFrame(columns=join_cols+["cs_prob","cs_id","cs_region"])
         cs_df = df_replace_value(cs_df,columns["chrom"],"X","23")
@@ -441,18 +806,42 @@ def fetch_gws(gws_fpath: str,
         #grouping
         if group:
             if grouping_method=="ld":
-                new_df=ld_grouping(
-                    df_p1=df_p1,
-                    df_p2=df_p2,
-                    locus_range=locus_width_bp,
-                    dynamic_r2 = dynamic_r2,
-                    ld_threshold=ld_r2,
-                    overlap=overlap,
-                    ld_api=ld_api,
-                    columns=columns
+                new_df=run_grouping(
+                    ld_grouping,
+                    {"df_p1":df_p1,"df_p2":df_p2},
+                    {"locus_range":locus_width_bp,
+                    "dynamic_r2":dynamic_r2,
+                    "ld_threshold":ld_r2,
+                    "overlap":overlap,
+                    "ld_api":ld_api,
+                    "columns":columns},
+                    fetch_workers,
+                    columns
+                )
+            elif grouping_method=="plink_clump":
+                if dynamic_r2:
+                    raise ValueError("Grouping method plink_clump does not support --dynamic-r2-chisq.")
+                new_df=run_grouping(
+                    plink_clump_grouping,
+                    {"df_p1":df_p1,"df_p2":df_p2},
+                    {"sig_tresh_1":sig_tresh_1,
+                    "sig_tresh_2":sig_tresh_2,
+                    "locus_range":locus_width_bp,
+                    "ld_threshold":ld_r2,
+                    "overlap":overlap,
+                    "ld_api":ld_api,
+                    "columns":columns},
+                    fetch_workers,
+                    columns
                 )
             else :
-                new_df=simple_grouping(df_p1=df_p1,df_p2=df_p2,r=locus_width_bp,overlap=overlap,columns=columns)
+                new_df=run_grouping(
+                    simple_grouping,
+                    {"df_p1":df_p1,"df_p2":df_p2},
+                    {"r":locus_width_bp,"overlap":overlap,"columns":columns},
+                    fetch_workers,
+                    columns
+                )
                 new_df["r2_to_lead"]=np.nan
             new_df=new_df.sort_values(["locus_id","#variant"])
             retval = new_df
@@ -488,7 +877,7 @@ if __name__=="__main__":
     parser.add_argument("--prefix",dest="prefix",type=str,default="",help="output and temporary file prefix. Default value is the base name (no path and no file extensions) of input file. ")
     parser.add_argument("--fetch-out",dest="fetch_out",type=str,default="fetch_out.tsv",help="GWS output filename, default is fetch_out.tsv")
     parser.add_argument("--group", dest="grouping",action='store_true',help="Whether to group SNPs")
-    parser.add_argument("--grouping-method",dest="grouping_method",type=str,default="simple",help="Decide grouping method, options ['ld','simple','cred']")
+    parser.add_argument("--grouping-method",dest="grouping_method",type=str,default="simple",help="Decide grouping method, options ['ld','simple','cred','plink_clump']")
     parser.add_argument("--locus-width-kb",dest="loc_width",type=int,default=250,help="locus width to include for each SNP, in kb")
     parser.add_argument("--alt-sign-treshold",dest="sig_treshold_2",type=float, default=5e-8,help="optional group treshold")
     parser.add_argument("--ld-panel-path",dest="ld_panel_path",type=str,help="Filename to the genotype data for ld calculation, without suffix")
@@ -498,12 +887,15 @@ if __name__=="__main__":
     r2_group.add_argument("--dynamic-r2-chisq",type=float,nargs="?",const=5.0,default=None,help="If flag is passed, r2 threshold is set per peak so that leadvar_chisq*r2=value (default 5).")
     
     parser.add_argument("--plink-memory", dest="plink_mem", type=int, default=12000, help="plink memory for ld clumping, in MB")
+    parser.add_argument("--plink-threads", dest="plink_threads", type=int, default=1, help="Maximum number of concurrent plink processes for LD calculation. The plink memory is divided between them. In ld and cred grouping, LD of up to PLINK_THREADS-1 upcoming lead variants is calculated in the background. Default 1")
     parser.add_argument("--overlap",dest="overlap",action="store_true",help="Are groups allowed to overlap")
     parser.add_argument("--column-labels",dest="column_labels",metavar=("CHROM","POS","REF","ALT","PVAL"),nargs=5,default=["#chrom","pos","ref","alt","pval","beta","maf","maf_cases","maf_controls"],help="Names for data file columns. Default is '#chrom pos ref alt pval beta maf maf_cases maf_controls'.")
     parser.add_argument("--extra-cols",dest="extra_cols",nargs="*",default=[],help="extra columns in the summary statistic you want to add to the results")
     parser.add_argument("--ignore-region",dest="ignore_region",type=str,default="",help="Ignore the given region, e.g. HLA region, from analysis. Give in CHROM:BPSTART-BPEND format.")
     parser.add_argument("--credible-set-file",dest="cred_set_file",type=str,default="",help="bgzipped SuSiE credible set file.")
     parser.add_argument("--ld-api",dest="ld_api_choice",type=str,default="plink",help="LD interface to use. Valid options are 'plink' and 'online'.")
+    parser.add_argument("--ld-prefetch",dest="ld_prefetch",type=int,default=4,help="Number of upcoming lead variants whose LD is fetched in the background when using the online LD api. Default 4")
+    parser.add_argument("--fetch-workers",dest="fetch_workers",type=int,default=1,help="Number of worker processes for grouping. If more than 1, chromosomes are grouped in parallel, each worker with its own LD backend. Default 1")
     parser.add_argument("--pheno-name",dest="pheno_name",type=str,default="",help="Phenotype name")
     parser.add_argument("--pheno-info-file",dest="pheno_info_file",type=str,default="",help="Phenotype information file path")
     args=parser.parse_args()
@@ -514,9 +906,9 @@ if __name__=="__main__":
     #ld api loading
     ld_api=None
     if args.ld_api_choice == "plink":
-        ld_api = PlinkLD(args.ld_panel_path,args.plink_mem)
+        ld_api = PlinkLD(args.ld_panel_path,args.plink_mem,args.plink_threads)
     elif args.ld_api_choice == "online":
-        ld_api = OnlineLD("http://api.finngen.fi/api/ld")
+        ld_api = OnlineLD("http://api.finngen.fi/api/ld",prefetch_depth=args.ld_prefetch)
     else:
         raise ValueError("Wrong argument for --ld-api:{}".format(args.ld_api_choice)) 
     #cs access object loading
@@ -550,6 +942,9 @@ if __name__=="__main__":
         ld_api=ld_api,
         extra_cols=args.extra_cols,
         pheno_name=args.pheno_name,
-        pheno_data_file =args.pheno_info_file
+        pheno_data_file =args.pheno_info_file,
+        fetch_workers=args.fetch_workers
     )
+    if isinstance(ld_api, PlinkLD) and ld_api.panel_index is not None:
+        print("Skipped {} LD calculations for lead variants not in the LD panel".format(ld_api.panel_misses))
     fetch_df.fillna("NA").replace("","NA").to_csv(path_or_buf=args.fetch_out,sep="\t",index=False,float_format="%.3g")
@@ -25,14 +25,20 @@ def main(args):
                                                     args.gwascatalog_pad,
                                                     args.gwascatalog_pval,
                                                     args.gwascatalog_threads,
-                                                    args.allele_db_file)
+                                                    args.allele_db_file,
+                                                    args.gwascatalog_cache_dir,
+                                                    args.gwascatalog_cache_ttl*86400 if args.gwascatalog_cache_ttl else None,
+                                                    args.gwascatalog_cache_max_size*2**20 if args.gwascatalog_cache_max_size else None,
+                                                    args.db_timeout,
+                                                    args.gwascatalog_mirror,
+                                                    args.gwascatalog_mirror_max_age*86400 if args.gwascatalog_mirror_max_age else None)
 
     ld_api=None
     if args.grouping_method != "simple":
         if args.ld_api_choice == "plink":
-            ld_api = PlinkLD(args.ld_panel_path,args.plink_mem)
+            ld_api = PlinkLD(args.ld_panel_path,args.plink_mem,args.plink_threads)
         elif args.ld_api_choice == "online":
-            ld_api = OnlineLD(url="http://api.finngen.fi/api/ld")
+            ld_api = OnlineLD(url="http://api.finngen.fi/api/ld",prefetch_depth=args.ld_prefetch)
         else:
             raise ValueError("Wrong argument for --ld-api:{}".format(args.ld_api_choice))
     
@@ -71,8 +77,11 @@ def main(args):
         ld_api=ld_api,
         extra_cols=args.extra_cols,
         pheno_name=args.pheno_name,
-        pheno_data_file =args.pheno_info_file
+        pheno_data_file =args.pheno_info_file,
+        fetch_workers=args.fetch_workers
     )
+    if isinstance(ld_api, PlinkLD) and ld_api.panel_index is not None:
+        print("Skipped {} LD calculations for lead variants not in the LD panel".format(ld_api.panel_misses))
     
     #write fetch_df as a file, so that other parts of the script work
     if type(fetch_df) != type(None):
@@ -108,7 +117,7 @@ def main(args):
     print("Compare results to previous findings")
     [report_df,ld_out_df] = compare.compare(annotate_df, ld_check=args.ld_check,
                                     plink_mem=args.plink_mem, ld_panel_path=args.ld_panel_path, prefix=args.prefix,
-                                    ldstore_threads=args.ldstore_threads, ld_threshold=args.ld_threshold, cache_gwas=args.cache_gwas, columns=columns,
+                                    ldstore_threads=args.ldstore_threads, ld_threshold=args.ld_threshold, columns=columns,
                                     association_db=assoc_db)
 
     if type(report_df) != type(None):
@@ -131,7 +140,7 @@ if __name__=="__main__":
     parser.add_argument("--prefix",dest="prefix",type=str,default="",help="output and temporary file prefix")
     parser.add_argument("--fetch-out",dest="fetch_out",type=str,default="fetch_out.tsv",help="GWS output filename, default is fetch_out.tsv")
     parser.add_argument("--group", dest="grouping",action='store_true',help="Whether to group SNPs")
-    parser.add_argument("--grouping-method",dest="grouping_method",type=str,default="simple",help="Decide grouping method, simple or ld, default simple")
+    parser.add_argument("--grouping-method",dest="grouping_method",type=str,default="simple",help="Decide grouping method, simple, ld, cred or plink_clump, default simple")
     parser.add_argument("--locus-width-kb",dest="loc_width",type=int,default=250,help="locus width to include for each SNP, in kb")
     parser.add_argument("--alt-sign-treshold",dest="sig_treshold_2",type=float, default=5e-8,help="optional group treshold")
     parser.add_argument("--ld-panel-path",dest="ld_panel_path",type=str,help="Filename to the genotype data for ld calculation, without suffix")
@@ -142,10 +151,13 @@ if __name__=="__main__":
     r2_group.add_argument("--dynamic-r2-chisq",type=float,nargs="?",const=5.0,default=None,help="If flag is passed, r2 threshold is set per peak so that leadvar_chisq*r2=value (default 5).")
     
     parser.add_argument("--plink-memory", dest="plink_mem", type=int, default=12000, help="plink memory for ld clumping, in MB")
+    parser.add_argument("--plink-threads", dest="plink_threads", type=int, default=1, help="Maximum number of concurrent plink processes for LD calculation. The plink memory is divided between them. In ld and cred grouping, LD of up to PLINK_THREADS-1 upcoming lead variants is calculated in the background. Default 1")
     parser.add_argument("--overlap",dest="overlap",action="store_true",help="Are groups allowed to overlap")
     parser.add_argument("--ignore-region",dest="ignore_region",type=str,default="",help="Ignore the given region, e.g. HLA region, from analysis. Give in CHROM:BPSTART-BPEND format.")
     parser.add_argument("--credible-set-file",dest="cred_set_file",type=str,default="",help="bgzipped SuSiE credible set file.")
     parser.add_argument("--ld-api",dest="ld_api_choice",type=str,default="plink",help="LD interface to use. Valid options are 'plink' and 'online'.")
+    parser.add_argument("--ld-prefetch",dest="ld_prefetch",type=int,default=4,help="Number of upcoming lead variants whose LD is fetched in the background when using the online LD api. Default 4")
+    parser.add_argument("--fetch-workers",dest="fetch_workers",type=int,default=1,help="Number of worker processes for grouping. If more than 1, chromosomes are grouped in parallel, each worker with its own LD backend. Default 1")
     parser.add_argument("--pheno-name",dest="pheno_name",type=str,default="",help="Phenotype name")
     parser.add_argument("--pheno-info-file",dest="pheno_info_file",type=str,default="",help="Phenotype information file path")
     parser.add_argument("--extra-cols",dest="extra_cols",nargs="*",default=[],help="extra columns in the summary statistic you want to add to the results")
@@ -170,10 +182,15 @@ if __name__=="__main__":
     parser.add_argument("--gwascatalog-threads",dest="gwascatalog_threads",type=int,default=4,help="Number of concurrent queries to GWAScatalog API. Default 4. Increase if the gwascatalog api takes too long.")
     parser.add_argument("--ldstore-threads",type=int,default=4,help="Number of threads to use with ldstore. Default 4")
     parser.add_argument("--ld-threshold",type=float,default=0.9,help="ld threshold for including ld associations in ld report")
-    parser.add_argument("--cache-gwas",action="store_true",help="save gwascatalog results into gwas_out_mapping.tsv and load them from there if it exists. Use only for testing.")
+    parser.add_argument("--gwascatalog-mirror",dest="gwascatalog_mirror",type=str,default="",help="GWAS Catalog mirror created with gwcatalog.py mirror. With --db gwas, the mirror is used in place of the GWAS Catalog api if it is fresh.")
+    parser.add_argument("--gwascatalog-mirror-max-age",dest="gwascatalog_mirror_max_age",type=float,default=30,help="Largest age of a usable GWAS Catalog mirror in days. 0 for no limit. Default 30")
+    parser.add_argument("--gwascatalog-cache-dir",dest="gwascatalog_cache_dir",type=str,default="",help="Cache GWAS Catalog api results in this directory, and reuse them for the same regions in later runs. Can be shared by several runs.")
+    parser.add_argument("--gwascatalog-cache-ttl",dest="gwascatalog_cache_ttl",type=float,default=30,help="Days after which cached GWAS Catalog results are refreshed. 0 for no limit. Default 30")
+    parser.add_argument("--gwascatalog-cache-max-size",dest="gwascatalog_cache_max_size",type=float,default=0,help="Largest size of the GWAS Catalog cache in MB. The least recently used results are removed first. 0 for no limit. Default 0")
     parser.add_argument("--local-gwascatalog",dest='localdb_path',type=str,help="Path to local GWAS Catalog file.")
-    parser.add_argument("--db",dest="database_choice",type=str,choices=['local','gwas','summary_stats'],default="gwas",help="Database to use for comparison. use 'local','gwas' or 'summary_stats'.")
-    parser.add_argument("--gwascatalog-allele-file",dest="allele_db_file",default="",help="GWAS Catalog alleles taken from here. Use dbSNP variation VCF file (current gwcat build hg38p13, b153).")
+    parser.add_argument("--db",dest="database_choice",type=str,choices=['local','gwas','summary_stats','sqlite'],default="gwas",help="Database to use for comparison. use 'local','gwas','summary_stats' or 'sqlite'. With 'sqlite', --local-gwascatalog is an SQLite association database created with gwcatalog.py sqlite.")
+    parser.add_argument("--db-timeout",dest="db_timeout",type=float,default=None,help="Time in seconds to wait for each comparison database. The databases are queried concurrently, and the associations of a database that does not answer in time are left out. Default no limit.")
+    parser.add_argument("--gwascatalog-allele-file",dest="allele_db_file",default="",help="GWAS Catalog alleles taken from here. Use dbSNP variation VCF file (current gwcat build hg38p13, b153), or an allele table created from it with gwcatalog.py alleles.")
 
     #top report creation
     parser.add_argument("--top-report-out",dest="top_report_out",type=str,default="top_report.tsv",help="Top level report filename.")
@@ -3,23 +3,36 @@ import numpy as np
 import pandas as pd
 import argparse
 from typing import NamedTuple, Optional, List
-from data_access.db import Variant, LDData, LDAccess
+from data_access.db import Variant, LDData, LDTable, LDAccess
 import data_access.linkage as linkage
 import data_access.db as db
 
-def max_r2_correlation(variant: Variant, data_variants: List[Variant], ld_data: List[LDData])->Optional[LDData]:
+def max_r2_correlation(variant: Variant, data_variants: pd.Index, ld_data: LDTable)->Optional[LDData]:
     """Get strongest r2 correlation between a locus and other loci in its region
+    Args:
+        variant (Variant): The locus variant
+        data_variants (pd.Index): Variant ids (chr{chrom}_{pos}_{ref}_{alt}) of the loci on the top report
+        ld_data (LDTable): LD data of the locus
+    Returns:
+        (Optional[LDData]): The LD pair with the strongest correlation, with the locus variant as variant1, or None if there is none
     """
+    variant_id = "chr{}_{}_{}_{}".format(variant.chrom,variant.pos,variant.ref,variant.alt)
+    ids1 = ld_data.variant_ids(1)
+    ids2 = ld_data.variant_ids(2)
     #filter to variants on the top report
-    ld_data = [a for a in ld_data if ((a.variant1 in data_variants) and (a.variant2 in data_variants))]
-    #if for some reason the variant in question is in variant2, add flipped LDData so it's not filtered away
-    ld_data.extend([LDData(a.variant2,a.variant1,a.r2) for a in ld_data])
-    #filter the LD so that 1) the first variant in pairs is the variant, and 2) exclude self-correlation(which is by definition strongest)
-    ld_data = [a for a in ld_data if ( (a.variant1 == variant) and (a.variant2 != variant) )]
-    if ld_data:
-        ld_max = max(ld_data,key=lambda x: x.r2)
-        return ld_max
-    return None
+    on_report = ids1.isin(data_variants) & ids2.isin(data_variants)
+    #the variant can be either the first or the second variant of the pair. Exclude self-correlation(which is by definition strongest)
+    forward = on_report & (ids1 == variant_id) & (ids2 != variant_id)
+    flipped = on_report & (ids2 == variant_id) & (ids1 != variant_id)
+    r2 = pd.concat([ld_data.df.loc[forward,"r2"],ld_data.df.loc[flipped,"r2"]],ignore_index=True)
+    if r2.empty:
+        return None
+    idx = int(r2.values.argmax())
+    n_forward = int(forward.sum())
+    side = 2 if idx < n_forward else 1
+    row = ld_data.df.loc[forward].iloc[idx] if idx < n_forward else ld_data.df.loc[flipped].iloc[idx-n_forward]
+    partner = Variant(str(row["chrom{}".format(side)]),int(row["pos{}".format(side)]),str(row["ref{}".format(side)]),str(row["alt{}".format(side)]))
+    return LDData(variant,partner,float(row["r2"]))
 
 
 def is_strongest_association(var: Variant, loc_id: str, pval_threshold: float, region_width: int, data: pd.DataFrame)->bool:
@@ -52,21 +65,24 @@ def main(data: pd.DataFrame, region_width: int, ld_api: LDAccess, output_fname:
     out_data["max_r2"]=0.0
     out_data["max_r2_hit"]=""
     out_data["strongest_hit"]=False
-    #create list of variants in our data
-    list_of_datavars = [Variant(str(d.chrom),int(d.pos),str(d.ref),str(d.alt)) for d in data.itertuples()]
+    #get LD for all of the loci at once, so that the LD backend can calculate them concurrently
+    list_of_variants = [Variant(str(d.chrom),int(d.pos),d.ref,d.alt) for d in data.itertuples()]
+    #create index of variants in our data
+    data_variant_ids = pd.Index(["chr{}_{}_{}_{}".format(v.chrom,v.pos,v.ref,v.alt) for v in list_of_variants])
+    list_of_ld = ld_api.get_range_tables(list_of_variants,region_width)
 
     for idx,dtuple in enumerate(data.itertuples()):
         #create easier to work with Variant from the row named tuple
-        variant = Variant(str(dtuple.chrom),int(dtuple.pos),dtuple.ref,dtuple.alt)
+        variant = list_of_variants[idx]
 
 
         r2=0.0
         max_var = ""
 
         # Part 1: calculate r2
-        ld_data = ld_api.get_range(variant,region_width)
+        ld_data = list_of_ld[idx]
 
-        ld_max = max_r2_correlation(variant,list_of_datavars,ld_data)
+        ld_max = max_r2_correlation(variant,data_variant_ids,ld_data)
 
         if ld_max:
             r2 = ld_max.r2
@@ -88,9 +104,10 @@ if __name__=="__main__":
     parser.add_argument("--region-width-kb",type=int,default=2000,help="region width in kb")
     parser.add_argument("--ld-panel-path",required=True)
     parser.add_argument("--plink-memory",type=int,default=17000)
+    parser.add_argument("--plink-threads",type=int,default=1,help="Maximum number of concurrent plink processes. The plink memory is divided between them.")
     args=parser.parse_args()
     #load prerequisites
-    ld_api = linkage.PlinkLD(args.ld_panel_path,args.plink_memory)
+    ld_api = linkage.PlinkLD(args.ld_panel_path,args.plink_memory,args.plink_threads)
     region_width_bp = args.region_width_kb*1000
     data=pd.read_csv(args.input_data,sep="\t")
     #calc & write output
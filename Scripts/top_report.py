@@ -26,6 +26,113 @@ def top_report_lead_cols(top_df: pd.DataFrame, report_df: pd.DataFrame, columns:
     return out
 
 
+def _format_values(values: pd.Series, fmt: str) -> pd.Series:
+    """Format values with a format string, e.g. '{:.3g}'. Each distinct value is formatted once, and missing values are formatted as NaN.
+    """
+    codes, uniques = pd.factorize(values)
+    formatted = np.array([fmt.format(a) for a in uniques]+[fmt.format(np.nan)],dtype=object)
+    return pd.Series(formatted[codes],index=values.index,dtype=object)
+
+def _join_by_locus(loci: pd.Index, locus: pd.Series, text: pd.Series) -> np.ndarray:
+    """Join the texts of each locus with ';', in row order. Loci without texts get an empty string.
+    """
+    if text.empty:
+        return np.full(len(loci),"",dtype=object)
+    return text.groupby(locus.values,sort=False).agg(";".join).reindex(loci).fillna("").values
+
+def aggregate_loci(df: pd.DataFrame, efo_traits: List[str], columns: Dict[str,str], grouping_method: str, significance_threshold: float, strict_ld_threshold: float) -> pd.DataFrame:
+    """Aggregate the variants of each locus to the group-level columns of the top report, with the loci in the order of their first row.
+    The strict group of a locus is its lead variant's credible set with 'cred' grouping, the variants with p-value <= significance_threshold and
+    r2 to lead >= strict_ld_threshold with 'ld' and 'plink_clump' grouping, and the variants with p-value <= significance_threshold otherwise.
+    Args:
+        df (pd.DataFrame): report dataframe, with columns locus_id, #variant, cs_id, cs_prob, r2_to_lead, trait and trait_name, and optionally functional_category and most_severe_gene
+        efo_traits (List[str]): Traits that are reported in the specific_efo_trait_associations columns
+        columns (Dict[str,str]): column names
+        grouping_method (str): grouping method
+        significance_threshold (float): p-value threshold of strict groups
+        strict_ld_threshold (float): r2 threshold of strict groups
+    Returns:
+        (pd.DataFrame): Dataframe with columns #variant (the locus id), start, end, credible_set_variants, functional_variants_strict, functional_variants_relaxed,
+            found_associations_strict, found_associations_relaxed, specific_efo_trait_associations_strict, specific_efo_trait_associations_relaxed, n_ld_partners_0_8 and n_ld_partners_0_6
+    """
+    data = df.reset_index(drop=True)
+    locus = data["locus_id"]
+    loci = pd.Index(locus.unique())
+    # The credible set of each locus is the credible set of its lead variant
+    try:
+        leads = data.loc[data["#variant"]==locus,["locus_id","cs_id"]].drop_duplicates(subset=["locus_id"],keep="first")
+    except KeyError:
+        raise Exception("lead variant not in group, results incorrect.")
+    lead_cs = leads.set_index("locus_id")["cs_id"]
+    if not loci.isin(lead_cs.index).all():
+        raise Exception("lead variant not in group, results incorrect.")
+    row_cs = locus.map(lead_cs)
+    in_cs = data["cs_id"] == row_cs
+
+    # Strict groups. The definition changes based on the grouping method.
+    if grouping_method == "cred":
+        strict = in_cs
+    elif grouping_method in ("ld","plink_clump"):
+        strict = (data[columns["pval"]]<=significance_threshold) & (data["r2_to_lead"]>=strict_ld_threshold)
+    else:
+        strict = data[columns["pval"]]<=significance_threshold
+
+    positions = data[columns["pos"]].groupby(locus.values,sort=False).agg(["min","max"]).reindex(loci)
+    r2 = _format_values(data["r2_to_lead"],"{:.3g}")
+
+    credset_vars = data.loc[strict & in_cs,["locus_id","#variant","cs_prob","r2_to_lead"]].drop_duplicates()
+    cred_set = _format_values(credset_vars["#variant"],"{}") + "|" + _format_values(credset_vars["cs_prob"],"{:.3g}") + "|" + r2[credset_vars.index]
+
+    # Functional variants in relaxed & strict groups. Try because it is possible that functional data was skipped.
+    try:
+        functional = data["functional_category"].notna()
+        col_lst = ["locus_id","#variant","functional_category","most_severe_gene","r2_to_lead"]
+        func_text = _format_values(data["#variant"],"{}") + "|" + _format_values(data["functional_category"],"{}") + "|" + _format_values(data["most_severe_gene"],"{}") + "|" + r2
+        func_idx = data.loc[functional,col_lst].drop_duplicates().index
+        func_idx_strict = data.loc[functional & strict,col_lst].drop_duplicates().index
+        func_set = _join_by_locus(loci,locus[func_idx],func_text[func_idx])
+        func_set_strict = _join_by_locus(loci,locus[func_idx_strict],func_text[func_idx_strict])
+    except Exception:
+        func_set = np.full(len(loci),"",dtype=object)
+        func_set_strict = np.full(len(loci),"",dtype=object)
+
+    # Traits of each locus, from the highest r2 to lead, once per trait
+    locus_order = pd.Series(np.arange(len(loci)),index=loci)
+    traits = data.loc[data["trait"].notna(),["locus_id","trait","trait_name","r2_to_lead"]]
+    traits = traits.assign(locus_order=traits["locus_id"].map(locus_order)).sort_values(by=["locus_order","r2_to_lead"],ascending=[True,False],kind="mergesort")
+    all_traits = traits.drop_duplicates(subset=["locus_id","trait","trait_name"],keep="first")
+    strict_traits = traits.loc[strict[traits.index],:].drop_duplicates(subset=["locus_id","trait","trait_name"],keep="first")
+    trait_text = _format_values(data["trait_name"],"{}") + "|" + r2
+    trait_cols = {}
+    for group_name, group_traits in [("relaxed",all_traits),("strict",strict_traits)]:
+        matching = group_traits["trait"].isin(efo_traits)
+        other_idx = group_traits.index[~matching.values]
+        matching_idx = group_traits.index[matching.values]
+        trait_cols["found_associations_{}".format(group_name)] = _join_by_locus(loci,locus[other_idx],trait_text[other_idx])
+        trait_cols["specific_efo_trait_associations_{}".format(group_name)] = _join_by_locus(loci,locus[matching_idx],trait_text[matching_idx])
+
+    #N ld partners with LD >0.8, LD>0.6, outside the credible set of the locus
+    other_cs = data["cs_id"] != row_cs
+    n_ld = {}
+    for name, r2_thresh in [("n_ld_partners_0_8",0.8),("n_ld_partners_0_6",0.6)]:
+        n_ld[name] = ((data["r2_to_lead"]>r2_thresh) & other_cs).groupby(locus.values,sort=False).sum().reindex(loci).values
+
+    top_level_df = pd.DataFrame({
+        "#variant":loci.values,
+        "start":positions["min"].values.astype(np.int64),
+        "end":positions["max"].values.astype(np.int64),
+        "found_associations_strict":trait_cols["found_associations_strict"],
+        "found_associations_relaxed":trait_cols["found_associations_relaxed"],
+        "credible_set_variants":_join_by_locus(loci,locus[cred_set.index],cred_set),
+        "functional_variants_strict":func_set_strict,
+        "functional_variants_relaxed":func_set,
+        "specific_efo_trait_associations_strict":trait_cols["specific_efo_trait_associations_strict"],
+        "specific_efo_trait_associations_relaxed":trait_cols["specific_efo_trait_associations_relaxed"],
+        "n_ld_partners_0_8":n_ld["n_ld_partners_0_8"],
+        "n_ld_partners_0_6":n_ld["n_ld_partners_0_6"]
+    })
+    return top_level_df
+
 def create_top_level_report(report_df,efo_traits,columns,grouping_method,significance_threshold,strict_ld_threshold, extra_cols,dynamic_r2, ld_r2_threshold):
     """
     Create a top level report from which it is easy to see which loci are novel
@@ -97,8 +204,6 @@ def create_top_level_report(report_df,efo_traits,columns,grouping_method,signifi
     if df.empty:
         return pd.DataFrame(columns=top_level_cols)
 
-    list_of_loci=list(df["locus_id"].unique())
-
     lead_var_df = df.loc[df["locus_id"]==df["#variant"],["#variant"]].drop_duplicates()
     lead_var_idx = lead_var_df.index
     #get the pheno_cols dataframe
@@ -133,85 +238,7 @@ def create_top_level_report(report_df,efo_traits,columns,grouping_method,signifi
     except:
         gnomad_info_df=pd.DataFrame(columns=gnomad_cols+["#variant"])
 
-    top_level_df=pd.DataFrame(columns=["#variant"]+aggregated_cols)
-
-    
-    for locus_id in list_of_loci:
-        # The row is a dict which will contain the aggregated values for a single group
-        row = {}
-        # Separate group variants from all variants
-        loc_variants=df.loc[df["locus_id"]==locus_id,:]
-
-        # Create strict group. The definition changes based on the grouping method.
-        try:
-            locus_cs_id = loc_variants.loc[loc_variants["#variant"] == locus_id,"cs_id"].values[0]
-        except:
-            raise Exception("lead variant not in group, results incorrect.")
-        strict_group=None
-        if grouping_method == "cred":
-            #strict group = variants in the credible set of this locus
-            strict_group = loc_variants[loc_variants["cs_id"]==locus_cs_id].copy()
-        elif grouping_method == "ld":
-            #strict group = variants that have low enough pvalue and high enough correlation with lead variant
-            strict_group = loc_variants[(loc_variants[columns["pval"]]<=significance_threshold) & (loc_variants["r2_to_lead"]>=strict_ld_threshold )].copy()
-        else:
-            #variants that have low enough pvalue
-            strict_group = loc_variants[loc_variants[columns["pval"]]<=significance_threshold].copy()
-        
-        row['#variant']=locus_id
-        row["start"]=int(np.amin(loc_variants[columns["pos"]]))
-        row["end"]=int(np.amax(loc_variants[columns["pos"]]))
-        credset_vars = strict_group.loc[strict_group["cs_id"]==locus_cs_id,["#variant","cs_prob","r2_to_lead"]].drop_duplicates()
-        cred_set=";".join( "{}|{:.3g}|{:.3g}".format(t._1,t.cs_prob,t.r2_to_lead) for t in  credset_vars.itertuples() )
-        # Get credible set variants in relazed & strict group, as well as functional variants. 
-        # Try because it is possible that functional data was skipped.
-        try:
-            col_lst = ["#variant","functional_category","most_severe_gene","r2_to_lead"]
-            func_s = loc_variants.loc[~loc_variants["functional_category"].isna(),col_lst].drop_duplicates()
-            func_set=";".join("{}|{}|{}|{:.3g}".format(t._1,t.functional_category,t.most_severe_gene,t.r2_to_lead) for t in  func_s.itertuples())
-            func_s_strict = strict_group.loc[~strict_group["functional_category"].isna(),col_lst ].drop_duplicates()
-            func_set_strict=";".join("{}|{}|{}|{:.3g}".format(t._1,t.functional_category,t.most_severe_gene,t.r2_to_lead) for t in  func_s_strict.itertuples())
-        except:
-            func_set=""
-            func_set_strict=""
-        row["credible_set_variants"]=cred_set
-        row["functional_variants_strict"]=func_set_strict
-        row["functional_variants_relaxed"]=func_set
-        # Solve traits for relaxed and strict groups.
-        all_traits=(
-                    loc_variants.loc[~loc_variants["trait"].isna(),["trait","trait_name","r2_to_lead"]]
-                    .sort_values(by="r2_to_lead",ascending=False)
-                    .drop_duplicates(subset=["trait","trait_name"], keep="first")
-                    )
-        strict_traits=(
-                    strict_group.loc[~strict_group["trait"].isna(),["trait","trait_name","r2_to_lead"]]
-                    .sort_values(by="r2_to_lead",ascending=False)
-                    .drop_duplicates(subset=["trait","trait_name"],keep="first")
-                    )
-        
-        other_traits_relaxed = all_traits[ ~all_traits["trait"].isin(efo_traits) ].copy()
-        other_traits_strict = strict_traits[ ~strict_traits["trait"].isin(efo_traits) ].copy()
-
-        row["found_associations_relaxed"]=";".join( "{}|{:.3g}".format(t.trait_name,t.r2_to_lead) for t in other_traits_relaxed.itertuples() )
-        row["found_associations_strict"]=";".join( "{}|{:.3g}".format(t.trait_name,t.r2_to_lead) for t in other_traits_strict.itertuples() )
-        
-        matching_traits_relaxed= all_traits[ all_traits["trait"].isin(efo_traits) ].copy()
-        matching_traits_strict = strict_traits[ strict_traits["trait"].isin(efo_traits) ].copy()
-        row["specific_efo_trait_associations_relaxed"]=";".join( "{}|{:.3g}".format(t.trait_name,t.r2_to_lead) for t in matching_traits_relaxed.itertuples() )
-        row["specific_efo_trait_associations_strict"]=";".join( "{}|{:.3g}".format(t.trait_name,t.r2_to_lead) for t in matching_traits_strict.itertuples() )
-        #try:
-        #    row["credible_set_min_r2_value"] = np.nanmin(credset_vars.loc[:, "r2_to_lead" ].values)
-        #except:
-        #    row["credible_set_min_r2_value"] = np.nan
-
-        #N ld partners with LD >0.8, LD>0.6
-        r2_thresh_0_8 = 0.8
-        r2_thresh_0_6 = 0.6
-        n_ld_gt_0_8 = loc_variants.loc[((loc_variants["r2_to_lead"]>r2_thresh_0_8) & (loc_variants["cs_id"]!=locus_cs_id)),"r2_to_lead"].count()
-        n_ld_gt_0_6 = loc_variants.loc[((loc_variants["r2_to_lead"]>r2_thresh_0_6) & (loc_variants["cs_id"]!=locus_cs_id)),"r2_to_lead"].count()
-        row["n_ld_partners_0_8"] = n_ld_gt_0_8
-        row["n_ld_partners_0_6"] = n_ld_gt_0_6
-        top_level_df=top_level_df.append(row,ignore_index=True)
+    top_level_df=aggregate_loci(df,efo_traits,columns,grouping_method,significance_threshold,strict_ld_threshold)
 
     #merge the different dataframes to top_level_df
     top_level_df=top_level_df.merge(pheno_info_df,on="#variant",how="left")
@@ -227,7 +254,7 @@ if __name__ == "__main__":
     parser=argparse.ArgumentParser(description="Create top report")
     parser.add_argument("report_fname",type=str,help="autoreporting report file")
     parser.add_argument("--sign-treshold",dest="sig_treshold",type=float,help="Signifigance treshold",default=5e-8)
-    parser.add_argument("--grouping-method",dest="grouping_method",type=str,default="simple",help="Decide grouping method, simple, ld or cred, default simple")
+    parser.add_argument("--grouping-method",dest="grouping_method",type=str,default="simple",help="Decide grouping method, simple, ld, cred or plink_clump, default simple")
     parser.add_argument("--column-labels",dest="column_labels",metavar=("CHROM","POS","REF","ALT","PVAL"),nargs=5,default=["#chrom","pos","ref","alt","pval"],help="Names for data file columns. Default is '#chrom pos ref alt pval'.")
     parser.add_argument("--extra-cols",dest="extra_cols",nargs="*",default=[],help="extra columns in the summary statistic you want to add to the results")
     parser.add_argument("--efo-codes",dest="efo_traits",type=str,nargs="+",default=[],help="Specific EFO codes to look for in the top level report")
@@ -0,0 +1,74 @@
+import json, threading, time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qsl
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class StandInServer(object):
+    """Local HTTP server that replays recorded responses, for testing the API clients without network access.
+    The responses are a list of dicts with keys 'path', 'params', 'status' and 'body'. A request is answered with the
+    first response that has the same path and query parameters, or with 404 if none match.
+    Optional keys: 'count', the number of requests a response answers before it is skipped, 'delay', seconds to wait before answering, and 'headers', a dict of extra response headers.
+    Received requests are stored in requests as (path, params) tuples, and the largest number of requests answered at the same time in max_active.
+    Use as a context manager, the base url of the server is in url.
+    """
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                params = dict(parse_qsl(parsed.query))
+                status, body, delay, headers = 404, "", 0, {}
+                with server.lock:
+                    server.requests.append((parsed.path, params))
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                    for r in server.responses:
+                        if r["path"] == parsed.path and {k: str(v) for k, v in r["params"].items()} == params and r.get("count", 1) > 0:
+                            if "count" in r:
+                                r["count"] -= 1
+                            status = r["status"]
+                            body = r["body"] if isinstance(r["body"], str) else json.dumps(r["body"])
+                            delay = r.get("delay", 0)
+                            headers = r.get("headers", {})
+                            break
+                time.sleep(delay)
+                with server.lock:
+                    server.active -= 1
+                data = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                return
+
+        self.httpd = _ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}".format(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @classmethod
+    def from_file(cls, fname):
+        with open(fname, "r") as f:
+            return cls(json.load(f))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
@@ -1,6 +1,6 @@
 import unittest
 import unittest.mock as mock
-import sys,os,json, requests
+import sys,os,json,tempfile, requests
 import pandas as pd
 sys.path.append("../")
 sys.path.append("./")
@@ -73,4 +73,57 @@ class TestAlleleDB(unittest.TestCase):
         self.assertEqual(no_alleles,no_all_ver)
         self.assertEqual(biallelic,biallelic_ver)
         self.assertEqual(multiallelic,multiallelic_ver)
-        self.assertEqual(manyvars,manyvar_ver)
\ No newline at end of file
+        self.assertEqual(manyvars,manyvar_ver)
+
+    def test_vcf_get_allele_table(self):
+        """Test that nearby positions are read with one fetch, and that only variants at the queried positions are returned, sorted and once
+        """
+        filename = "testing/db_resources/test_vcf.vcf.gz"
+        db = alleledb.VCFAlleleDB(filename,max_gap=200)
+        positions = pd.DataFrame({
+            "chrom":["1","1","1","1","1"],
+            "pos":[10169,10039,10,10039,10019]
+        })
+        with mock.patch.object(alleledb.tabix_pool,"fetch",wraps=alleledb.tabix_pool.fetch) as fetch:
+            out = db.get_allele_table(positions)
+        self.assertEqual([a[0][2:] for a in fetch.call_args_list],[(9,10),(10018,10169)])
+        validate = pd.DataFrame({
+            "chrom":["1","1","1"],
+            "pos":[10019,10039,10169],
+            "ref":["TA","A","T"],
+            "alt":["T","C","C,G"],
+            "rsid":[775809821,978760828,1456517851]
+        })
+        pd.testing.assert_frame_equal(out,validate)
+
+    def test_allele_table(self):
+        """Test that an allele table contains the GWAS Catalog variants of the vcf, and that it returns the same alleles as the vcf
+        """
+        vcf = "testing/db_resources/test_vcf.vcf.gz"
+        catalog = pd.DataFrame({
+            "SNP_ID_CURRENT": ["978760828","1456517851","775809821","1"],
+            "CHR_ID":["1","1","1","1"],
+            "CHR_POS":["10039","10169","10019","10043"],
+            "P-VALUE":[1e-10,1e-10,1e-10,1e-10],
+            "PVALUE_MLOG":[10.,10.,10.,10.],
+            "MAPPED_TRAIT":["A","B","C","D"],
+            "MAPPED_TRAIT_URI":["http://efo/A","http://efo/B","http://efo/C","http://efo/D"],
+            "LINK":["link","link","link","link"],
+            "STUDY":["study","study","study","study"]
+        })
+        positions = pd.DataFrame({"chrom":["1","1","1","2","1"],"pos":[10169,10039,10043,10039,10039]})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            catalog_path = os.path.join(tmp_dir,"gwcat.tsv")
+            table_path = os.path.join(tmp_dir,"alleles")
+            catalog.to_csv(catalog_path,sep="\t",index=False)
+            self.assertEqual(alleledb.create_allele_table(catalog_path,vcf,table_path),3)
+            db = alleledb.open_alleledb(table_path)
+            self.assertIsInstance(db,alleledb.TableAlleleDB)
+            self.assertIsInstance(alleledb.open_alleledb(vcf),alleledb.VCFAlleleDB)
+            out = db.get_allele_table(positions)
+            alleles = db.get_alleles([Location("1",10169)])
+        validate = alleledb.VCFAlleleDB(vcf).get_allele_table(positions)
+        #the variant at 10043 is not a GWAS Catalog variant
+        validate = validate.loc[validate["pos"] != 10043,:].reset_index(drop=True)
+        pd.testing.assert_frame_equal(out,validate)
+        self.assertEqual(alleles,[VariantData(Variant("1",10169,"T","C"),["G"],1456517851)])
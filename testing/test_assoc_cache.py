@@ -0,0 +1,97 @@
+import unittest
+import sys,os,tempfile
+import unittest.mock as mock
+import pandas as pd
+sys.path.append("../")
+sys.path.append("./")
+sys.path.insert(0, './Scripts')
+from Scripts.data_access import assoc_cache
+from Scripts.data_access.db import ExtDB, association_table
+from Scripts.autoreporting_utils import Region
+
+class GridDB(ExtDB):
+    """Association database with an association at every 50th position, recording the queried regions
+    """
+    def __init__(self, pval_threshold, padding):
+        self.pval_threshold = pval_threshold
+        self.pad = padding
+        self.queries = []
+
+    def associations_for_regions(self, regions):
+        self.queries.append(list(regions))
+        rows = []
+        for region in regions:
+            start = max(0, region.start - self.pad)
+            for pos in range(start + (-start) % 50, region.end + self.pad + 1, 50):
+                rows.append({"chrom":region.chrom,"pos":pos,"ref":"A","alt":"C","rsid":pos,"pval":self.pval_threshold/2,
+                    "trait":"EFO_{}".format(pos),"trait_name":None,"study":"study","study_link":"link"})
+        return association_table(pd.DataFrame(rows)) if rows else association_table()
+
+class TestAssocCache(unittest.TestCase):
+
+    def test_subtract_regions(self):
+        covered = [Region("1",100,200),Region("1",301,400)]
+        out = assoc_cache.subtract_regions([Region("1",50,350),Region("1",340,500),Region("2",1,10)],covered)
+        self.assertEqual(out,[Region("1",50,99),Region("1",201,300),Region("1",401,500),Region("2",1,10)])
+        self.assertEqual(assoc_cache.subtract_regions([Region("1",120,180)],covered),[])
+
+    def test_missing_regions(self):
+        """Test that only the regions that are not cached are queried, and that the results equal the uncached results
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = GridDB(1e-5,20)
+            cached = assoc_cache.CachedDB(db,tmp_dir)
+            cached.associations_for_regions([Region("1",100,200),Region("2",100,200)])
+            out = cached.associations_for_regions([Region("1",150,300),Region("2",120,180)])
+            self.assertEqual(db.queries[1],[Region("1",201,300)])
+            validate = GridDB(1e-5,20).associations_for_regions([Region("1",150,300),Region("2",120,180)])
+            pd.testing.assert_frame_equal(out,validate.sort_values(["chrom","pos"]).reset_index(drop=True),check_dtype=False)
+            self.assertTrue(out["trait_name"].isna().all())
+            #fully cached
+            cached.associations_for_regions([Region("1",100,300)])
+            self.assertEqual(len(db.queries),2)
+            #other p-value threshold is cached separately
+            other = GridDB(1e-8,20)
+            assoc_cache.CachedDB(other,tmp_dir).associations_for_regions([Region("1",100,300)])
+            self.assertEqual(other.queries,[[Region("1",100,300)]])
+
+    def test_duplicate_rows(self):
+        """Test that rows the backend returns twice are kept, and that the rows of one query are in the order of the backend
+        """
+        class DuplicateDB(GridDB):
+            def associations_for_regions(self, regions):
+                data = super().associations_for_regions(regions)
+                return association_table(pd.concat([data,data]).iloc[::-1])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cached = assoc_cache.CachedDB(DuplicateDB(1e-5,20),tmp_dir)
+            regions = [Region("1",100,200)]
+            pd.testing.assert_frame_equal(cached.associations_for_regions(regions),DuplicateDB(1e-5,20).associations_for_regions(regions))
+            #rows of the overlapping padded regions of two entries are taken from the first entry
+            out = cached.associations_for_regions([Region("1",100,300)])
+            self.assertEqual(list(out["pos"]),[a for a in range(100,350,50) for _ in range(2)])
+
+    def test_eviction(self):
+        """Test that expired entries and entries over the size limit are removed
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = GridDB(1e-5,0)
+            cached = assoc_cache.CachedDB(db,tmp_dir,ttl=3600)
+            regions = [Region("1",100,200)]
+            with mock.patch("time.time",return_value=1000.0):
+                cached.associations_for_regions(regions)
+            with mock.patch("time.time",return_value=2000.0):
+                cached.associations_for_regions(regions)
+            self.assertEqual(len(db.queries),1)
+            with mock.patch("time.time",return_value=5000.0):
+                cached.associations_for_regions(regions)
+            self.assertEqual(len(db.queries),2)
+            self.assertEqual(len(os.listdir(os.path.join(tmp_dir,assoc_cache.ENTRY_DIR))),1)
+            #every entry is larger than the cache
+            small = assoc_cache.CachedDB(db,tmp_dir,max_size=1)
+            small.associations_for_regions(regions)
+            small.associations_for_regions(regions)
+            self.assertEqual(len(db.queries),4)
+            self.assertEqual(os.listdir(os.path.join(tmp_dir,assoc_cache.ENTRY_DIR)),[])
+
+if __name__=="__main__":
+    unittest.main()
@@ -99,7 +99,58 @@ class TestCompare(unittest.TestCase):
         for col in validate.columns:
             self.assertTrue(res[col].astype(object).equals(validate[col].astype(object)) )
         TODO"""
-    
+
+    def test_top_report_groups(self):
+        """Test the aggregated columns of the top report for credible set and ld grouping
+        """
+        nan=np.nan
+        df=pd.DataFrame({
+            "#chrom":["1"]*5+["2"]*3,
+            "pos":[100,150,200,250,300,1000,1100,1200],
+            "ref":["A"]*8,
+            "alt":["C"]*8,
+            "pval":[1e-10,1e-6,1e-9,1e-9,1e-3,1e-12,1e-9,1e-9],
+            "#variant":["chr1_100_A_C","chr1_150_A_C","chr1_200_A_C","chr1_200_A_C","chr1_300_A_C","chr2_1000_A_C","chr2_1100_A_C","chr2_1100_A_C"],
+            "locus_id":["chr1_100_A_C"]*5+["chr2_1000_A_C"]*3,
+            "cs_id":[1,1,1,1,nan,2,3,3],
+            "cs_prob":[0.5,0.2,0.1,0.1,nan,0.9,0.05,0.05],
+            "r2_to_lead":[1.0,0.95,0.7,0.7,0.65,1.0,0.85,0.85],
+            "trait":["EFO_1","EFO_2",nan,"EFO_3","EFO_2",nan,"EFO_4","EFO_1"],
+            "trait_name":["Trait 1","Trait 2",nan,"Trait 3","Trait 2",nan,"Trait 4","Trait 1"],
+            "functional_category":[nan,"pLoF",nan,nan,"missense",nan,"missense","missense"],
+            "most_severe_gene":[nan,"GENE1",nan,nan,"GENE2",nan,"GENE3","GENE3"]
+        })
+        columns={"chrom":"#chrom","pos":"pos","ref":"ref","alt":"alt","pval":"pval"}
+        relaxed = {
+            "locus_id":["chr1_100_A_C","chr2_1000_A_C"],
+            "start":[100,1000],
+            "end":[300,1200],
+            "functional_variants_relaxed":["chr1_150_A_C|pLoF|GENE1|0.95;chr1_300_A_C|missense|GENE2|0.65","chr2_1100_A_C|missense|GENE3|0.85"],
+            "found_associations_relaxed":["Trait 2|0.95;Trait 3|0.7","Trait 4|0.85"],
+            "specific_efo_trait_associations_relaxed":["Trait 1|1","Trait 1|0.85"],
+            "n_ld_partners_0_8":[0,2],
+            "n_ld_partners_0_6":[1,2]
+        }
+        strict = {
+            "cred":{
+                "credible_set_variants":["chr1_100_A_C|0.5|1;chr1_150_A_C|0.2|0.95;chr1_200_A_C|0.1|0.7","chr2_1000_A_C|0.9|1"],
+                "functional_variants_strict":["chr1_150_A_C|pLoF|GENE1|0.95",""],
+                "found_associations_strict":["Trait 2|0.95;Trait 3|0.7",""],
+                "specific_efo_trait_associations_strict":["Trait 1|1",""]
+            },
+            "ld":{
+                "credible_set_variants":["chr1_100_A_C|0.5|1","chr2_1000_A_C|0.9|1"],
+                "functional_variants_strict":["","chr2_1100_A_C|missense|GENE3|0.85"],
+                "found_associations_strict":["","Trait 4|0.85"],
+                "specific_efo_trait_associations_strict":["Trait 1|1","Trait 1|0.85"]
+            }
+        }
+        for method in ["cred","ld"]:
+            res=compare.create_top_level_report(df,["EFO_1"],columns,method,1e-8,0.8,[],False,0.1)
+            validate=dict(relaxed,**strict[method])
+            for col in validate:
+                self.assertEqual(list(res[col]),validate[col])
+
 
 if __name__=="__main__":
     unittest.main()
\ No newline at end of file
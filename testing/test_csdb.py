@@ -1,13 +1,15 @@
 import unittest
 import unittest.mock as mock
-import sys,os,json, requests
+import sys,os,json, requests, tempfile
 from tempfile import NamedTemporaryFile
 import gzip
+import pysam
 sys.path.append("../")
 sys.path.append("./")
 sys.path.insert(0, './Scripts')
 from Scripts.data_access import cs
 from Scripts.data_access.db import Variant, CSVariant, CS
+from Scripts.autoreporting_utils import Region
 
 class TestCSSummary(unittest.TestCase):
             
@@ -243,3 +245,82 @@ class TestCSFull(unittest.TestCase):
                 reader=cs.CSFullReader(snp_temp.name,cred_temp.name)
                 validation = reader.get_cs()
                 self.assertEqual([test_data],validation)
+
+    def test_get_cs_df(self):
+        """Test that variants outside credible sets are dropped, the lead is the most probable variant, and the dataframe matches the credible sets
+        """
+        cred_lines = [
+            "cs_log10bf\tcs_min_r2\tcs\tcs_size\tregion\tlow_purity",
+            "2.5\t0.8\t1\t2\tchr1:1-100\tFALSE",
+            "1.5\t0.2\t2\t1\tchr1:1-100\tTRUE",
+            "3.0\t0.9\t1\t1\tchrX:1-100\tFALSE"
+        ]
+        snp_lines = [
+            "v\tcs_specific_prob\tregion\tcs\tlead_r2",
+            "1:10:A:T\t0.4\tchr1:1-100\t1\t0.9",
+            "1:20:C:G\t0.6\tchr1:1-100\t1\t1.0",
+            "1:30:G:A\t0.1\tchr1:1-100\t-1\t0.1",
+            "1:40:T:C\t1.0\tchr1:1-100\t2\t1.0",
+            "X:50:A:G\t1.0\tchrX:1-100\t1\t1.0"
+        ]
+        columns = {"chrom":"#chrom","pos":"pos","ref":"ref","alt":"alt","pval":"pval"}
+        with NamedTemporaryFile(mode="w+b") as cred_temp, NamedTemporaryFile(mode="w+b") as snp_temp:
+            for (f, lines) in [(cred_temp, cred_lines), (snp_temp, snp_lines)]:
+                gzip_f = gzip.GzipFile(mode="wb",fileobj = f)
+                gzip_f.write(bytes("\n".join(lines)+"\n","utf-8"))
+                gzip_f.close()
+                f.seek(0)
+            reader = cs.CSFullReader(snp_temp.name,cred_temp.name)
+            credsets = reader.get_cs()
+            out = reader.get_cs_df(columns)
+        self.assertEqual(len(credsets),3)
+        self.assertEqual([a.lead for a in credsets],[Variant("1",20,"C","G"),Variant("1",40,"T","C"),Variant("X",50,"A","G")])
+        self.assertEqual([a.good_cs for a in credsets],[True,False,True])
+        self.assertEqual(list(out["cs_id"]),["chr1_20_C_G_1","chr1_20_C_G_1","chr1_40_T_C_2","chrX_50_A_G_1"])
+        self.assertEqual(list(out["pos"]),[10,20,40,50])
+        self.assertTrue(out.equals(cs.cs_to_df(list(credsets),columns)))
+
+    def test_get_cs_in_regions(self):
+        """Test that only credible sets with variants in the regions are returned, with all of their variants, with and without a tabix index
+        """
+        cred_lines = [
+            "cs_log10bf\tcs_min_r2\tcs\tcs_size\tregion\tlow_purity",
+            "2.5\t0.8\t1\t3\tchr1:1-1000\tFALSE",
+            "1.5\t0.2\t2\t1\tchr1:1-1000\tFALSE",
+            "3.0\t0.9\t1\t2\tchr1:2000-3000\tFALSE",
+            "3.0\t0.9\t1\t1\tchr2:1-1000\tFALSE"
+        ]
+        snps = [
+            ("1",100,1,0.2),("1",200,-1,0.0),("1",500,1,0.7),("1",900,1,0.1),("1",950,2,1.0),
+            ("1",2100,1,0.5),("1",2200,1,0.5),("1",2500,-1,0.0),("2",300,1,1.0)
+        ]
+        snp_lines = ["v\tchromosome\tposition\tcs_specific_prob\tregion\tcs\tlead_r2"] + [
+            f"{c}:{p}:A:T\t{c}\t{p}\t{prob}\t" + ("chr1:1-1000" if c == "1" and p < 1000 else "chr1:2000-3000" if c == "1" else "chr2:1-1000") + f"\t{n}\t1.0"
+            for (c,p,n,prob) in snps
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cred_path = os.path.join(tmp_dir,"test.cred.bgz")
+            with gzip.open(cred_path,"wt") as f:
+                f.write("\n".join(cred_lines)+"\n")
+            snp_path = os.path.join(tmp_dir,"test.snp.tsv")
+            with open(snp_path,"w") as f:
+                f.write("\n".join(snp_lines)+"\n")
+            snp_path = pysam.tabix_index(snp_path,seq_col=1,start_col=2,end_col=2,line_skip=1)
+            reader = cs.CSFullReader(snp_path,cred_path)
+            all_cs = list(reader.get_cs())
+            for regions in [[Region("1",400,600)],[Region("1",900,2150)],[Region("2",1,100),Region("3",1,100)],[Region("1",1,5000),Region("2",1,5000)]]:
+                validate = [a for a in all_cs if any([b.overlaps(Region(c.variant.chrom,c.variant.pos,c.variant.pos)) for b in regions for c in a.variants])]
+                with mock.patch("Scripts.data_access.cs.tabix_pool.fetch",wraps=cs.tabix_pool.fetch) as fetch:
+                    out = reader.get_cs_in_regions(regions)
+                self.assertTrue(fetch.called)
+                self.assertEqual(list(out),validate)
+                with mock.patch("Scripts.data_access.cs.path.isfile",return_value=False):
+                    self.assertEqual(list(reader.get_cs_in_regions(regions)),validate)
+            #wide regions are selected from the whole file
+            with mock.patch("Scripts.data_access.cs.tabix_pool.fetch",wraps=cs.tabix_pool.fetch) as fetch:
+                wide = reader.get_cs_in_regions([Region("1",1,cs.TABIX_MAX_SPAN),Region("2",2000,3000)])
+            self.assertFalse(fetch.called)
+            self.assertEqual(list(wide),all_cs[:3])
+            out = reader.get_cs_in_regions([Region("1",400,600)])
+            cs.tabix_pool.close()
+        self.assertEqual([(a.region,a.number,len(a.variants)) for a in out],[("chr1:1-1000",1,3)])
@@ -1,11 +1,13 @@
 import unittest
 import unittest.mock as mock
-import sys,os,json, requests
+import sys,os,json,threading, requests
 import pandas as pd, numpy as np
 sys.path.append("../")
 sys.path.append("./")
 sys.path.insert(0, './Scripts')
-from Scripts.data_access import custom_catalog
+from Scripts.data_access import custom_catalog, datafactory
+from Scripts.data_access.db import ASSOCIATION_COLUMNS, ExtDB, association_table
+from Scripts.autoreporting_utils import Region
 from io import StringIO
 
 def create_data() -> pd.DataFrame:
@@ -57,9 +59,45 @@ class TestCustomCat(unittest.TestCase):
             pd.testing.assert_series_equal(out[col], validation_data[col])
 
     def test_get_trait(self):
-        trait="TRAIT"
+        """Test that the trait is used as the trait name, as the custom data resource has no trait names
+        """
         catalog=create_catalog()
-        self.assertEqual(catalog._CustomCatalog__get_trait(trait),trait)
+        out = catalog.associations_for_regions([Region("1",10,20)])
+        self.assertFalse(out.empty)
+        self.assertEqual(list(out["trait_name"]),list(out["trait"]))
+
+    def test_associations_for_regions(self):
+        """Test that associations from several regions and databases are returned in one table with the association columns
+        """
+        db = datafactory.CompoundDB([create_catalog(),create_catalog()])
+        out = db.associations_for_regions([Region("1",10,20),Region("1",50,52),Region("2",10,20)])
+        self.assertEqual(list(out.columns),ASSOCIATION_COLUMNS)
+        self.assertEqual(list(out["pos"]),(list(range(10,21))+[50,51,52])*2)
+        self.assertEqual(list(out.index),list(range(28)))
+        self.assertTrue(out["rsid"].isna().all())
+        empty = db.associations_for_regions([Region("2",10,20)])
+        self.assertTrue(empty.empty)
+        self.assertEqual(list(empty.columns),ASSOCIATION_COLUMNS)
+
+    def test_compound_timeout(self):
+        """Test that the databases are queried concurrently, and that a database that does not answer in time is left out
+        """
+        release = threading.Event()
+        class BlockedDB(ExtDB):
+            def associations_for_regions(self, regions):
+                release.wait(10)
+                return association_table()
+        db = datafactory.CompoundDB([BlockedDB(),create_catalog()],timeout=0.5)
+        try:
+            out = db.associations_for_regions([Region("1",10,20)])
+            #the abandoned query does not keep the process alive
+            blocked = [a for a in threading.enumerate() if a.name == "CompoundDB-0:BlockedDB"]
+            self.assertTrue(blocked and all(a.daemon for a in blocked))
+        finally:
+            release.set()
+        self.assertEqual(list(out["pos"]),list(range(10,21)))
+        self.assertIsNone(db.latencies["0:BlockedDB"])
+        self.assertLess(db.latencies["1:CustomCatalog"],0.5)
 
 if __name__=="__main__":
     unittest.main()
\ No newline at end of file
@@ -1,6 +1,6 @@
 import unittest
 import unittest.mock as mock
-import sys,os
+import sys,os,threading,time
 sys.path.append("../")
 sys.path.append("./")
 sys.path.insert(0, './Scripts')
@@ -91,6 +91,17 @@ class TestGws(unittest.TestCase):
             self.assertTrue(validate[col].equals(retval[col]))
             
 
+    def test_region_complement(self):
+        """Test that the complement of a region covers the rest of the genome, with chromosomes 23 and X excluded together
+        """
+        out = gws_fetch.region_complement(gws_fetch.parse_region("6:100-200"))
+        self.assertIn(autils.Region("6",1,99),out)
+        self.assertIn(autils.Region("6",201,gws_fetch.MAX_POSITION),out)
+        self.assertEqual(sorted(set([a.chrom for a in out])),sorted(gws_fetch.CHROMOSOMES))
+        self.assertFalse(any([a.overlaps(autils.Region("6",100,200)) for a in out]))
+        out = gws_fetch.region_complement(gws_fetch.parse_region("X:1-200"))
+        self.assertEqual([a for a in out if a.chrom in ["23","X"]],[autils.Region("23",201,gws_fetch.MAX_POSITION),autils.Region("X",201,gws_fetch.MAX_POSITION)])
+
     def test_cred_merge(self):
         # test merging of data
         # mock: load_pysam_df
@@ -842,5 +853,169 @@ class LDGrouping(unittest.TestCase):
             msg = f"Output does not equal validation data!\n validation:\n{validation_df}\noutput:\n{out}"
             raise Exception(msg)
 
+class TestGreedyClumper(unittest.TestCase):
+
+    def test_lead_order(self):
+        """Test that leads are popped in p-value order with ties broken by row order, and that retired variants are skipped
+        """
+        pool = pd.DataFrame({
+            "#variant":["chr1_3_A_T","chr1_1_A_T","chr1_2_A_T","chr1_4_A_T","chr1_1_A_T"],
+            "pval":[1e-8,1e-9,1e-8,1e-10,1e-9]
+        })
+        clumper = gws_fetch.GreedyClumper(pool, np.arange(5), "pval")
+        self.assertEqual(clumper.pop_lead(),3)
+        self.assertEqual(clumper.peek(2),[1,4])
+        clumper.retire(clumper.codes_of(pd.Series(["chr1_1_A_T"])))
+        self.assertEqual(list(clumper.rows_of(clumper.codes_of(pd.Series(["chr1_1_A_T","chr1_3_A_T"])))),[0,1,4])
+        self.assertEqual(clumper.pop_lead(),0)
+        self.assertEqual(clumper.pop_lead(),2)
+        self.assertEqual(clumper.pop_lead(),None)
+
+class LDPrefetch(unittest.TestCase):
+
+    def test_prefetch_grouping(self):
+        """Test that grouping with prefetched LD gives the same groups as fetching LD when needed, and that LD of claimed leads is not used
+        """
+        variants = [
+            "1:10000000:1e-10",
+            "1:10500000:1e-9",
+            "1:10100000:1e-8",
+            "1:10200000:1e-8",
+            "1:10300000:1e-8",
+            "1:10400000:1e-8",
+            "1:12000000:1e-8",
+            "1:12100000:1e-8"
+        ]
+        data,c = create_loci(variants)
+        df = pd.DataFrame(data,columns=c)
+        df["locus_id"]=np.nan
+        outputs = []
+        for depth in (0,3):
+            ld_api = PosLD([Variant(a[0],a[1],"A","T") for a in data])
+            ld_api.prefetch_depth = depth
+            with mock.patch.object(ld_api,"get_range_table",wraps=ld_api.get_range_table) as range_mock:
+                outputs.append(gws_fetch.ld_grouping(df.copy(),df.copy(),dynamic_r2=False,ld_threshold=0.2,
+                    locus_range=1000000,overlap=False,ld_api=ld_api,columns=LDGrouping.cols))
+            if depth == 0:
+                self.assertEqual(range_mock.call_count,3)
+            else:
+                self.assertGreaterEqual(range_mock.call_count,3)
+        pd.testing.assert_frame_equal(outputs[0],outputs[1])
+
+    def test_prefetcher_exit(self):
+        """Test that prefetches that have not started are cancelled on exit, and that exit waits for the running ones
+        """
+        started = threading.Event()
+        release = threading.Event()
+        left = threading.Event()
+        cancelled = threading.Semaphore(0)
+        class BlockingLD(object):
+            def get_range_table(self, variant, bp_range, ld_threshold):
+                started.set()
+                release.wait(5)
+                return variant
+        futures = []
+        def group():
+            with gws_fetch.LDPrefetcher(BlockingLD(),1000,1) as prefetcher:
+                prefetcher.prefetch([(i,Variant("1",i,"A","T"),0.1) for i in range(3)])
+                futures.extend([a[1] for a in prefetcher.pending.values()])
+                for future in futures[1:]:
+                    future.add_done_callback(lambda f: cancelled.release())
+                started.wait(5)
+                left.set()
+        grouping = threading.Thread(target=group)
+        grouping.start()
+        self.assertTrue(left.wait(5))
+        for _ in futures[1:]:
+            self.assertTrue(cancelled.acquire(timeout=5))
+        self.assertTrue(all([a.cancelled() for a in futures[1:]]))
+        #the running prefetch keeps the grouping in the with block exit until it is done
+        self.assertTrue(grouping.is_alive())
+        self.assertFalse(futures[0].done())
+        release.set()
+        grouping.join(5)
+        self.assertFalse(grouping.is_alive())
+        self.assertEqual(futures[0].result(),Variant("1",0,"A","T"))
+
+class PlinkClumpGrouping(unittest.TestCase):
+
+    def test_plink_clump_grouping(self):
+        """Test that plink clumps are converted to groups, and that leads that were not clumped form groups of their own
+        """
+        ld_vars = [
+            "1:1000000:1e-10",
+            "1:1100000:1e-5",
+            "1:1200000:1e-9",
+            "2:5000000:1e-8",
+            "2:5100000:1e-6"
+        ]
+        data,c = create_loci(ld_vars)
+        data = pd.DataFrame(data,columns=c)
+        data["locus_id"]=data["#variant"]
+        data["pos_rmin"]=data["pos1"]
+        data["pos_rmax"]=data["pos1"]
+        df_p1 = data[data["pval1"]<=5e-8].copy()
+        df_p2 = data.copy()
+        clumps = pd.DataFrame({
+            "lead":["chr1_1000000_A_T","chr1_1000000_A_T","chr1_1000000_A_T","chr2_5000000_A_T"],
+            "variant":["chr1_1000000_A_T","chr1_1100000_A_T","chr1_1200000_A_T","chr2_5000000_A_T"],
+            "r2":[1.0,0.5,0.3,1.0]
+        })
+        ld_api = gws_fetch.PlinkLD("panel",1000)
+        with mock.patch.object(ld_api,"clump",return_value=clumps) as clump_mock:
+            output = gws_fetch.plink_clump_grouping(df_p1,df_p2,5e-8,1e-5,1500000,0.2,False,ld_api,LDGrouping.cols)
+        self.assertEqual(clump_mock.call_args[0][1:],(5e-8,1e-5,0.2,1500,False))
+        out = output[["#variant","locus_id","r2_to_lead","pos_rmin","pos_rmax"]].sort_values(["#variant"]).reset_index(drop=True)
+        validate = pd.DataFrame({
+            "#variant":["chr1_1000000_A_T","chr1_1100000_A_T","chr1_1200000_A_T","chr2_5000000_A_T"],
+            "locus_id":["chr1_1000000_A_T","chr1_1000000_A_T","chr1_1000000_A_T","chr2_5000000_A_T"],
+            "r2_to_lead":[1.0,0.5,0.3,1.0],
+            "pos_rmin":[1000000,1000000,1000000,5000000],
+            "pos_rmax":[1200000,1200000,1200000,5000000]
+        })
+        self.assertEqual(out.astype(str).values.tolist(),validate.astype(str).values.tolist())
+        #the groups are formed by lead significance, whatever the order of the clumps
+        with mock.patch.object(ld_api,"clump",return_value=clumps.iloc[::-1].reset_index(drop=True)):
+            output = gws_fetch.plink_clump_grouping(df_p1,df_p2,5e-8,1e-5,1500000,0.2,False,ld_api,LDGrouping.cols)
+        self.assertEqual(list(output["locus_id"].drop_duplicates()),["chr1_1000000_A_T","chr2_5000000_A_T"])
+        #without clumps, every lead is its own group
+        with mock.patch.object(ld_api,"clump",return_value=pd.DataFrame(columns=["lead","variant","r2"])):
+            output = gws_fetch.plink_clump_grouping(df_p1,df_p2,5e-8,1e-5,1500000,0.2,False,ld_api,LDGrouping.cols)
+        self.assertEqual(sorted(output["locus_id"]),["chr1_1000000_A_T","chr1_1200000_A_T","chr2_5000000_A_T"])
+
+class ChromosomeWorkers(unittest.TestCase):
+
+    def test_group_by_chromosome(self):
+        """Test that grouping chromosomes in worker processes gives the same groups as grouping them all at once
+        """
+        ld_vars = [
+            "1:1000000:1e-10",
+            "1:1100000:1e-5",
+            "1:1300000:1e-9",
+            "2:5000000:1e-8",
+            "2:5100000:1e-6",
+            "3:200000:1e-12",
+            "3:250000:1e-12"
+        ]
+        data,c = create_loci(ld_vars)
+        data = pd.DataFrame(data,columns=c)
+        data["locus_id"]=data["#variant"]
+        data["pos_rmin"]=data["pos1"]
+        data["pos_rmax"]=data["pos1"]
+        df_p1 = data[data["pval1"]<=5e-8].copy()
+        df_p2 = data.copy()
+        ld_api = PosLD([Variant(a.split(":")[0],int(a.split(":")[1]),"A","T") for a in ld_vars])
+        kwargs = {"locus_range":500000,"dynamic_r2":False,"ld_threshold":0.2,"overlap":False,"ld_api":ld_api,"columns":LDGrouping.cols}
+        frames = {"df_p1":df_p1,"df_p2":df_p2}
+        serial = gws_fetch.ld_grouping(**frames,**kwargs).sort_values(["locus_id","#variant"]).reset_index(drop=True)
+        with mock.patch.object(gws_fetch,"Pool",wraps=gws_fetch.Pool) as pool:
+            parallel = gws_fetch.group_by_chromosome(gws_fetch.ld_grouping,frames,kwargs,2,LDGrouping.cols).sort_values(["locus_id","#variant"]).reset_index(drop=True)
+        pd.testing.assert_frame_equal(serial,parallel)
+        #the LD api partition is passed once to each worker, not with every chromosome
+        initargs = pool.call_args[1]["initargs"]
+        self.assertEqual(initargs[0],gws_fetch.ld_grouping)
+        self.assertIs(initargs[1]["ld_api"],ld_api.partition(2))
+        self.assertEqual(sorted(parallel["locus_id"].unique()),["chr1_1000000_A_T","chr2_5000000_A_T","chr3_200000_A_T"])
+
 if __name__=="__main__":
     unittest.main()
\ No newline at end of file
@@ -1,14 +1,17 @@
 import unittest
 import unittest.mock as mock
-import sys,os,json, requests
-import pandas as pd
+import sys,os,json,tempfile,time, requests
+import pandas as pd, numpy as np
 from typing import List
+from email.utils import formatdate
 sys.path.append("../")
 sys.path.append("./")
 sys.path.insert(0, './Scripts')
-from Scripts.data_access import gwcatalog_api
-from Scripts.data_access.db import AlleleDB, Location, VariantData, Variant, RsidVar, Rsid
+from Scripts.data_access import gwcatalog_api, http_client, datafactory, columnar_store, assoc_cache
+from Scripts.data_access.db import AlleleDB, Location, VariantData, Variant, RsidVar, Rsid, association_table
 from Scripts.autoreporting_utils import Region
+sys.path.insert(0, './testing')
+from stand_in_server import StandInServer
 import itertools
 from io import StringIO
 
@@ -146,6 +149,31 @@ class MockAlleleDB(AlleleDB):
             )
         ]
 
+class PositionAlleleDB(AlleleDB):
+    """Allele database with an A/C variant with rsid pos+1000 at every queried position
+    """
+    def get_alleles(self, positions:List[Location]):
+        return [VariantData(Variant(a.chromosome,a.position,"A","C"),[],a.position+1000) for a in positions]
+
+def gwcat_download(chrom, positions):
+    """GWAS Catalog download response with one association at each position
+    """
+    data = pd.DataFrame({
+        "SNP_ID_CURRENT":[a+1000 for a in positions],
+        "CHR_ID":chrom,
+        "CHR_POS":positions,
+        "P-VALUE":1e-10,
+        "PVALUE_MLOG":10.0,
+        "MAPPED_TRAIT":"trait",
+        "MAPPED_TRAIT_URI":"http://efo/T1",
+        "LINK":"link",
+        "STUDY":"study"
+    })
+    return data.to_csv(sep="\t",index=False)
+
+def gwcat_query(chrom, start, end):
+    return {"q":"chromosomeName: {} AND chromosomePosition:[ {} TO {}]".format(chrom,start,end),"facet":"association","efo":"true"}
+
 class TestGwcat(unittest.TestCase):
     """Test gwcatalog api functions not relevant to a single db
     """
@@ -164,12 +192,15 @@ class TestGwcat(unittest.TestCase):
         tryurl="https://www.ebi.ac.uk/gwas/rest/api/efoTraits/{}".format(trait)
         response_mock=mock.Mock()
         response_mock.json=lambda:{"trait":trait_name}
-        with mock.patch("Scripts.data_access.gwcatalog_api.try_request",return_value = response_mock) as mock_try:
+        client_mock=mock.Mock()
+        client_mock.request=mock.Mock(return_value=response_mock)
+        with mock.patch("Scripts.data_access.gwcatalog_api.http_client.get_client",return_value = client_mock):
             return_value=gwcatalog_api.get_trait_name(trait)
         self.assertEqual(return_value,trait_name)
-        mock_try.assert_called_with("GET",url=tryurl)
+        client_mock.request.assert_called_with("GET",url=tryurl)
         #does not exist, raises exception gwcatalog_api.ResourceNotFound
-        with mock.patch("Scripts.data_access.gwcatalog_api.try_request",side_effect = gwcatalog_api.ResourceNotFound):
+        client_mock.request=mock.Mock(side_effect = gwcatalog_api.ResourceNotFound)
+        with mock.patch("Scripts.data_access.gwcatalog_api.http_client.get_client",return_value = client_mock):
             with mock.patch("Scripts.data_access.gwcatalog_api.print"):
                 return_value=gwcatalog_api.get_trait_name(trait)
         self.assertEqual("NA",return_value)
@@ -193,6 +224,13 @@ class TestGwcat(unittest.TestCase):
             retval=gwcatalog_api.parse_efo(efo)
         mock_print.assert_called_with("Invalid EFO code:{}".format(efo))
         self.assertEqual("NAN",retval)
+        #vectorised version
+        codes = pd.Series(["asd/EFO_1",123456,"http://efo/EFO_2","asd/EFO_1",None],index=[5,6,7,8,9])
+        with mock.patch("Scripts.data_access.gwcatalog_api.print") as mock_print:
+            retval=gwcatalog_api.parse_efo_codes(codes)
+        mock_print.assert_called_once()
+        self.assertEqual(list(retval.index),[5,6,7,8,9])
+        self.assertEqual(list(retval),["EFO_1","NAN","EFO_2","EFO_1","NAN"])
 
     def test_split_traits(self):
         """
@@ -212,6 +250,10 @@ class TestGwcat(unittest.TestCase):
         validationdata=pd.DataFrame({"variant":validationvar,"MAPPED_TRAIT":validationtraits,"MAPPED_TRAIT_URI":validationuris})
         data2=gwcatalog_api.split_traits(data)
         self.assertTrue(validationdata.equals(data2))
+        #traits and uris are paired in order, unpaired ones are dropped, and rows without uris are kept
+        data=pd.DataFrame({"variant":["1","2","3"],"MAPPED_TRAIT":["A, B, C","D","E, F"],"MAPPED_TRAIT_URI":["1, 2","3",None]},index=[10,20,30])
+        validationdata=pd.DataFrame({"variant":["1","1","2","3"],"MAPPED_TRAIT":["A","B","D","E, F"],"MAPPED_TRAIT_URI":["1","2","3",None]})
+        pd.testing.assert_frame_equal(gwcatalog_api.split_traits(data),validationdata)
         #faulty dataframe: no correct columns
         data=pd.DataFrame({"variant":variants,"MT":traits,"MTU":trait_uris})
         data2=gwcatalog_api.split_traits(data)
@@ -319,7 +361,100 @@ class TestLocalDB(unittest.TestCase):
             "study":"study1"
             }
         ]
-        self.assertEqual(assocs,validationdata)
+        validationdata = association_table(pd.DataFrame(validationdata))
+        pd.testing.assert_frame_equal(assocs,validationdata)
+
+    def test_snapshot(self):
+        """Test that a LocalDB loaded from a snapshot returns the same associations as one loaded from the association file, and that an up to date snapshot is not rewritten
+        """
+        data = pd.DataFrame({
+            "SNP_ID_CURRENT": ["12345","54321","90001","11111","22222"],
+            "CHR_ID":["1","1","3","3","4"],
+            "CHR_POS":["1","10","100","1;2","200"],
+            "P-VALUE":[0.1,0.1,0.1,0.1,0.1],
+            "PVALUE_MLOG":[2.,2.,2.,2.,2.],
+            "MAPPED_TRAIT":["A1","B1, B2","C1","D1","E1"],
+            "MAPPED_TRAIT_URI":["http://efo/1","http://efo/2, http://efo/3","http://efo/4","http://efo/5","http://efo/6"],
+            "LINK":["link","link","link","link","link"],
+            "STUDY":["study1","study2","study3","study4","study5"]
+        })
+        regions = [Region("1",1,20),Region("3",50,150)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fname = os.path.join(tmp_dir,"gwcat.tsv")
+            snapshot = os.path.join(tmp_dir,"gwcat_snapshot")
+            data.to_csv(fname,sep="\t",index=False)
+            self.assertTrue(gwcatalog_api.create_snapshot(fname,snapshot))
+            self.assertFalse(gwcatalog_api.create_snapshot(fname,snapshot))
+            file_db = gwcatalog_api.LocalDB(fname,1.0,0,MockAlleleDB())
+            snapshot_db = gwcatalog_api.LocalDB(snapshot,1.0,0,MockAlleleDB())
+            self.assertEqual(list(snapshot_db.df["trait"]),["1","2","3","4","6"])
+            pd.testing.assert_frame_equal(snapshot_db.df.astype(object),file_db.df.astype(object))
+            pd.testing.assert_frame_equal(snapshot_db.associations_for_regions(regions),file_db.associations_for_regions(regions))
+            #the sorted snapshot is indexed without copying it, and the p-value threshold is applied per query
+            self.assertTrue(snapshot_db.index.sorted)
+            self.assertIs(snapshot_db.index.data,snapshot_db.df)
+            strict_db = gwcatalog_api.LocalDB(snapshot,0.05,0,MockAlleleDB())
+            self.assertEqual(len(strict_db.df),5)
+            self.assertTrue(strict_db.associations_for_regions(regions).empty)
+            #the columns of a table are memory-mapped, and missing values are read as NaN
+            table = os.path.join(tmp_dir,"table")
+            columnar_store.write_table(table,pd.DataFrame({"a":[1.0,np.nan],"b":["x",None],"c":[1,2]}))
+            table_df, _ = columnar_store.read_table(table)
+            self.assertEqual(table_df["b"].isna().tolist(),[False,True])
+            for col in table_df.columns:
+                values = table_df[col].values
+                values = values.codes if table_df[col].dtype.name == "category" else values
+                while values is not None and not isinstance(values,np.memmap):
+                    values = values.base
+                self.assertIsInstance(values,np.memmap)
+            #rewriting a table replaces its data directory, so a table that is already mapped keeps its values
+            columnar_store.write_table(table,pd.DataFrame({"a":[3.0,4.0],"b":["y","z"],"c":[3,4]}))
+            self.assertEqual(table_df["c"].tolist(),[1,2])
+            self.assertEqual(table_df["b"].tolist()[0],"x")
+            self.assertEqual(columnar_store.read_table(table)[0]["c"].tolist(),[3,4])
+            self.assertEqual(len([a for a in os.listdir(table) if a.startswith("data-")]),1)
+            #a snapshot with an old format is recreated
+            meta_file = os.path.join(snapshot,columnar_store.META_FILE)
+            with open(meta_file) as f:
+                meta = json.load(f)
+            meta["format"] = columnar_store.FORMAT_VERSION - 1
+            with open(meta_file,"w") as f:
+                json.dump(meta,f)
+            self.assertTrue(gwcatalog_api.create_snapshot(fname,snapshot))
+            self.assertTrue(columnar_store.is_current(snapshot))
+
+    def test_mirror(self):
+        """Test that a mirror is created from a downloaded or local export, and that db_factory uses it in place of the api only while it is fresh
+        """
+        export = gwcat_download("1",[1000,2000])
+        path = "/gwas/api/search/downloads/alternative"
+        client = http_client.HttpClient()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mirror = os.path.join(tmp_dir,"mirror")
+            export_path = os.path.join(tmp_dir,"export.tsv")
+            #the export time is the Last-Modified time of the download, or the download time without the header
+            last_modified = formatdate(time.time()-2*86400,usegmt=True)
+            with StandInServer([{"path":path,"params":{},"status":200,"body":export,"headers":{"Last-Modified":last_modified},"count":1},
+                                {"path":path,"params":{},"status":200,"body":export}]) as server:
+                self.assertTrue(gwcatalog_api.create_mirror(server.url+path,mirror,export_path,client))
+                self.assertGreater(gwcatalog_api.mirror_age(mirror),86400)
+                self.assertLess(gwcatalog_api.mirror_age(mirror),3*86400)
+                self.assertFalse(gwcatalog_api.create_mirror(server.url+path,mirror,export_path,client))
+            client.close()
+            self.assertLess(gwcatalog_api.mirror_age(mirror),60)
+            db = gwcatalog_api.LocalDB(mirror,1e-5,0,PositionAlleleDB())
+            self.assertEqual(list(db.associations_for_regions([Region("1",1,5000)])["rsid"]),[2000,3000])
+            #offline from the downloaded export, which needs the export time, not the modification time of the file
+            with self.assertRaises(ValueError):
+                gwcatalog_api.create_mirror(export_path,mirror,"")
+            self.assertFalse(gwcatalog_api.create_mirror(export_path,mirror,"",export_time=time.time()-7*86400))
+            self.assertGreater(gwcatalog_api.mirror_age(mirror),6*86400)
+            allele_file = "testing/db_resources/test_vcf.vcf.gz"
+            fresh = datafactory.db_factory(True,"","gwas","",0,1e-5,1,allele_file,mirror_path=mirror,mirror_max_age=30*86400)
+            stale = datafactory.db_factory(True,"","gwas","",0,1e-5,1,allele_file,mirror_path=mirror,mirror_max_age=86400)
+            self.assertEqual(type(fresh.db[0]).__name__,"LocalDB")
+            self.assertEqual(type(stale.db[0]).__name__,"GwasApi")
+            self.assertIsNone(gwcatalog_api.mirror_age(os.path.join(tmp_dir,"missing")))
 
 
 class testGWASDB(unittest.TestCase):
@@ -329,7 +464,8 @@ class testGWASDB(unittest.TestCase):
 
     def test_associations_for_regions(self):
         mockdb = MockAlleleDB()
-        db = gwcatalog_api.GwasApi(1.0,100,1,mockdb)
+        client = http_client.HttpClient()
+        db = gwcatalog_api.GwasApi(1.0,100,1,mockdb,client)
         ranges = [
             Region("1",1,2),
             Region("2",10,12),
@@ -354,8 +490,10 @@ class testGWASDB(unittest.TestCase):
         buf.seek(0)
         request_val.text = buf.getvalue()
         
-        with mock.patch("Scripts.data_access.gwcatalog_api.try_request",return_value=request_val) as mock_request:
+        with mock.patch.object(client,"arequest",new=mock.AsyncMock(return_value=request_val)) as mock_request:
             assocs = db.associations_for_regions(ranges)
+        client.close()
+        self.assertEqual(mock_request.await_count,3)
         validationdata = [{
             "rsid": 12345,
             "chrom":"1",
@@ -370,7 +508,60 @@ class testGWASDB(unittest.TestCase):
             "study":"study1"
             }
         ]
-        self.assertEqual(assocs,validationdata)
+        validationdata = association_table(pd.DataFrame(validationdata))
+        pd.testing.assert_frame_equal(assocs,validationdata)
+
+    def test_query_coalescing(self):
+        """Test that nearby padded regions are fetched with one query, that the results are filtered to the padded regions,
+        and that associations returned by several queries are reported once
+        """
+        path = "/gwas/api/search/downloads"
+        responses = [
+            {"path":path,"params":gwcat_query("1",500,3500),"status":200,"body":gwcat_download("1",[1000,2000,3000])},
+            {"path":path,"params":gwcat_query("1",899500,900500),"status":200,"body":gwcat_download("1",[900000])},
+            {"path":path,"params":gwcat_query("2",0,1100),"status":200,"body":gwcat_download("2",[600])},
+            {"path":path,"params":gwcat_query("3",500,1500),"status":200,"body":gwcat_download("3",[1100])},
+            {"path":path,"params":gwcat_query("3",700,1700),"status":200,"body":gwcat_download("3",[1100,1600])}
+        ]
+        regions = [Region("1",1000,1000),Region("1",3000,3000),Region("1",900000,900000),Region("2",500,600)]
+        client = http_client.HttpClient()
+        with StandInServer(responses) as server:
+            db = gwcatalog_api.GwasApi(1e-5,500,2,PositionAlleleDB(),client,server.url+"/gwas",max_gap=5000,max_span=100000)
+            out = db.associations_for_regions(regions)
+            self.assertEqual(len(server.requests),3)
+            self.assertEqual(list(zip(out["chrom"],out["pos"])),[("1",1000),("1",3000),("1",900000),("2",600)])
+            #overlapping regions that do not fit in one query
+            db = gwcatalog_api.GwasApi(1e-5,500,2,PositionAlleleDB(),client,server.url+"/gwas",max_gap=5000,max_span=900)
+            out = db.associations_for_regions([Region("3",1000,1000),Region("3",1200,1200)])
+            self.assertEqual(len(server.requests),5)
+            self.assertEqual(list(zip(out["chrom"],out["pos"])),[("3",1100),("3",1600)])
+        client.close()
+        self.assertEqual(list(out["rsid"]),[2100,2600])
+
+    def test_failed_query_not_cached(self):
+        """Test that a region whose query failed is reported as failed and not cached, so that it is queried again on the next call
+        """
+        path = "/gwas/api/search/downloads"
+        responses = [
+            {"path":path,"params":gwcat_query("1",500,1500),"status":503,"body":"","count":1},
+            {"path":path,"params":gwcat_query("1",500,1500),"status":200,"body":gwcat_download("1",[1000])},
+            {"path":path,"params":gwcat_query("2",4500,5500),"status":200,"body":gwcat_download("2",[5000])}
+        ]
+        regions = [Region("1",1000,1000),Region("2",5000,5000)]
+        #the client of the module that gwcatalog_api imports, so that its exceptions are the ones gwcatalog_api handles
+        client = gwcatalog_api.http_client.HttpClient(retry_count=1)
+        with StandInServer(responses) as server, tempfile.TemporaryDirectory() as cache_dir:
+            api = gwcatalog_api.GwasApi(1e-5,500,2,PositionAlleleDB(),client,server.url+"/gwas")
+            db = assoc_cache.CachedDB(api,cache_dir)
+            out, failed = db.query_regions(regions)
+            self.assertEqual(failed,[Region("1",1000,1000)])
+            self.assertEqual(list(zip(out["chrom"],out["pos"])),[("2",5000)])
+            out, failed = db.query_regions(regions)
+            self.assertEqual(failed,[])
+            self.assertEqual(sorted(zip(out["chrom"],out["pos"])),[("1",1000),("2",5000)])
+            #only the failed region was queried again
+            self.assertEqual(sorted([r[1]["q"] for r in server.requests]),[gwcat_query("1",500,1500)["q"]]*2+[gwcat_query("2",4500,5500)["q"]])
+        client.close()
 
 if __name__=="__main__":
     unittest.main()
\ No newline at end of file
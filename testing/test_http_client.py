@@ -0,0 +1,56 @@
+import unittest
+import sys,os
+sys.path.append("../")
+sys.path.append("./")
+sys.path.insert(0, './Scripts')
+sys.path.insert(0, './testing')
+from Scripts.data_access import http_client
+from stand_in_server import StandInServer
+
+class TestHttpClient(unittest.TestCase):
+    def setUp(self):
+        self.client = http_client.HttpClient(max_per_host=2, retry_count=3, backoff=0.01)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_retry(self):
+        """Test that 5xx and 429 responses are retried, and that the request fails after the last attempt
+        """
+        responses = [
+            {"path":"/flaky","params":{},"status":503,"body":"","count":1},
+            {"path":"/flaky","params":{},"status":429,"body":"","count":1},
+            {"path":"/flaky","params":{},"status":200,"body":{"value":1}},
+            {"path":"/down","params":{},"status":500,"body":""}
+        ]
+        with StandInServer(responses) as server:
+            r = self.client.request("GET",server.url+"/flaky")
+            self.assertEqual(r.json(),{"value":1})
+            self.assertEqual(len(server.requests),3)
+            with self.assertRaises(http_client.ResponseFailure):
+                self.client.request("GET",server.url+"/down")
+            self.assertEqual(len(server.requests),6)
+
+    def test_not_found(self):
+        """Test that 404 responses raise ResourceNotFound without retrying
+        """
+        with StandInServer([]) as server:
+            with self.assertRaises(http_client.ResourceNotFound) as e:
+                self.client.request("GET",server.url+"/missing",params={"a":1})
+            self.assertEqual(e.exception.parameters["status_code"],404)
+            self.assertEqual(server.requests,[("/missing",{"a":"1"})])
+
+    def test_gather(self):
+        """Test that concurrent requests return in order, and that the number of concurrent requests to a host is bounded
+        """
+        responses = [{"path":"/value","params":{"i":i},"status":200,"body":{"value":i},"delay":0.05} for i in range(8)]
+        async def get(i):
+            r = await self.client.arequest("GET",server.url+"/value",params={"i":i})
+            return r.json()["value"]
+        with StandInServer(responses) as server:
+            out = self.client.gather([get(i) for i in range(8)])
+        self.assertEqual(out,list(range(8)))
+        self.assertEqual(server.max_active,2)
+
+if __name__=="__main__":
+    unittest.main()
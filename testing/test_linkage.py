@@ -0,0 +1,211 @@
+import unittest
+import unittest.mock as mock
+import sys,os,gzip,shlex,tempfile,pickle
+import pandas as pd, numpy as np
+from multiprocessing.dummy import Pool as ThreadPool
+sys.path.append("../")
+sys.path.append("./")
+sys.path.insert(0, './Scripts')
+sys.path.append("./testing")
+from stand_in_server import StandInServer
+from Scripts.data_access import linkage
+from Scripts.data_access.db import LDData, LDTable, Variant
+
+def plink_run_mock(cmd, stdout=None, stderr=None, encoding=None):
+    """Mock plink run: write an LD file with the lead variant and one partner to the --out path
+    """
+    args = cmd
+    out = args[args.index("--out")+1]
+    snp = args[args.index("--ld-snp")+1]
+    chrom, pos = snp.split("_")[0].replace("chr",""), int(snp.split("_")[1])
+    with gzip.open(f"{out}.ld.gz","wt") as f:
+        f.write(" CHR_A BP_A SNP_A CHR_B BP_B SNP_B R2\n")
+        f.write(f" {chrom} {pos} {snp} {chrom} {pos} {snp} 1\n")
+        f.write(f" {chrom} {pos} {snp} {chrom} {pos+1} chr{chrom}_{pos+1}_A_T 0.5\n")
+    retval=mock.Mock()
+    retval.returncode=0
+    retval.stdout=""
+    return retval
+
+class TestPlinkLD(unittest.TestCase):
+
+    def test_get_range(self):
+        """Test that a single LD range is read from the plink output, and that the output directory is removed afterwards
+        """
+        ld = linkage.PlinkLD("panel",1000)
+        variant = Variant("1",100,"A","C")
+        with mock.patch("Scripts.data_access.linkage.subprocess.run",side_effect=plink_run_mock) as mock_run:
+            out = ld.get_range(variant,1000,0.1)
+        validate = [
+            LDData(variant,variant,1.0),
+            LDData(variant,Variant("1",101,"A","T"),0.5)
+        ]
+        self.assertEqual(out,validate)
+        cmd = mock_run.call_args[0][0]
+        out_path = cmd[cmd.index("--out")+1]
+        self.assertFalse(os.path.exists(os.path.dirname(out_path)))
+
+    def test_get_ranges(self):
+        """Test that batched ranges are returned in input order, with separate output directories and a share of the memory
+        """
+        ld = linkage.PlinkLD("panel",1000,threads=4)
+        variants = [Variant("1",100*i,"A","C") for i in range(1,9)]
+        with mock.patch("Scripts.data_access.linkage.subprocess.run",side_effect=plink_run_mock) as mock_run:
+            out = ld.get_ranges(variants,1000,0.1)
+        self.assertEqual([a[0].variant1 for a in out],variants)
+        cmds = [a[0][0] for a in mock_run.call_args_list]
+        out_dirs = set([os.path.dirname(c[c.index("--out")+1]) for c in cmds])
+        self.assertEqual(len(out_dirs),len(variants))
+        self.assertTrue(all([c[c.index("--memory")+1] == "250" for c in cmds]))
+
+    def test_get_range_failure(self):
+        """Test that a failed plink run returns only the variant itself
+        """
+        ld = linkage.PlinkLD("panel",1000)
+        variant = Variant("1",100,"A","C")
+        retval=mock.Mock()
+        retval.returncode=3
+        retval.stdout="Error: No valid variants specified by --ld-snp/--ld-snps/--ld-snp-list."
+        with mock.patch("Scripts.data_access.linkage.subprocess.run",return_value=retval):
+            with mock.patch("Scripts.data_access.linkage.print"):
+                out = ld.get_range(variant,1000,0.1)
+        self.assertEqual(out,[LDData(variant,variant,1.0)])
+
+    def test_panel_index(self):
+        """Test that variants missing from the panel .bim are not passed to plink, and that flipped variants are queried with the panel id
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            panel = os.path.join(tmp_dir,"panel")
+            with open(f"{panel}.bim","w") as f:
+                f.write("1\tchr1_100_A_C\t0\t100\tC\tA\n")
+                f.write("1\tchr1_200_G_T\t0\t200\tT\tG\n")
+            ld = linkage.PlinkLD(panel,1000)
+        self.assertEqual(len(ld.panel_index),2)
+        #single and batched lookups agree, and ids that are not chr_pos_ref_alt are not flipped
+        ids = ["chr1_100_A_C","chr1_100_C_A","chr1_200_T_G","chr1_300_A_C","rs123"]
+        self.assertEqual([ld.panel_index.lookup(a) for a in ids],["chr1_100_A_C","chr1_100_A_C","chr1_200_G_T",None,None])
+        self.assertEqual(list(ld.panel_index.lookup_ids(pd.Series(ids)).fillna("NA")),["chr1_100_A_C","chr1_100_A_C","chr1_200_G_T","NA","NA"])
+        missing = Variant("1",300,"A","C")
+        flipped = Variant("1",200,"T","G")
+        with mock.patch("Scripts.data_access.linkage.subprocess.run",side_effect=plink_run_mock) as mock_run:
+            with mock.patch("Scripts.data_access.linkage.print") as mock_print:
+                out_missing = ld.get_range(missing,1000,0.1)
+                #skipped variants are counted, not printed one by one
+                mock_print.assert_not_called()
+                out_flipped = ld.get_range(flipped,1000,0.1)
+        self.assertEqual(out_missing,[LDData(missing,missing,1.0)])
+        self.assertEqual(ld.panel_misses,1)
+        self.assertEqual(mock_run.call_count,1)
+        cmd = mock_run.call_args[0][0]
+        self.assertEqual(cmd[cmd.index("--ld-snp")+1],"chr1_200_G_T")
+        self.assertEqual(out_flipped,[
+            LDData(flipped,flipped,1.0),
+            LDData(flipped,Variant("1",201,"A","T"),0.5)
+        ])
+
+    def test_clump(self):
+        """Test that clumps are read from the plink output, with chromosome X ids mapped back and r2 from the LD run
+        """
+        def run_mock(cmd, stdout=None, stderr=None, encoding=None):
+            out = cmd[cmd.index("--out")+1]
+            if "--clump" in cmd:
+                with open("testing/fetch_resources/test_plink.clumped") as f_in, open(f"{out}.clumped","w") as f_out:
+                    f_out.write(f_in.read())
+            else:
+                with gzip.open(f"{out}.ld.gz","wt") as f:
+                    f.write(" CHR_A BP_A SNP_A CHR_B BP_B SNP_B R2\n")
+                    f.write(" 1 111111111 chr1_111111111_A_T 1 111111112 chr1_111111112_C_T 0.9\n")
+                    f.write(" X 111111113 chrX_111111113_A_T X 111111114 chrX_111111114_G_T 0.8\n")
+            retval=mock.Mock()
+            retval.returncode=0
+            retval.stdout=""
+            return retval
+        ld = linkage.PlinkLD("panel",1000)
+        assoc = pd.DataFrame({
+            "SNP":["chr1_111111111_A_T","chr1_111111112_C_T","chr23_111111113_A_T","chr23_111111114_G_T","chr23_111111115_C_T"],
+            "P":[1.11e-11,1e-6,1.11e-12,1e-6,1e-6]
+        })
+        with mock.patch("Scripts.data_access.linkage.subprocess.run",side_effect=run_mock) as mock_run:
+            out = ld.clump(assoc,5e-8,1e-5,0.2,1500)
+        cmd = mock_run.call_args_list[0][0][0]
+        self.assertEqual(cmd[cmd.index("--clump-kb")+1],"1500")
+        validate = pd.DataFrame({
+            "lead":["chr1_111111111_A_T","chr23_111111113_A_T","chr1_111111111_A_T","chr23_111111113_A_T","chr23_111111113_A_T"],
+            "variant":["chr1_111111111_A_T","chr23_111111113_A_T","chr1_111111112_C_T","chr23_111111114_G_T","chr23_111111115_C_T"],
+            "r2":[1.0,1.0,0.9,0.8,np.nan]
+        })
+        pd.testing.assert_frame_equal(out,validate)
+
+    def test_partition(self):
+        """Test that worker partitions get a share of the memory and threads, and can be pickled
+        """
+        ld = linkage.PlinkLD("panel",1000,threads=4)
+        part = pickle.loads(pickle.dumps(ld.partition(3)))
+        self.assertEqual((part.memory,part.threads),(333,1))
+        self.assertEqual((ld.memory,ld.threads),(1000,4))
+
+class TestOnlineLD(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer.from_file("testing/linkage_resources/online_ld_responses.json")
+        self.server.__enter__()
+        self.url = self.server.url+"/api/ld"
+
+    def tearDown(self):
+        self.server.__exit__()
+
+    def test_get_range_cached(self):
+        """Test that the LD response is parsed, and that repeated ranges are served from the cache
+        """
+        ld = linkage.OnlineLD(self.url)
+        variant = Variant("1",1000,"A","C")
+        validate = [
+            LDData(variant,variant,1.0),
+            LDData(variant,Variant("1",1500,"G","T"),0.8)
+        ]
+        self.assertEqual(ld.get_range(variant,1000,0.4),validate)
+        self.assertEqual(ld.get_range(variant,1000,0.4),validate)
+        self.assertEqual(len(self.server.requests),1)
+        self.assertEqual(self.server.requests[0][1],{"variant":"1:1000:A:C","panel":"sisu3","window":"100000","r2_thresh":"0.4"})
+
+    def test_concurrent_get_range(self):
+        """Test that ranges fetched concurrently from worker threads are parsed correctly, and cached once per range
+        """
+        ld = linkage.OnlineLD(self.url,prefetch_depth=2)
+        variants = [Variant("1",2000,"C","G"),Variant("1",3000,"G","A")]
+        with ThreadPool(2) as pool:
+            out = pool.starmap(ld.get_range_table,[(v,1000,0.4) for v in variants])
+        self.assertEqual([a.to_ld_data() for a in out],[
+            [LDData(variants[0],variants[0],1.0)],
+            [LDData(variants[1],variants[1],1.0),LDData(variants[1],variants[0],0.5)]
+        ])
+        self.assertEqual([ld.get_range(v,1000,0.4) for v in variants],[a.to_ld_data() for a in out])
+        self.assertEqual(sorted([r[1]["variant"] for r in self.server.requests]),["1:2000:C:G","1:3000:G:A"])
+
+    def test_not_found(self):
+        """Test that a variant not found in the LD api returns only the variant itself
+        """
+        ld = linkage.OnlineLD(self.url)
+        variant = Variant("2",1000,"A","C")
+        with mock.patch("Scripts.data_access.linkage.print"):
+            out = ld.get_range(variant,1000,0.4)
+        self.assertEqual(out,[LDData(variant,variant,1.0)])
+
+class TestLDTable(unittest.TestCase):
+
+    def test_ld_data_round_trip(self):
+        """Test that LDTable converts to and from LDData, and creates variant ids for both variants
+        """
+        ld_data = [
+            LDData(Variant("1",100,"A","C"),Variant("1",100,"A","C"),1.0),
+            LDData(Variant("1",100,"A","C"),Variant("1",250,"GT","G"),0.25)
+        ]
+        table = LDTable.from_ld_data(ld_data)
+        self.assertEqual(len(table),2)
+        self.assertEqual(table.to_ld_data(),ld_data)
+        self.assertEqual(list(table.variant_ids(1)),["chr1_100_A_C","chr1_100_A_C"])
+        self.assertEqual(list(table.variant_ids(2)),["chr1_100_A_C","chr1_250_GT_G"])
+        self.assertTrue(LDTable.from_ld_data([]).empty)
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+import sys,os,tempfile
+import pandas as pd
+sys.path.append("../")
+sys.path.append("./")
+sys.path.insert(0, './Scripts')
+from Scripts.data_access import sqlite_catalog, gwcatalog_api, custom_catalog, datafactory
+from Scripts.data_access.db import AlleleDB, VariantData, Variant
+from Scripts.autoreporting_utils import Region
+
+class PositionAlleleDB(AlleleDB):
+    """Allele database with an A/C variant with rsid pos+1000 at every queried position
+    """
+    def get_alleles(self, positions):
+        return [VariantData(Variant(a.chromosome,a.position,"A","C"),[],a.position+1000) for a in positions]
+
+def write_resources(tmp_dir):
+    gwcat = pd.DataFrame({
+        "SNP_ID_CURRENT": ["1100","1200","1300","9999"],
+        "CHR_ID":["1","1","2","2"],
+        "CHR_POS":["100","200","300","400"],
+        "P-VALUE":[1e-10,1e-3,1e-9,1e-12],
+        "PVALUE_MLOG":[10.,3.,9.,12.],
+        "MAPPED_TRAIT":["A1","B1","C1, C2","D1"],
+        "MAPPED_TRAIT_URI":["http://efo/A1","http://efo/B1","http://efo/C1, http://efo/C2","http://efo/D1"],
+        "LINK":["link1","link2","link3","link4"],
+        "STUDY":["study1","study2","study3","study4"]
+    })
+    custom = pd.DataFrame({
+        "chrom":["1","1","2"],
+        "pos":[150,250,310],
+        "ref":["G","T","C"],
+        "alt":["A","C","CT"],
+        "pval":[1e-9,1e-9,1e-2],
+        "beta":[0.1,-0.2,0.3],
+        "se":[0.01,0.02,0.03],
+        "trait":["T1","T2","T3"],
+        "study_doi":["doi1","doi2","doi3"]
+    })
+    gwcat_path = os.path.join(tmp_dir,"gwcat.tsv")
+    custom_path = os.path.join(tmp_dir,"custom.tsv")
+    gwcat.to_csv(gwcat_path,sep="\t",index=False)
+    custom.to_csv(custom_path,sep="\t",index=False)
+    return gwcat_path, custom_path
+
+class TestSQLiteDB(unittest.TestCase):
+
+    def test_associations_for_regions(self):
+        """Test that the SQLite database returns the same associations as the LocalDB and CustomCatalog it was imported from
+        """
+        regions = [Region("1",120,180),Region("1",240,260),Region("2",290,320)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gwcat_path, custom_path = write_resources(tmp_dir)
+            db_path = os.path.join(tmp_dir,"assoc.db")
+            self.assertEqual(sqlite_catalog.import_associations(db_path,gwcat_path,"gwcatalog"),5)
+            self.assertEqual(sqlite_catalog.import_associations(db_path,custom_path,"custom"),3)
+            sqlite_db = sqlite_catalog.SQLiteDB(db_path,1e-5,30,PositionAlleleDB())
+            reference_db = datafactory.CompoundDB([
+                gwcatalog_api.LocalDB(gwcat_path,1e-5,30,PositionAlleleDB()),
+                custom_catalog.CustomCatalog(custom_path,1e-5,30)
+            ])
+            out = sqlite_db.associations_for_regions(regions)
+            validate = reference_db.associations_for_regions(regions)
+        sort_cols = ["chrom","pos","trait"]
+        self.assertEqual(list(out["trait"].sort_values()),["A1","C1","C2","T1","T2"])
+        pd.testing.assert_frame_equal(
+            out.sort_values(sort_cols).reset_index(drop=True),
+            validate.sort_values(sort_cols).reset_index(drop=True),
+            check_dtype=False
+        )
+
+    def test_no_associations(self):
+        """Test that a region without associations returns an empty association table
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            _, custom_path = write_resources(tmp_dir)
+            db_path = os.path.join(tmp_dir,"assoc.db")
+            sqlite_catalog.import_associations(db_path,custom_path,"custom")
+            out = sqlite_catalog.SQLiteDB(db_path,1e-5,0,None).associations_for_regions([Region("3",1,1000)])
+        self.assertTrue(out.empty)
+
+if __name__=="__main__":
+    unittest.main()
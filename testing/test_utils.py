@@ -1,8 +1,11 @@
 import unittest
-import sys,os
+import sys,os,tempfile
 sys.path.append("../")
 sys.path.append("./")
 import pandas as pd,numpy as np
+import unittest.mock as mock
+import pysam
+from multiprocessing.dummy import Pool as ThreadPool
 from Scripts import autoreporting_utils
 from Scripts.autoreporting_utils import Region
 
@@ -104,5 +107,76 @@ class TestUtils(unittest.TestCase):
             vdata[vdata.columns]=vdata[vdata.columns].apply(pd.to_numeric,errors="ignore")
         annotation_data = autoreporting_utils.load_pysam_df(data,annotate_fpath,columns)
         self.assertTrue(vdata.equals(annotation_data))
+
+    def test_position_index(self):
+        """Test that region queries return the rows inside the region, inclusive of the ends, in the original row order, and that sorted data with categorical chromosomes is indexed in place
+        """
+        rng = np.random.RandomState(5)
+        data = pd.DataFrame({
+            "chrom":rng.choice([1,2,"X"],200),
+            "pos":rng.randint(1,100,200),
+            "value":np.arange(200)
+        })
+        index = autoreporting_utils.PositionIndex(data,"chrom","pos")
+        self.assertEqual(len(index),200)
+        for (chrom,start,end) in [("1",10,20),("X",1,1),("2",50,200),("3",1,100)]:
+            out = index.query(chrom,start,end)
+            validate = data.loc[(data["chrom"].astype(str)==chrom)&(data["pos"]>=start)&(data["pos"]<=end),"value"]
+            self.assertEqual(list(out["value"]),list(validate))
+        self.assertFalse(index.sorted)
+        sorted_data = data.astype({"chrom":str}).sort_values(["chrom","pos"],kind="mergesort").reset_index(drop=True).astype({"chrom":"category"})
+        sorted_index = autoreporting_utils.PositionIndex(sorted_data,"chrom","pos")
+        self.assertTrue(sorted_index.sorted)
+        self.assertIs(sorted_index.data,sorted_data)
+        for (chrom,start,end) in [("1",10,20),("X",1,1),("2",50,200),("3",1,100)]:
+            out = sorted_index.query(chrom,start,end)
+            validate = sorted_data.loc[(sorted_data["chrom"].astype(str)==chrom)&(sorted_data["pos"]>=start)&(sorted_data["pos"]<=end),"value"]
+            self.assertEqual(list(out["value"]),list(validate))
+
+    def test_tabix_pool(self):
+        """Test that the tabix pool reuses handles within a thread, uses separate handles in other threads, and reads the header once
+        """
+        fpath = "testing/annotate_resources/gnomad_genomes.tsv.gz"
+        pool = autoreporting_utils.TabixPool()
+        handle = pool.handle(fpath)
+        self.assertIs(pool.handle(fpath),handle)
+        with ThreadPool(4) as threads:
+            handles = threads.map(lambda _: id(pool.handle(fpath)),range(4))
+            lines = threads.map(lambda pos: pool.fetch(fpath,"1",pos-1,pos),[1,10]*4)
+        self.assertNotIn(id(handle),handles)
+        self.assertEqual([a.split("\t")[2] for b in lines for a in b],["rs1111","rs1112"]*4)
+        with mock.patch("Scripts.autoreporting_utils.gzip.open",wraps=autoreporting_utils.gzip.open) as gzip_open:
+            headers = [pool.header(fpath) for _ in range(3)]
+        self.assertEqual(gzip_open.call_count,1)
+        self.assertEqual(headers[0][:3],["#CHROM","POS","ID"])
+        self.assertEqual(pool.contigs(fpath),["1"])
+        pool.close()
+        self.assertIsNot(pool.handle(fpath),handle)
+
+    def test_load_tabix_rows(self):
+        """Test that point and range queries are coalesced, each merged interval is fetched once, and each row is returned once
+        """
+        intervals = autoreporting_utils.coalesce_intervals(np.array(["1","X","1","1"]),np.array([3000,1000,1000,2000]),np.array([3200,1000,1000,2600]),500)
+        self.assertEqual([(a.chrom,a.start,a.end) for a in intervals],[("1",1000,1000),("1",2000,3200),("X",1000,1000)])
+        points = pd.DataFrame({"chrom":["1","1","X","2"],"pos":[2500,2800,1500,100]})
+        ranges = pd.DataFrame({"chrom":["1","1"],"min":[2600,2700],"max":[3100,3250]})
+        data = pd.DataFrame({"#chrom":["1"]*7+["X"]*2,"pos":[1000,2000,2500,2800,3000,3200,3999,1000,1500],"value":np.arange(9)})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fpath = os.path.join(tmp_dir,"data.tsv")
+            data.to_csv(fpath,sep="\t",index=False)
+            fpath = pysam.tabix_index(fpath,seq_col=0,start_col=1,end_col=1,meta_char="#")
+            with mock.patch("Scripts.autoreporting_utils.tabix_pool.fetch",wraps=autoreporting_utils.tabix_pool.fetch) as fetch:
+                out = autoreporting_utils.load_tabix_rows(fpath,points=points,ranges=ranges,max_gap=1000)
+            #position lookups alone use the small default gap, so positions 1.5 kb apart are fetched separately
+            with mock.patch("Scripts.autoreporting_utils.tabix_pool.fetch",wraps=autoreporting_utils.tabix_pool.fetch) as point_fetch:
+                point_out = autoreporting_utils.load_tabix_rows(fpath,points=pd.DataFrame({"chrom":["1","1","1"],"pos":[2000,2500,3999]}))
+            autoreporting_utils.tabix_pool.close()
+        self.assertEqual([a[0][1:] for a in point_fetch.call_args_list],[("1",1999,2500),("1",3998,3999)])
+        self.assertEqual(list(point_out["value"]),[1,2,6])
+        #chromosome 1 is read as one interval, chromosome 2 is not in the file
+        self.assertEqual(fetch.call_count,2)
+        self.assertEqual(list(zip(out["#chrom"].astype(str),out["pos"])),[("1",2500),("1",2800),("1",3000),("1",3200),("X",1500)])
+        self.assertEqual(list(out["value"]),[2,3,4,5,8])
+
 if __name__=="__main__":
     unittest.main()
\ No newline at end of file